@@ -0,0 +1,87 @@
+"""
+Compares the Postgres backend with the in-memory local backend (see
+src/local.py) by timing every read endpoint in-process through the test
+client. Each backend runs in a fresh interpreter with MOVIE_API_BACKEND set,
+so neither benefits from the other's warm state. The POSTGRES_* environment
+variables select the database for the postgres run.
+
+    python -m benchmarks.backends --iterations 200
+    python -m benchmarks.backends --backend local
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROUTES = [
+    "/movies/44",
+    "/movies/",
+    "/movies/?name=big&sort=rating",
+    "/characters/2",
+    "/characters/",
+    "/characters/?sort=number_of_lines&limit=250",
+    "/lines/2",
+    "/lines/2/conversations",
+    "/lines/longest/2",
+    "/search/movies/?q=the",
+    "/search/autocomplete/?prefix=th",
+]
+
+RUNNER = """
+import json, statistics, sys, time
+from fastapi.testclient import TestClient
+from src import cache
+from src.api.server import app
+
+routes, iterations = json.loads(sys.argv[1]), int(sys.argv[2])
+results = {}
+with TestClient(app) as client:
+    for route in routes:
+        client.get(route)
+        timings = []
+        for _ in range(iterations):
+            # measure the backend rather than the read-through cache
+            cache.movie_cache.clear()
+            cache.character_cache.clear()
+            start = time.perf_counter()
+            client.get(route)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        results[route] = {
+            "p50_ms": statistics.median(timings) * 1000,
+            "p95_ms": timings[int(len(timings) * 0.95) - 1] * 1000,
+        }
+print(json.dumps(results))
+"""
+
+
+def run_backend(backend, iterations):
+    env = dict(os.environ, MOVIE_API_BACKEND=backend)
+    output = subprocess.run(
+        [sys.executable, "-c", RUNNER, json.dumps(ROUTES), str(iterations)],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare data backends.")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument(
+        "--backend", action="append", choices=["postgres", "local"], dest="backends"
+    )
+    args = parser.parse_args()
+
+    results = {
+        backend: run_backend(backend, args.iterations)
+        for backend in args.backends or ["postgres", "local"]
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
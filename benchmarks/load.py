@@ -0,0 +1,149 @@
+"""
+Load test for the API: keeps `--concurrency` requests in flight until
+`--requests` have completed and reports throughput and latency.
+
+Either point it at a running server with `--url`, or pass `--compare` to start
+the app under uvicorn once with the threadpool (psycopg2) database path and
+once with the async (asyncpg) path and compare the two. The POSTGRES_*
+environment variables select the database.
+
+    python -m benchmarks.load --compare --concurrency 500 --requests 20000
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+DEFAULT_PATHS = [
+    "/movies/44",
+    "/characters/2",
+    "/movies/?sort=rating",
+    "/characters/?name=amy",
+    "/lines/longest/2",
+]
+
+
+def send(client, request):
+    """Sends a path as a GET, or a (method, path, json body) tuple."""
+    if isinstance(request, str):
+        return client.get(request)
+    method, path, body = request
+    return client.request(method, path, json=body)
+
+
+async def run_load(url, paths, concurrency, total):
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+
+        async def worker():
+            nonlocal errors
+            for i in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await send(client, paths[i % len(paths)])
+                    if response.status_code >= 500:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "requests_per_second": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def percentile(ordered, q):
+    return ordered[max(int(len(ordered) * q) - 1, 0)]
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url + "/", timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not start")
+
+
+@contextlib.contextmanager
+def serve(port, env):
+    """Runs the app under uvicorn with `env` and yields its url."""
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "src.api.server:app",
+            "--port", str(port), "--log-level", "warning",
+        ],
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_up(url)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_server_mode(async_mode, port, paths, concurrency, total):
+    env = dict(os.environ, POSTGRES_ASYNC="true" if async_mode else "false")
+    with serve(port, env) as url:
+        # warm the pool and caches so both modes are measured at steady state
+        asyncio.run(run_load(url, paths, min(concurrency, 50), 200))
+        return asyncio.run(run_load(url, paths, concurrency, total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API.")
+    parser.add_argument("--url", default="http://127.0.0.1:3000")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--port", type=int, default=3100)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--path", action="append", dest="paths")
+    args = parser.parse_args()
+    paths = args.paths or DEFAULT_PATHS
+
+    if args.compare:
+        results = {
+            "threadpool": run_server_mode(
+                False, args.port, paths, args.concurrency, args.requests
+            ),
+            "async": run_server_mode(
+                True, args.port, paths, args.concurrency, args.requests
+            ),
+        }
+    else:
+        results = asyncio.run(
+            run_load(args.url, paths, args.concurrency, args.requests)
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
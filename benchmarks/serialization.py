@@ -0,0 +1,100 @@
+"""
+Compares FastAPI's default JSON encoding with the fast path in
+src/fast_json.py, for the routes with the largest responses.
+
+Two things are measured:
+
+* `encode`: the time to turn each route's response into bytes, in-process,
+  with jsonable_encoder followed by json.dumps as FastAPI does, and with
+  fast_json.dumps.
+* `routes`: the time of whole requests through the test client, in a fresh
+  interpreter with MOVIE_API_FAST_JSON=none and again with
+  MOVIE_API_FAST_JSON=all (see benchmarks/backends.py).
+
+MOVIE_API_BACKEND selects the backend as usual.
+
+    python -m benchmarks.serialization --iterations 200
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.backends import RUNNER
+
+ROUTES = [
+    "/movies/?sort=rating&limit=250",
+    "/movies/?ids=" + ",".join(str(id) for id in range(250)),
+    "/characters/?limit=250",
+    "/characters/?sort=number_of_lines&limit=250",
+    "/lines/2",
+    "/lines/2/conversations",
+    "/graph/characters/2/neighborhood?hops=2&limit=500",
+]
+
+
+def time_ms(fn, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def encode(iterations):
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.testclient import TestClient
+
+    from src import fast_json
+    from src.api.server import app
+
+    def default_dumps(content):
+        return json.dumps(
+            jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")
+        ).encode()
+
+    results = {}
+    with TestClient(app) as client:
+        for route in ROUTES:
+            content = client.get(route).json()
+            results[route] = {
+                "bytes": len(fast_json.dumps(content)),
+                "default_ms": time_ms(lambda: default_dumps(content), iterations),
+                "fast_ms": time_ms(lambda: fast_json.dumps(content), iterations),
+            }
+    return results
+
+
+def routes(fast_json, iterations):
+    env = dict(os.environ, MOVIE_API_FAST_JSON=fast_json)
+    output = subprocess.run(
+        [sys.executable, "-c", RUNNER, json.dumps(ROUTES), str(iterations)],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JSON response encoding.")
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    results = {
+        "encode": encode(args.iterations),
+        "routes": {
+            "default": routes("none", args.iterations),
+            "fast": routes("all", args.iterations),
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Measures cold start cost of the API: how long importing the app takes and
+how long the first request takes afterwards. For comparison it also times
+what the old import-time setup did, which was to connect and reflect the four
+tables before the app could serve anything.
+
+Each measurement runs in a fresh interpreter so nothing is shared between
+runs. Point the POSTGRES_* environment variables at the database to use.
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+STATIC = """
+import time
+start = time.perf_counter()
+from src.api.server import app
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+TestClient(app).get("/movies/44")
+served = time.perf_counter()
+print(imported - start, served - start)
+"""
+
+REFLECTED = """
+import time
+start = time.perf_counter()
+import sqlalchemy
+from src import database as db
+engine = sqlalchemy.create_engine(db.database_connection_url())
+conn = engine.connect()
+metadata_obj = sqlalchemy.MetaData()
+for name in ("Movies", "Characters", "Conversations", "Lines"):
+    sqlalchemy.Table(name, metadata_obj, autoload_with=engine)
+from src.api.server import app
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+TestClient(app).get("/movies/44")
+served = time.perf_counter()
+print(imported - start, served - start)
+"""
+
+
+def measure(code, runs):
+    imports = []
+    first_requests = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout
+        imported, served = (float(value) for value in output.split())
+        imports.append(imported)
+        first_requests.append(served)
+    return {
+        "import_ms": statistics.median(imports) * 1000,
+        "first_request_ms": statistics.median(first_requests) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API cold start time.")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {
+        "reflected": measure(REFLECTED, args.runs),
+        "static": measure(STATIC, args.runs),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
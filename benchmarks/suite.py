@@ -0,0 +1,364 @@
+"""
+Benchmark suite for every route of the movies, characters, lines and
+conversations routers. Each route is load tested on its own, at every
+`--concurrency` level given, and the throughput, error count and
+p50/p95/p99 latency of each are written as JSON for comparing runs.
+
+The data comes from the CSVs bundled with the repository. The repository
+ships no line data, so unless the data directory has a lines.csv,
+deterministic synthetic lines are generated for every conversation (see
+`--seed-value`). Two backends are supported:
+
+* `local` serves the data from memory (src/local.py), with no database.
+  Write routes are skipped, since the local backend is read only.
+* `postgres` uses the database the POSTGRES_* environment variables point
+  at. With `--seed`, its tables are DROPPED, recreated, loaded with the same
+  data and migrated first, so only use it on a throwaway database such as a
+  local container:
+
+      docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres:15
+
+Examples:
+
+    python -m benchmarks.suite --backend local --output before.json
+    python -m benchmarks.suite --backend postgres --seed \
+        --concurrency 1 --concurrency 50
+    python -m benchmarks.suite --backend local --baseline before.json \
+        --route number_of_lines
+
+With `--baseline`, each route's p95 is compared with an earlier run and the
+suite exits with status 1 if any got slower by more than `--max-regression`.
+"""
+
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.load import run_load, serve
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+TABLE_FILES = [
+    ("Movies", "movies.csv"),
+    ("Characters", "characters.csv"),
+    ("Conversations", "conversations.csv"),
+    ("Lines", "lines.csv"),
+]
+WORDS = (
+    "I you we they it the a what why where never always maybe tonight money "
+    "gun car love hate run stop please yes no listen look know think want "
+    "need tell said going gonna right now here there something nothing"
+).split()
+
+
+def read_csv(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def prepare_data(source_dir, target_dir, seed):
+    """
+    Copies the CSVs from `source_dir` into `target_dir`, generating a
+    lines.csv when `source_dir` has none.
+    """
+    for _, file_name in TABLE_FILES[:3]:
+        shutil.copy(source_dir / file_name, target_dir / file_name)
+    if (source_dir / "lines.csv").exists():
+        shutil.copy(source_dir / "lines.csv", target_dir / "lines.csv")
+        return
+
+    rng = random.Random(seed)
+    line_id = 0
+    with open(target_dir / "lines.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            [
+                "line_id",
+                "character_id",
+                "movie_id",
+                "conversation_id",
+                "line_sort",
+                "line_text",
+            ]
+        )
+        for conversation in read_csv(source_dir / "conversations.csv"):
+            speakers = (conversation["character1_id"], conversation["character2_id"])
+            for line_sort in range(1, rng.randint(2, 9)):
+                words = rng.choices(WORDS, k=rng.randint(1, 25))
+                writer.writerow(
+                    [
+                        line_id,
+                        speakers[(line_sort - 1) % 2],
+                        conversation["movie_id"],
+                        conversation["conversation_id"],
+                        line_sort,
+                        " ".join(words).capitalize() + rng.choice(".?!"),
+                    ]
+                )
+                line_id += 1
+
+
+def seed_postgres(data_dir):
+    """Recreates the tables from the CSVs in `data_dir` and migrates them."""
+    from src import database as db
+    from src.migrate import migrate
+
+    engine = db.get_engine()
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "DROP TABLE IF EXISTS schema_migrations, character_pair_stats, "
+            'movie_stats, character_stats, "Lines", "Conversations", "Characters", '
+            '"Movies" CASCADE'
+        )
+        conn.exec_driver_sql(
+            "DROP SEQUENCE IF EXISTS "
+            "conversations_conversation_id_seq, lines_line_id_seq"
+        )
+        db.metadata_obj.create_all(
+            conn, tables=[db.movies, db.characters, db.conversations, db.lines]
+        )
+
+    raw = engine.raw_connection()
+    try:
+        with raw.cursor() as cursor:
+            for table, file_name in TABLE_FILES:
+                with open(data_dir / file_name, encoding="utf-8") as f:
+                    columns = f.readline().strip()
+                    cursor.copy_expert(
+                        f'COPY "{table}" ({columns}) FROM STDIN WITH (FORMAT csv)', f
+                    )
+        raw.commit()
+    finally:
+        raw.close()
+
+    migrate()
+
+
+def route_requests(data_dir, writes):
+    """
+    The requests to send to each route, keyed by route. Routes with a path
+    parameter cycle through a sample of ids so that the measurements are not
+    all cache hits.
+    """
+    rng = random.Random(0)
+    movies = read_csv(data_dir / "movies.csv")
+    conversations = read_csv(data_dir / "conversations.csv")
+    speakers = sorted(
+        {int(row["character_id"]) for row in read_csv(data_dir / "lines.csv")}
+    )
+
+    movie_ids = [
+        int(row["movie_id"]) for row in rng.sample(movies, min(50, len(movies)))
+    ]
+    character_ids = rng.sample(speakers, min(50, len(speakers)))
+    id_list = ",".join(str(id) for id in character_ids[:20])
+    movie_id_list = ",".join(str(id) for id in movie_ids[:20])
+
+    routes = {
+        "GET /movies/{movie_id}": [f"/movies/{id}" for id in movie_ids],
+        "GET /movies/": ["/movies/"],
+        "GET /movies/?sort=year": ["/movies/?sort=year&limit=250"],
+        "GET /movies/?sort=rating": ["/movies/?sort=rating&offset=200"],
+        "GET /movies/?name=": [
+            "/movies/?name=the",
+            "/movies/?name=star",
+            "/movies/?name=man",
+        ],
+        "GET /movies/?cursor=": ["/movies/?cursor=&sort=rating"],
+        "GET /movies/?ids=": [f"/movies/?ids={movie_id_list}"],
+        "GET /characters/{id}": [f"/characters/{id}" for id in character_ids],
+        "GET /characters/": ["/characters/"],
+        "GET /characters/?sort=movie": ["/characters/?sort=movie"],
+        "GET /characters/?sort=number_of_lines": [
+            "/characters/?sort=number_of_lines&limit=250"
+        ],
+        "GET /characters/?name=": ["/characters/?name=john", "/characters/?name=an"],
+        "GET /characters/?cursor=": ["/characters/?cursor=&sort=number_of_lines"],
+        "GET /characters/?ids=": [f"/characters/?ids={id_list}"],
+        "GET /lines/{character_id}": [f"/lines/{id}" for id in character_ids],
+        "GET /lines/{character_id}/stream": [
+            f"/lines/{id}/stream" for id in character_ids
+        ],
+        "GET /lines/{char_id}/conversations": [
+            f"/lines/{id}/conversations" for id in character_ids
+        ],
+        "GET /lines/longest/{char_id}": [
+            f"/lines/longest/{id}" for id in character_ids
+        ],
+        "GET /lines/longest/{char_id}?offset=": [
+            f"/lines/longest/{id}?limit=5&offset=20" for id in character_ids
+        ],
+    }
+
+    if writes:
+        new_conversations = []
+        for row in rng.sample(conversations, min(50, len(conversations))):
+            character_1_id, character_2_id = int(row["character1_id"]), int(
+                row["character2_id"]
+            )
+            new_conversations.append(
+                (
+                    int(row["movie_id"]),
+                    {
+                        "character_1_id": character_1_id,
+                        "character_2_id": character_2_id,
+                        "lines": [
+                            {
+                                "character_id": character_1_id,
+                                "line_text": "Benchmark line one.",
+                            },
+                            {
+                                "character_id": character_2_id,
+                                "line_text": "Benchmark line two.",
+                            },
+                        ],
+                    },
+                )
+            )
+        routes["POST /movies/{movie_id}/conversations/"] = [
+            ("POST", f"/movies/{movie_id}/conversations/", body)
+            for movie_id, body in new_conversations
+        ]
+        routes["POST /movies/{movie_id}/conversations/batch/"] = [
+            ("POST", f"/movies/{movie_id}/conversations/batch/", [body] * 5)
+            for movie_id, body in new_conversations
+        ]
+    return routes
+
+
+def run_suite(url, routes, concurrency_levels, total):
+    results = {}
+    for concurrency in concurrency_levels:
+        results[str(concurrency)] = {}
+        for route, requests in routes.items():
+            # one pass over the route's requests warms the caches and pool
+            asyncio.run(
+                run_load(url, requests, min(concurrency, len(requests)), len(requests))
+            )
+            result = asyncio.run(run_load(url, requests, concurrency, total))
+            results[str(concurrency)][route] = result
+            print(
+                f"{concurrency:>4} {route:<48} "
+                f"{result['requests_per_second']:>9.1f} req/s "
+                f"p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms  "
+                f"p99 {result['p99_ms']:>8.2f} ms  errors {result['errors']}",
+                file=sys.stderr,
+            )
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Prints the p95 change of each route and returns the regressed ones."""
+    regressions = []
+    for concurrency, routes in results.items():
+        for route, result in routes.items():
+            before = baseline["results"].get(concurrency, {}).get(route)
+            if before is None:
+                continue
+            change = result["p95_ms"] / before["p95_ms"] - 1
+            print(f"{concurrency:>4} {route:<48} p95 {change:+7.1%}", file=sys.stderr)
+            if change > max_regression:
+                regressions.append((concurrency, route, change))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every route of the API.")
+    parser.add_argument("--backend", choices=["local", "postgres"], default="local")
+    parser.add_argument(
+        "--seed",
+        action="store_true",
+        help="recreate and load the postgres tables first",
+    )
+    parser.add_argument(
+        "--seed-value", type=int, default=0, help="seed for the synthetic lines"
+    )
+    parser.add_argument("--data-dir", type=pathlib.Path, default=REPO_DIR)
+    parser.add_argument("--url", help="benchmark a server that is already running")
+    parser.add_argument("--port", type=int, default=3200)
+    parser.add_argument(
+        "--concurrency", type=int, action="append", dest="concurrency_levels"
+    )
+    parser.add_argument("--requests", type=int, default=1000, help="requests per route")
+    parser.add_argument("--route", help="only run routes containing this text")
+    parser.add_argument("--no-writes", action="store_true", help="skip the POST routes")
+    parser.add_argument("--output", type=pathlib.Path)
+    parser.add_argument("--baseline", type=pathlib.Path)
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+    concurrency_levels = args.concurrency_levels or [10]
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = pathlib.Path(data_dir)
+        prepare_data(args.data_dir, data_dir, args.seed_value)
+        if args.backend == "postgres" and args.seed:
+            seed_postgres(data_dir)
+
+        writes = args.backend == "postgres" and not args.no_writes
+        routes = route_requests(data_dir, writes)
+        if args.route:
+            routes = {
+                route: requests
+                for route, requests in routes.items()
+                if args.route in route
+            }
+
+        if args.url:
+            results = run_suite(args.url, routes, concurrency_levels, args.requests)
+        else:
+            env = dict(
+                os.environ,
+                MOVIE_API_BACKEND=args.backend,
+                MOVIE_API_DATA_DIR=str(data_dir),
+            )
+            with serve(args.port, env) as url:
+                results = run_suite(url, routes, concurrency_levels, args.requests)
+
+    report = {
+        "meta": {
+            "backend": args.backend,
+            "commit": git_commit(),
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "requests_per_route": args.requests,
+            "concurrency": concurrency_levels,
+        },
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
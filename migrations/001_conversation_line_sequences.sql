@@ -0,0 +1,23 @@
+-- Conversation and line ids used to be computed by the API as max(id) + 1,
+-- which costs a scan per insert and races under concurrent writers. Back both
+-- columns with sequences instead.
+
+CREATE SEQUENCE IF NOT EXISTS conversations_conversation_id_seq
+    OWNED BY "Conversations".conversation_id;
+SELECT setval(
+    'conversations_conversation_id_seq',
+    COALESCE((SELECT max(conversation_id) FROM "Conversations"), 0) + 1,
+    false
+);
+ALTER TABLE "Conversations"
+    ALTER COLUMN conversation_id SET DEFAULT nextval('conversations_conversation_id_seq');
+
+CREATE SEQUENCE IF NOT EXISTS lines_line_id_seq
+    OWNED BY "Lines".line_id;
+SELECT setval(
+    'lines_line_id_seq',
+    COALESCE((SELECT max(line_id) FROM "Lines"), 0) + 1,
+    false
+);
+ALTER TABLE "Lines"
+    ALTER COLUMN line_id SET DEFAULT nextval('lines_line_id_seq');
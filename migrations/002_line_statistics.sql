@@ -0,0 +1,73 @@
+-- Precomputed line counts so the list and detail endpoints do not aggregate
+-- the whole Lines table on every request. The API keeps these current as it
+-- writes conversations (see src/stats.py).
+
+-- num_lines counts every line a character speaks; num_distinct_lines counts
+-- distinct line texts, which is what /characters/ reports as number_of_lines.
+CREATE TABLE IF NOT EXISTS character_stats (
+    character_id integer PRIMARY KEY REFERENCES "Characters" (character_id),
+    movie_id integer NOT NULL REFERENCES "Movies" (movie_id),
+    num_lines integer NOT NULL DEFAULT 0,
+    num_distinct_lines integer NOT NULL DEFAULT 0
+);
+
+INSERT INTO character_stats (character_id, movie_id, num_lines, num_distinct_lines)
+SELECT c.character_id, c.movie_id, count(l.line_id), count(DISTINCT l.line_text)
+FROM "Characters" c
+LEFT JOIN "Lines" l ON l.character_id = c.character_id
+WHERE c.movie_id IS NOT NULL
+GROUP BY c.character_id
+ON CONFLICT (character_id) DO NOTHING;
+
+CREATE INDEX IF NOT EXISTS character_stats_num_distinct_lines_idx
+    ON character_stats (num_distinct_lines DESC, character_id);
+CREATE INDEX IF NOT EXISTS character_stats_movie_num_lines_idx
+    ON character_stats (movie_id, num_lines DESC);
+
+-- num_conversations is read by the /analytics snapshot (see src/analytics.py).
+CREATE TABLE IF NOT EXISTS movie_stats (
+    movie_id integer PRIMARY KEY REFERENCES "Movies" (movie_id),
+    num_lines integer NOT NULL DEFAULT 0,
+    num_conversations integer NOT NULL DEFAULT 0
+);
+
+INSERT INTO movie_stats (movie_id, num_lines)
+SELECT m.movie_id, count(l.line_id)
+FROM "Movies" m
+LEFT JOIN "Lines" l ON l.movie_id = m.movie_id
+GROUP BY m.movie_id
+ON CONFLICT (movie_id) DO NOTHING;
+
+UPDATE movie_stats
+SET num_conversations = counts.num_conversations
+FROM (
+    SELECT movie_id, count(*) AS num_conversations
+    FROM "Conversations"
+    GROUP BY movie_id
+) counts
+WHERE counts.movie_id = movie_stats.movie_id;
+
+-- One row per direction of every character pair that shares a conversation:
+-- num_lines is the number of lines character_id speaks to partner_id.
+CREATE TABLE IF NOT EXISTS character_pair_stats (
+    character_id integer NOT NULL REFERENCES "Characters" (character_id),
+    partner_id integer NOT NULL REFERENCES "Characters" (character_id),
+    num_lines integer NOT NULL DEFAULT 0,
+    num_conversations integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (character_id, partner_id)
+);
+
+INSERT INTO character_pair_stats (character_id, partner_id, num_lines, num_conversations)
+SELECT pairs.character_id, pairs.partner_id, count(l.line_id), count(DISTINCT pairs.conversation_id)
+FROM (
+    SELECT conversation_id, character1_id AS character_id, character2_id AS partner_id
+    FROM "Conversations"
+    UNION ALL
+    SELECT conversation_id, character2_id, character1_id
+    FROM "Conversations"
+) pairs
+LEFT JOIN "Lines" l
+    ON l.conversation_id = pairs.conversation_id
+    AND l.character_id = pairs.character_id
+GROUP BY pairs.character_id, pairs.partner_id
+ON CONFLICT (character_id, partner_id) DO NOTHING;
@@ -0,0 +1,10 @@
+-- Trigram indexes for the name and title filters. A GIN trigram index serves
+-- ILIKE '%text%' and ILIKE 'text%' as well as the similarity operators used by
+-- the /search/ endpoints, none of which a btree index can help with.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS movies_title_trgm_idx
+    ON "Movies" USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS characters_name_trgm_idx
+    ON "Characters" USING gin (name gin_trgm_ops);
@@ -0,0 +1,19 @@
+-- The /lines endpoints rank a character's lines by how many words they have,
+-- longest first. Store the word count and character length of every line so
+-- the ranking is read from an index in order instead of computing and sorting
+-- length(line_text) over all of a character's lines on each request. Generated
+-- columns stay current on insert without any help from the API.
+
+-- words are runs of non-whitespace characters
+ALTER TABLE "Lines"
+    ADD COLUMN IF NOT EXISTS word_count integer GENERATED ALWAYS AS (
+        CASE WHEN btrim(line_text, E' \t\n\r\f\v') = '' THEN 0
+        ELSE array_length(regexp_split_to_array(btrim(line_text, E' \t\n\r\f\v'), E'\\s+'), 1)
+        END
+    ) STORED;
+ALTER TABLE "Lines"
+    ADD COLUMN IF NOT EXISTS line_length integer GENERATED ALWAYS AS (length(line_text)) STORED;
+
+-- ties on word count go to the longer line, then to the earlier line
+CREATE INDEX IF NOT EXISTS lines_character_word_count_idx
+    ON "Lines" (character_id, word_count DESC, line_length DESC, line_id);
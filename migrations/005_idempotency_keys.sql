@@ -0,0 +1,13 @@
+-- Responses of writes sent with an Idempotency-Key header, so a client that
+-- retries a request it did not hear back from gets the original response
+-- instead of a second copy of its conversations (see src/idempotency.py).
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key text PRIMARY KEY,
+    request_hash text NOT NULL,
+    response jsonb,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx
+    ON idempotency_keys (created_at);
@@ -0,0 +1,14 @@
+-- A character's conversations used to be found with
+-- character1_id = :id OR character2_id = :id, which no index could serve.
+-- /lines/{char_id}/conversations now reads them as the union of two lookups,
+-- one per column, each served in conversation id order by its own index, so
+-- a page of conversations reads no more rows than it returns.
+CREATE INDEX IF NOT EXISTS conversations_character1_idx
+    ON "Conversations" (character1_id, conversation_id);
+CREATE INDEX IF NOT EXISTS conversations_character2_idx
+    ON "Conversations" (character2_id, conversation_id);
+
+-- the lines of a conversation in the order they were spoken, for the line
+-- previews embedded in that endpoint
+CREATE INDEX IF NOT EXISTS lines_conversation_line_sort_idx
+    ON "Lines" (conversation_id, line_sort);
@@ -0,0 +1,8 @@
+-- /movies/{movie_id}/script streams every line of a movie, conversation by
+-- conversation and in speaking order within each. This index returns them
+-- in exactly that order, so the first lines are sent without reading, let
+-- alone sorting, the rest of the movie first. Transcripts of single
+-- conversations use lines_conversation_line_sort_idx from
+-- migrations/006_conversation_lookups.sql.
+CREATE INDEX IF NOT EXISTS lines_movie_conversation_line_sort_idx
+    ON "Lines" (movie_id, conversation_id, line_sort, line_id);
@@ -0,0 +1,10 @@
+-- /search/autocomplete/ matches names by prefix. The trigram indexes from
+-- migrations/003_name_search.sql answer ILIKE 'text%' too, but only by
+-- collecting every name that shares the prefix's trigrams and rechecking
+-- them. lower(name) LIKE lower('text%') reads just the matching range of
+-- these btree indexes instead; text_pattern_ops makes LIKE prefixes usable
+-- whatever the database collation.
+CREATE INDEX IF NOT EXISTS movies_title_prefix_idx
+    ON "Movies" (lower(title) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS characters_name_prefix_idx
+    ON "Characters" (lower(name) text_pattern_ops);
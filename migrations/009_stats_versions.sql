@@ -0,0 +1,11 @@
+-- Versions for the ETag and Last-Modified validators of the read endpoints
+-- (see src/http_cache.py). Every write of conversations increments the
+-- version and sets updated_at of the movie_stats row of its movie and the
+-- character_stats rows of its characters, in the transaction that writes
+-- them, so every API process serves the same validators for the same data.
+ALTER TABLE movie_stats
+    ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+ALTER TABLE character_stats
+    ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
@@ -0,0 +1,365 @@
+import asyncio
+import datetime
+import logging
+import math
+import os
+import time
+
+import dotenv
+import numpy
+import sqlalchemy
+from starlette.concurrency import run_in_threadpool
+
+from src import database as db, local, statements
+
+# Corpus-wide aggregates for the /analytics endpoints. The movies with their
+# line and conversation counts from movie_stats, the characters with their
+# line counts from character_stats, and the pairs of characters that share a
+# conversation from character_pair_stats are read in bulk, turned into numpy
+# arrays, one per column, and every aggregate is computed from those arrays
+# at once into a snapshot that the endpoints serve as is.
+#
+# Ids are mapped to rows by binary search over the sorted id columns, and
+# each aggregation is a numpy.bincount over dense integer group codes, such
+# as a movie's row in the movie columns, so no step loops over the rows in
+# Python except to read them and to write out the results.
+#
+# The snapshot is built on first use and rebuilt every
+# MOVIE_API_ANALYTICS_REFRESH_SECONDS while the server runs, so it can lag
+# behind writes by up to that long. Set it to 0 to never refresh.
+
+dotenv.load_dotenv()
+REFRESH_SECONDS = float(os.environ.get("MOVIE_API_ANALYTICS_REFRESH_SECONDS", "3600"))
+
+logger = logging.getLogger(__name__)
+
+GENDERS = ("female", "male", "unknown")
+
+
+def column(rows, index, dtype=numpy.int64):
+    """Item `index` of every row in `rows` as an array, None read as NaN."""
+    values = (row[index] for row in rows)
+    if dtype is numpy.float64:
+        values = (math.nan if value is None else value for value in values)
+    return numpy.fromiter(values, dtype=dtype, count=len(rows))
+
+
+def rows_of(keys, ids):
+    """The row of each of `keys` in `ids`, or -1 where it is not in `ids`."""
+    if len(ids) == 0:
+        return numpy.full(len(keys), -1, dtype=numpy.int64)
+    order = numpy.argsort(ids, kind="stable")
+    positions = numpy.searchsorted(ids, keys, sorter=order)
+    rows = order[numpy.minimum(positions, len(ids) - 1)]
+    return numpy.where(ids[rows] == keys, rows, -1)
+
+
+def gender_code(gender):
+    if gender is None:
+        return 2
+    return {"f": 0, "m": 1}.get(gender.lower(), 2)
+
+
+def release_year(year):
+    # a few years carry a suffix, as in "1998/I"
+    if year is None or not year[:4].isdigit():
+        return math.nan
+    return int(year[:4])
+
+
+def correlation(xs, ys):
+    """Pearson's r of two equally long arrays, or None when it is undefined."""
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    if len(xs) < 2:
+        return None
+    dx = xs - xs.mean()
+    dy = ys - ys.mean()
+    sxx = dx @ dx
+    syy = dy @ dy
+    if sxx == 0 or syy == 0:
+        return None
+    return float(dx @ dy / math.sqrt(sxx * syy))
+
+
+def share(part, whole):
+    return round(part / whole, 4) if whole > 0 else None
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+
+class Snapshot:
+    """
+    The aggregates, computed from columns of the corpus:
+    * `movies`: (movie_id, title, year, imdb_rating, num_lines,
+      num_conversations) rows.
+    * `characters`: (character_id, movie_id, gender, num_lines) rows.
+    * `pairs`: (character_id, partner_id) pairs of characters who share a
+      conversation, in either or both orders.
+    """
+
+    def __init__(self, movies, characters, pairs, refreshed_at):
+        self.taken_at = refreshed_at
+        self.refreshed_at = timestamp(refreshed_at)
+
+        # per movie results are listed in order of movie id
+        movies = list(movies)
+        movie_ids = column(movies, 0)
+        order = numpy.argsort(movie_ids, kind="stable")
+        movie_ids = movie_ids[order]
+        titles = column(movies, 1, object)[order].tolist()
+        years = numpy.fromiter(
+            (release_year(movie[2]) for movie in movies),
+            dtype=numpy.float64,
+            count=len(movies),
+        )[order]
+        ratings = column(movies, 3, numpy.float64)[order]
+        movie_lines = column(movies, 4)[order]
+        movie_conversations = column(movies, 5)[order]
+        num_movies = len(movie_ids)
+
+        # characters of movies that are not in the corpus are left out
+        characters = list(characters)
+        character_movie = rows_of(column(characters, 1), movie_ids)
+        in_corpus = character_movie >= 0
+        character_ids = column(characters, 0)[in_corpus]
+        character_movie = character_movie[in_corpus]
+        character_gender = numpy.fromiter(
+            (gender_code(character[2]) for character in characters),
+            dtype=numpy.int64,
+            count=len(characters),
+        )[in_corpus]
+        character_lines = column(characters, 3)[in_corpus]
+        num_characters = len(character_ids)
+
+        gender_lines = numpy.bincount(
+            character_movie * len(GENDERS) + character_gender,
+            weights=character_lines,
+            minlength=num_movies * len(GENDERS),
+        ).reshape(num_movies, len(GENDERS))
+
+        # pairs are coded as one integer, smaller character row first, so
+        # both orders of a pair are the same pair
+        pairs = list(pairs)
+        rows = rows_of(column(pairs, 0), character_ids)
+        partner_rows = rows_of(column(pairs, 1), character_ids)
+        known = (rows >= 0) & (partner_rows >= 0) & (rows != partner_rows)
+        rows, partner_rows = rows[known], partner_rows[known]
+        same_movie = character_movie[rows] == character_movie[partner_rows]
+        rows, partner_rows = rows[same_movie], partner_rows[same_movie]
+        pair_keys = numpy.unique(
+            numpy.minimum(rows, partner_rows) * num_characters
+            + numpy.maximum(rows, partner_rows)
+        )
+        first, second = numpy.divmod(pair_keys, max(num_characters, 1))
+        movie_pairs = numpy.bincount(
+            character_movie[first], minlength=num_movies
+        ).tolist()
+        talkers = numpy.unique(numpy.concatenate([first, second]))
+        movie_talkers = numpy.bincount(
+            character_movie[talkers], minlength=num_movies
+        ).tolist()
+
+        gender_lines = gender_lines.tolist()
+        ids = movie_ids.tolist()
+        lines = movie_lines.tolist()
+        self.gender_share = []
+        self.pair_density = []
+        for row in range(num_movies):
+            self.gender_share.append(
+                {
+                    "movie_id": ids[row],
+                    "title": titles[row],
+                    "lines": lines[row],
+                    **{
+                        gender: share(gender_lines[row][code], lines[row])
+                        for code, gender in enumerate(GENDERS)
+                    },
+                }
+            )
+            talkers_in_movie = movie_talkers[row]
+            self.pair_density.append(
+                {
+                    "movie_id": ids[row],
+                    "title": titles[row],
+                    "characters": talkers_in_movie,
+                    "pairs": movie_pairs[row],
+                    "density": share(
+                        movie_pairs[row], talkers_in_movie * (talkers_in_movie - 1) / 2
+                    ),
+                }
+            )
+
+        dated = ~numpy.isnan(years)
+        year_values, codes = numpy.unique(
+            years[dated].astype(numpy.int64), return_inverse=True
+        )
+        movies_by_year = numpy.bincount(codes, minlength=len(year_values))
+        lines_by_year = numpy.bincount(
+            codes, weights=movie_lines[dated], minlength=len(year_values)
+        )
+        conversations_by_year = numpy.bincount(
+            codes, weights=movie_conversations[dated], minlength=len(year_values)
+        )
+        self.lines_by_year = [
+            {
+                "year": year,
+                "movies": movies,
+                "lines": int(lines),
+                "lines_per_movie": round(lines / movies, 1),
+                "conversations": int(conversations),
+            }
+            for year, movies, lines, conversations in zip(
+                year_values.tolist(),
+                movies_by_year.tolist(),
+                lines_by_year.tolist(),
+                conversations_by_year.tolist(),
+            )
+        ]
+
+        rated = ~numpy.isnan(ratings)
+        buckets, codes = numpy.unique(
+            numpy.floor(ratings[rated]).astype(numpy.int64), return_inverse=True
+        )
+        movies_by_rating = numpy.bincount(codes, minlength=len(buckets))
+        lines_by_rating = numpy.bincount(
+            codes, weights=movie_lines[rated], minlength=len(buckets)
+        )
+        r = correlation(ratings[rated], movie_lines[rated])
+        self.rating_vs_dialogue = {
+            "movies": int(rated.sum()),
+            "correlation": round(r, 4) if r is not None else None,
+            "by_rating": [
+                {
+                    "rating": bucket,
+                    "movies": movies,
+                    "lines": int(lines),
+                    "lines_per_movie": round(lines / movies, 1),
+                }
+                for bucket, movies, lines in zip(
+                    buckets.tolist(),
+                    movies_by_rating.tolist(),
+                    lines_by_rating.tolist(),
+                )
+            ],
+        }
+
+
+@statements.prebuilt
+def movies_statement():
+    return sqlalchemy.select(
+        db.movies.c.movie_id,
+        db.movies.c.title,
+        db.movies.c.year,
+        db.movies.c.imdb_rating,
+        sqlalchemy.func.coalesce(db.movie_stats.c.num_lines, 0),
+        sqlalchemy.func.coalesce(db.movie_stats.c.num_conversations, 0),
+    ).select_from(
+        db.movies.outerjoin(
+            db.movie_stats, db.movie_stats.c.movie_id == db.movies.c.movie_id
+        )
+    )
+
+
+@statements.prebuilt
+def characters_statement():
+    return sqlalchemy.select(
+        db.characters.c.character_id,
+        db.characters.c.movie_id,
+        db.characters.c.gender,
+        sqlalchemy.func.coalesce(db.character_stats.c.num_lines, 0),
+    ).select_from(
+        db.characters.outerjoin(
+            db.character_stats,
+            db.character_stats.c.character_id == db.characters.c.character_id,
+        )
+    )
+
+
+@statements.prebuilt
+def pairs_statement():
+    return sqlalchemy.select(
+        db.character_pair_stats.c.character_id, db.character_pair_stats.c.partner_id
+    ).where(db.character_pair_stats.c.num_conversations > 0)
+
+
+async def load(clock=time.time):
+    refreshed_at = clock()
+    if local.enabled():
+        corpus = local.corpus()
+        movies = [
+            (
+                movie_id,
+                corpus.movie_title[row],
+                corpus.movie_year[row],
+                corpus.movie_rating[row],
+                *corpus.movie_counts(movie_id),
+            )
+            for row, movie_id in enumerate(corpus.movie_id)
+        ]
+        characters = [
+            (
+                character_id,
+                corpus.character_movie[row],
+                corpus.character_gender[row],
+                corpus.num_lines[character_id],
+            )
+            for row, character_id in enumerate(corpus.character_id)
+        ]
+        pairs = list(corpus.conversations_by_pair)
+    else:
+        movies = await db.fetch_all(movies_statement())
+        characters = await db.fetch_all(characters_statement())
+        pairs = await db.fetch_all(pairs_statement())
+    return await run_in_threadpool(Snapshot, movies, characters, pairs, refreshed_at)
+
+
+class SnapshotStore:
+    """
+    Builds the snapshot on first use. Once started, rebuilds it every
+    `interval` seconds in the background, keeping the previous snapshot
+    when a rebuild fails.
+    """
+
+    def __init__(self, load=load, interval=REFRESH_SECONDS):
+        self.load = load
+        self.interval = interval
+        self.snapshot = None
+        self._task = None
+
+    async def get(self):
+        if self.snapshot is None:
+            await self.refresh()
+        return self.snapshot
+
+    async def refresh(self):
+        self.snapshot = await self.load()
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.snapshot is None:
+                # nobody asked for it yet
+                continue
+            try:
+                await self.refresh()
+            except Exception as error:
+                logger.warning("refreshing the analytics snapshot failed: %r", error)
+
+
+snapshots = SnapshotStore()
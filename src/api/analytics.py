@@ -0,0 +1,103 @@
+from fastapi import APIRouter, Request, Response
+from src import analytics, fast_json, http_cache
+
+router = APIRouter()
+
+# Corpus-wide aggregates, served from the snapshot in src/analytics.py. Every
+# response carries `refreshed_at`, the time the snapshot was taken, and an
+# ETag that changes whenever it is refreshed.
+
+
+@router.on_event("startup")
+async def start_refreshing():
+    analytics.snapshots.start()
+
+
+@router.on_event("shutdown")
+async def stop_refreshing():
+    await analytics.snapshots.stop()
+
+
+async def snapshot_or_not_modified(request: Request, response: Response):
+    snapshot = await analytics.snapshots.get()
+    return snapshot, http_cache.conditional_on(
+        request, response, ("analytics",), 0, snapshot.taken_at
+    )
+
+
+@router.get("/analytics/lines-by-year", tags=["analytics"])
+@fast_json.response
+async def get_lines_by_year(request: Request, response: Response):
+    """
+    This endpoint returns the number of lines in the movies of each year.
+    For each year it returns:
+    * `year`: The year of release.
+    * `movies`: The number of movies released that year.
+    * `lines`: The number of lines in those movies.
+    * `lines_per_movie`: The average number of lines per movie.
+    * `conversations`: The number of conversations in those movies.
+
+    The years are listed in order, under `results`.
+    """
+    snapshot, not_modified = await snapshot_or_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return {"refreshed_at": snapshot.refreshed_at, "results": snapshot.lines_by_year}
+
+
+@router.get("/analytics/gender-share", tags=["analytics"])
+@fast_json.response
+async def get_gender_share(request: Request, response: Response):
+    """
+    This endpoint returns how the dialogue of each movie is shared between
+    female, male and other characters. For each movie it returns:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `lines`: The number of lines in the movie.
+    * `female`, `male`, `unknown`: The share of those lines spoken by female
+      characters, male characters and characters whose gender is not known,
+      between 0 and 1, or null for movies without lines.
+    """
+    snapshot, not_modified = await snapshot_or_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return {"refreshed_at": snapshot.refreshed_at, "results": snapshot.gender_share}
+
+
+@router.get("/analytics/rating-vs-dialogue", tags=["analytics"])
+@fast_json.response
+async def get_rating_vs_dialogue(request: Request, response: Response):
+    """
+    This endpoint compares the IMDB rating of movies with how much dialogue
+    they have. It returns:
+    * `movies`: The number of rated movies.
+    * `correlation`: The Pearson correlation between the rating and the
+      number of lines of rated movies.
+    * `by_rating`: For each whole rating, such as 7 for ratings from 7 up to
+      but not including 8, the number of `movies`, their `lines` and their
+      average `lines_per_movie`.
+    """
+    snapshot, not_modified = await snapshot_or_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return {"refreshed_at": snapshot.refreshed_at, **snapshot.rating_vs_dialogue}
+
+
+@router.get("/analytics/pair-density", tags=["analytics"])
+@fast_json.response
+async def get_pair_density(request: Request, response: Response):
+    """
+    This endpoint returns how many of the characters of each movie talk to
+    each other. For each movie it returns:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `characters`: The number of characters in at least one conversation.
+    * `pairs`: The number of pairs of those characters who share at least
+      one conversation.
+    * `density`: `pairs` divided by the number of possible pairs of those
+      characters, or null for movies with fewer than two of them.
+    """
+    snapshot, not_modified = await snapshot_or_not_modified(request, response)
+    if not_modified:
+        return not_modified
+    return {"refreshed_at": snapshot.refreshed_at, "results": snapshot.pair_density}
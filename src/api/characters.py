@@ -1,14 +1,37 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from enum import Enum
+from typing import Optional
 from fastapi.params import Query
-from src import database as db
+from src import (
+    batch,
+    cache,
+    fast_json,
+    http_cache,
+    local,
+    pagination,
+    projection,
+    statements,
+    database as db,
+)
 import sqlalchemy
 
 router = APIRouter()
 
+CHARACTER_FIELDS = ("character_id", "character", "movie", "gender", "top_conversations")
+CHARACTER_COLUMNS = {
+    "character_id": db.characters.c.character_id,
+    "character": db.characters.c.name,
+    "movie": db.movies.c.title,
+    "gender": db.characters.c.gender,
+}
+CHARACTERS_FIELDS = ("character_id", "character", "movie", "number_of_lines")
+
 
 @router.get("/characters/{id}", tags=["characters"])
-def get_character(id: int):
+@fast_json.response
+async def get_character(
+    id: int, request: Request, response: Response, fields: Optional[str] = None
+):
     """
     This endpoint returns a single character by its identifier. For each character
     it returns:
@@ -27,68 +50,216 @@ def get_character(id: int):
     * `gender`: The gender of the character.
     * `number_of_lines_together`: The number of lines the character has with the
       originally queried character.
+
+    To get only some of these, list them in `fields`, for example
+    `?fields=character,movie`. Leaving out `top_conversations` makes the
+    lookup much cheaper.
+
+    Responses carry an `ETag` and `Last-Modified` that change whenever a
+    conversation involving the character is added. Send them back in
+    `If-None-Match` or `If-Modified-Since` to get an empty 304 while your
+    copy is current.
     """
-    character_stmt = (
-        sqlalchemy.select(
-            db.characters.c.character_id,
-            db.characters.c.name,
-            db.movies.c.title.label("movie"),
-            db.characters.c.gender,
+    fields = projection.parse_fields(fields, CHARACTER_FIELDS)
+    not_modified, version = await http_cache.conditional_version(
+        request, response, "character", id
+    )
+    if not_modified:
+        return not_modified
+
+    if fields is not None and "top_conversations" not in fields:
+        return await character_summary(id, fields)
+    character = await cache.character_cache.get_or_load(
+        id, lambda: character_details(id), version
+    )
+    return projection.project(character, fields)
+
+
+async def character_summary(id: int, fields):
+    # without its conversations a character is a single row, read directly
+    # rather than through the cache of whole characters
+    if local.enabled():
+        character = local.corpus().character(id)
+    else:
+        rows = await db.fetch_all(
+            character_summary_statement(fields), {"character_id": id}
         )
-        .select_from(db.characters.join(db.movies)) 
-        .where(db.characters.c.character_id == id)
-        .limit(1)
+        character = dict(rows[0]._mapping) if rows else None
+    if character is None:
+        raise HTTPException(status_code=404, detail="Character not found")
+    return projection.project(character, fields)
+
+
+@statements.prebuilt
+def character_summary_statement(fields):
+    # joined to its movie even when the title is not wanted, as characters
+    # of unknown movies are not found
+    return (
+        sqlalchemy.select(*[CHARACTER_COLUMNS[field].label(field) for field in fields])
+        .select_from(db.characters.join(db.movies))
+        .where(db.characters.c.character_id == sqlalchemy.bindparam("character_id"))
     )
 
-    with db.engine.connect() as conn:
-        character_result = conn.execute(character_stmt)
-        character_row = character_result.fetchone()
-        if character_row is None:
+
+async def character_details(id: int):
+    if local.enabled():
+        character = local.corpus().character(id)
+        if character is None:
             raise HTTPException(status_code=404, detail="Character not found")
-        character = {
-            "character_id": character_row.character_id,
-            "character": character_row.name,
-            "movie": character_row.movie,
-            "gender": character_row.gender,
-        }
+        return character
+
+    rows = await db.fetch_all(character_statement(), {"character_id": id})
+
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Character not found")
 
-    # get top conversations
-    top_conversations_stmt = (
+    top_conversations = []
+    for row in rows:
+        if row.partner_id is not None:
+            top_conversations.append(
+                {
+                    "character_id": row.partner_id,
+                    "character": row.partner_name,
+                    "gender": row.partner_gender,
+                    "number_of_lines_together": row.number_of_lines_together,
+                }
+            )
+
+    return {
+        "character_id": rows[0].character_id,
+        "character": rows[0].name,
+        "movie": rows[0].movie,
+        "gender": rows[0].gender,
+        "top_conversations": top_conversations,
+    }
+
+
+@statements.prebuilt
+def character_statement():
+    # The character and its top conversations come back from a single
+    # statement: one row per conversation partner, or a single row with null
+    # partner columns. No rows at all means the character does not exist.
+    # The line counts come from character_pair_stats, which holds the lines
+    # each character speaks to each partner, whichever of the two
+    # conversation columns either of them is in.
+    id = sqlalchemy.bindparam("character_id")
+    pairs = db.character_pair_stats
+    partners = db.characters.alias("partners")
+    top_conversations = (
+        sqlalchemy.select(
+            partners.c.character_id,
+            partners.c.name,
+            partners.c.gender,
+            pairs.c.num_lines.label("number_of_lines_together"),
+        )
+        .select_from(
+            pairs.join(partners, partners.c.character_id == pairs.c.partner_id)
+        )
+        .where((pairs.c.character_id == id) & (pairs.c.num_lines > 0))
+        .subquery("top_conversations")
+    )
+
+    character_stmt = (
         sqlalchemy.select(
             db.characters.c.character_id,
-            db.characters.c.name.label("character"),
+            db.characters.c.name,
+            db.movies.c.title.label("movie"),
             db.characters.c.gender,
-            sqlalchemy.func.count(db.lines.c.line_id).label("number_of_lines_together"),
+            top_conversations.c.character_id.label("partner_id"),
+            top_conversations.c.name.label("partner_name"),
+            top_conversations.c.gender.label("partner_gender"),
+            top_conversations.c.number_of_lines_together,
         )
         .select_from(
-            db.lines.join(db.conversations)
-            .join(db.characters, db.characters.c.character_id == db.conversations.c.character2_id)
+            db.characters.join(db.movies)
+            .outerjoin(top_conversations, sqlalchemy.true())
         )
-        .where(
-            (db.lines.c.character_id == id) &
-            ((db.conversations.c.character1_id == id) | (db.conversations.c.character2_id == id))
+        .where(db.characters.c.character_id == id)
+        .order_by(
+            sqlalchemy.desc(top_conversations.c.number_of_lines_together),
+            top_conversations.c.character_id,
         )
-        .group_by(db.characters.c.character_id)
-        .order_by(sqlalchemy.desc("number_of_lines_together"))
     )
 
-    with db.engine.connect() as conn:
-        top_conversations_result = conn.execute(top_conversations_stmt)
-        top_conversations = []
-        for row in top_conversations_result:
-            top_conversations.append(
+    return character_stmt
+
+
+async def fetch_character_details(character_ids):
+    rows = await db.fetch_all(
+        characters_details_statement(), {"character_ids": character_ids}
+    )
+
+    characters = {}
+    for row in rows:
+        character = characters.get(row.character_id)
+        if character is None:
+            character = characters[row.character_id] = {
+                "character_id": row.character_id,
+                "character": row.name,
+                "movie": row.movie,
+                "gender": row.gender,
+                "top_conversations": [],
+            }
+        if row.partner_id is not None:
+            character["top_conversations"].append(
                 {
-                    "character_id": row.character_id,
-                    "character": row.character,
-                    "gender": row.gender,
+                    "character_id": row.partner_id,
+                    "character": row.partner_name,
+                    "gender": row.partner_gender,
                     "number_of_lines_together": row.number_of_lines_together,
                 }
             )
 
-    character["top_conversations"] = top_conversations
+    return list(characters.values())
 
-    return character
 
+@statements.prebuilt
+def characters_details_statement():
+    # The same statement as character_statement for many characters at once:
+    # the pairs of every character are joined back onto their character.
+    character_ids = sqlalchemy.bindparam("character_ids", expanding=True)
+    partners = db.characters.alias("partners")
+    together = (
+        sqlalchemy.select(
+            db.character_pair_stats.c.character_id,
+            db.character_pair_stats.c.partner_id,
+            db.character_pair_stats.c.num_lines.label("number_of_lines_together"),
+        )
+        .where(
+            db.character_pair_stats.c.character_id.in_(character_ids)
+            & (db.character_pair_stats.c.num_lines > 0)
+        )
+        .subquery("together")
+    )
+
+    characters_stmt = (
+        sqlalchemy.select(
+            db.characters.c.character_id,
+            db.characters.c.name,
+            db.movies.c.title.label("movie"),
+            db.characters.c.gender,
+            partners.c.character_id.label("partner_id"),
+            partners.c.name.label("partner_name"),
+            partners.c.gender.label("partner_gender"),
+            together.c.number_of_lines_together,
+        )
+        .select_from(
+            db.characters.join(db.movies).outerjoin(
+                together.join(
+                    partners, partners.c.character_id == together.c.partner_id
+                ),
+                together.c.character_id == db.characters.c.character_id,
+            )
+        )
+        .where(db.characters.c.character_id.in_(character_ids))
+        .order_by(
+            db.characters.c.character_id,
+            sqlalchemy.desc(together.c.number_of_lines_together),
+            partners.c.character_id,
+        )
+    )
+
+    return characters_stmt
 
 
 class character_sort_options(str, Enum):
@@ -98,11 +269,17 @@ class character_sort_options(str, Enum):
 
 
 @router.get("/characters/", tags=["characters"])
-def list_characters(
+@fast_json.response
+async def list_characters(
+    request: Request,
+    response: Response,
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: character_sort_options = character_sort_options.character,
+    cursor: Optional[str] = None,
+    ids: Optional[str] = None,
+    fields: Optional[str] = None,
 ):
     """
     This endpoint returns a list of characters. For each character it returns:
@@ -124,48 +301,160 @@ def list_characters(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    For walking the whole list, use the `cursor` query parameter instead of
+    `offset`. Pass an empty `cursor` for the first page and the `next_cursor`
+    of each response for the page after it. With `cursor` the response is an
+    object with the list of characters under `results` and `next_cursor`,
+    which is null on the last page. Cursor pages cost the same however deep
+    they are and do not shift while data is added.
+
+    To look up many characters at once, pass their ids as a comma separated
+    list in `ids`, for example `?ids=1,2,3`. The response is then an object
+    that maps each id to the character as returned by
+    `/characters/{character_id}`, including `top_conversations`. Ids of
+    characters that do not exist are left out. The other query parameters
+    are ignored.
+
+    To get only some of the fields of each character, list them in `fields`,
+    for example `?fields=character_id,character`. Only those columns are
+    read, and line counts are not looked up unless asked for or sorted by.
+    With `ids`, the fields are those of `/characters/{character_id}`.
     """
-    sort_column_mapping = {
-        "character": db.characters.c.name,
-        "movie": db.movies.c.title,
-        "number_of_lines": sqlalchemy.func.count(db.lines.c.line_text)
-    }
+    fields = projection.parse_fields(
+        fields, CHARACTER_FIELDS if ids is not None else CHARACTERS_FIELDS
+    )
+    not_modified = await http_cache.conditional(request, response, "corpus")
+    if not_modified:
+        return not_modified
 
+    if ids is not None:
+        if cursor is not None:
+            raise HTTPException(status_code=400, detail="Use either ids or cursor")
+        character_ids = batch.parse_ids(ids)
+        if local.enabled():
+            characters = [local.corpus().character(id) for id in character_ids]
+            characters = [
+                character for character in characters if character is not None
+            ]
+        else:
+            characters = await fetch_character_details(character_ids)
+        characters = batch.keyed(character_ids, characters, "character_id")
+        return {
+            id: projection.project(character, fields)
+            for id, character in characters.items()
+        }
 
-    characters_stmt = (
-        sqlalchemy.select(
-        db.characters.c.character_id,
-        db.characters.c.name.label("character"),
-        db.movies.c.title.label("movie"),
-        sqlalchemy.func.count(db.lines.c.line_text.distinct()).label("number_of_lines"),
+    position = None
+    if cursor is not None:
+        if offset != 0:
+            raise HTTPException(status_code=400, detail="Use either offset or cursor")
+        key_type = int if sort == character_sort_options.number_of_lines else str
+        position = pagination.decode_cursor(cursor, sort.value, key_type)
+        # the next cursor is made of the last character's sort key and id
+        columns = projection.including(fields, sort.value, "character_id")
+    else:
+        columns = fields
+
+    if local.enabled():
+        descending = sort == character_sort_options.number_of_lines
+        characters = local.corpus().characters(
+            name, sort.value, descending, limit, offset, position
         )
-        .select_from(
-            db.characters.join(db.movies)
-            .join(db.lines, db.lines.c.character_id == db.characters.c.character_id, isouter=True)
+    else:
+        characters = await fetch_characters(
+            name, sort, limit, offset, cursor is not None, position, columns
         )
-        .where(db.characters.c.name.ilike(f"%{name}%"))
-        .group_by(db.characters.c.character_id, db.movies.c.title)
+
+    if cursor is not None:
+        page = pagination.page(
+            characters, sort.value, limit, sort.value, "character_id"
+        )
+        page["results"] = projection.project_all(page["results"], fields)
+        return page
+    return projection.project_all(characters, fields)
+
+
+async def fetch_characters(name, sort, limit, offset, keyset, position, columns=None):
+    parameters = {"name": f"%{name}%", "limit": limit}
+    if not keyset:
+        parameters["offset"] = offset
+    if position is not None:
+        parameters.update(pagination.position_parameters(position))
+    characters_stmt = characters_statement(
+        sort, keyset, position is not None, columns or CHARACTERS_FIELDS
     )
 
-    if sort == character_sort_options.number_of_lines:
-        characters_stmt = characters_stmt.order_by(sqlalchemy.desc("number_of_lines"))
-    elif sort == character_sort_options.character:
-        characters_stmt = characters_stmt.order_by(db.characters.c.name)
-    elif sort == character_sort_options.movie:
-        characters_stmt = characters_stmt.order_by(db.movies.c.title)
-    characters_stmt = characters_stmt.limit(limit).offset(offset)
-
-    with db.engine.connect() as conn:
-        character_result = conn.execute(characters_stmt)
-        characters = []
-        for row in character_result:
-            characters.append(
-                {
-                    "character_id": row.character_id,
-                    "character": row.character,
-                    "movie": row.movie,
-                    "number_of_lines": row.number_of_lines,
-                }
+    character_result = await db.fetch_all(characters_stmt, parameters)
+    return [dict(row._mapping) for row in character_result]
+
+
+@statements.prebuilt
+def characters_statement(sort, keyset, after, columns=CHARACTERS_FIELDS):
+    # line counts come from the precomputed statistics table rather than an
+    # aggregate over Lines
+    number_of_lines = sqlalchemy.func.coalesce(
+        db.character_stats.c.num_distinct_lines, 0
+    )
+    selectable = {
+        "character_id": db.characters.c.character_id,
+        "character": db.characters.c.name.label("character"),
+        "movie": db.movies.c.title.label("movie"),
+        "number_of_lines": number_of_lines.label("number_of_lines"),
+    }
+
+    # the join to the movies stays, as it leaves out characters of unknown
+    # movies, but the statistics are only joined when they are needed
+    joined = db.characters.join(db.movies)
+    if "number_of_lines" in columns or sort == character_sort_options.number_of_lines:
+        joined = joined.join(
+            db.character_stats,
+            db.character_stats.c.character_id == db.characters.c.character_id,
+            isouter=True,
+        )
+
+    characters_stmt = (
+        sqlalchemy.select(*[selectable[column] for column in columns])
+        .select_from(joined)
+        .where(db.characters.c.name.ilike(sqlalchemy.bindparam("name")))
+    )
+
+    limit = sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer)
+    offset = sqlalchemy.bindparam("offset", type_=sqlalchemy.Integer)
+    if not keyset:
+        if sort == character_sort_options.number_of_lines:
+            characters_stmt = characters_stmt.order_by(
+                sqlalchemy.desc(
+                    "number_of_lines"
+                    if "number_of_lines" in columns
+                    else number_of_lines
+                )
+            )
+        elif sort == character_sort_options.character:
+            characters_stmt = characters_stmt.order_by(db.characters.c.name)
+        elif sort == character_sort_options.movie:
+            characters_stmt = characters_stmt.order_by(db.movies.c.title)
+        characters_stmt = characters_stmt.limit(limit).offset(offset)
+    else:
+        # cursor pages need a total order, so ties are broken by character id
+        if sort == character_sort_options.number_of_lines:
+            sort_column, descending = number_of_lines, True
+        elif sort == character_sort_options.character:
+            sort_column, descending = db.characters.c.name, False
+        elif sort == character_sort_options.movie:
+            sort_column, descending = db.movies.c.title, False
+        if after:
+            characters_stmt = characters_stmt.where(
+                pagination.after(
+                    sort_column,
+                    descending,
+                    db.characters.c.character_id,
+                    pagination.POSITION,
+                )
             )
+        characters_stmt = characters_stmt.order_by(
+            sqlalchemy.desc(sort_column) if descending else sort_column,
+            db.characters.c.character_id,
+        ).limit(limit)
 
-    return characters
+    return characters_stmt
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException
-from src import database as db
+from fastapi import APIRouter, Header, HTTPException, Request, Response
+from src import cache, graph, idempotency, ingest, local, stats, database as db
 from pydantic import BaseModel
-from typing import List
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
 import sqlalchemy
 
 
@@ -21,8 +22,232 @@ class ConversationJson(BaseModel):
 router = APIRouter()
 
 
+async def validate_conversations(movie_id: int, conversations: List[ConversationJson]):
+    """
+    Checks every conversation before anything is written so that a bad
+    conversation never leaves a partially inserted batch behind.
+    """
+    if local.enabled():
+        raise HTTPException(status_code=501, detail="The local backend is read-only")
+
+    character_ids = set()
+    for conversation in conversations:
+        conversation_character_ids = {
+            conversation.character_1_id,
+            conversation.character_2_id,
+        }
+        if len(conversation_character_ids) != 2:
+            raise HTTPException(status_code=400, detail="Characters must be different")
+        for line in conversation.lines:
+            if line.character_id not in conversation_character_ids:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Line does not match conversation characters",
+                )
+        character_ids |= conversation_character_ids
+
+    characters_stmt = (
+        sqlalchemy.select(db.characters.c.character_id)
+        .where((db.characters.c.character_id.in_(character_ids)) & (db.characters.c.movie_id == movie_id))
+    )
+
+    characters_result = await db.fetch_all(characters_stmt)
+    fetched_character_ids = {row.character_id for row in characters_result}
+
+    if fetched_character_ids != character_ids:
+        raise HTTPException(status_code=400, detail="Invalid characters for movie")
+
+
+def insert_conversations(conn, movie_id: int, conversations: List[ConversationJson]):
+    """
+    Writes the conversations and all of their lines with one multi-row insert
+    per table. Conversation ids are reserved from the sequence up front so the
+    lines can reference them; line ids come from the column default.
+
+    Returns the new conversation ids in the order the conversations were given.
+    """
+    conversation_ids_stmt = (
+        sqlalchemy.select(db.conversation_id_seq.next_value())
+        .select_from(sqlalchemy.func.generate_series(1, len(conversations)))
+    )
+    conversation_ids = conn.execute(conversation_ids_stmt).scalars().all()
+
+    conversation_rows = []
+    line_rows = []
+    for conversation_id, conversation in zip(conversation_ids, conversations):
+        conversation_rows.append(
+            {
+                "conversation_id": conversation_id,
+                "movie_id": movie_id,
+                "character1_id": conversation.character_1_id,
+                "character2_id": conversation.character_2_id,
+            }
+        )
+        for idx, line in enumerate(conversation.lines, start=1):
+            line_rows.append(
+                {
+                    "character_id": line.character_id,
+                    "movie_id": movie_id,
+                    "conversation_id": conversation_id,
+                    "line_sort": idx,
+                    "line_text": line.line_text,
+                }
+            )
+
+    conn.execute(sqlalchemy.insert(db.conversations), conversation_rows)
+    stats.record_conversations(conn, movie_id, conversations)
+    if line_rows:
+        conn.execute(sqlalchemy.insert(db.lines), line_rows)
+
+    return conversation_ids
+
+
+async def write(request: Request, response: Response, idempotency_key, body, fn, *args):
+    """
+    Runs `fn(conn, *args)`, which returns the response body, in a write
+    transaction that is retried on deadlocks. With an idempotency key, a
+    retried request replays the first response instead.
+    Returns the response body and whether it was replayed.
+    """
+    if idempotency_key is None:
+        return await db.write_transaction(fn, *args), False
+
+    fingerprint = idempotency.request_hash(request.method, request.url.path, body)
+    result, replayed = await db.write_transaction(
+        idempotency.run, idempotency_key, fingerprint, fn, *args
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    await idempotency.purger.maybe_purge()
+    return result, replayed
+
+
+async def enqueue(
+    request: Request,
+    response: Response,
+    idempotency_key,
+    body,
+    movie_id: int,
+    conversations: List[ConversationJson],
+):
+    """
+    Queues the conversations for the ingestion workers and returns the body
+    of the 202 response, which points at the job's status.
+    """
+    fingerprint = None
+    if idempotency_key is not None:
+        fingerprint = idempotency.request_hash(request.method, request.url.path, body)
+    job_id = await run_in_threadpool(
+        ingest.queue.enqueue,
+        movie_id,
+        [conversation.dict() for conversation in conversations],
+        idempotency_key,
+        fingerprint,
+    )
+    ingestion.notify()
+
+    response.status_code = 202
+    response.headers["Location"] = f"/conversations/jobs/{job_id}"
+    response.headers["Preference-Applied"] = "respond-async"
+    return {"job_id": job_id, "status_url": f"/conversations/jobs/{job_id}"}
+
+
+def recorded(movie_id: int, conversations: List[ConversationJson]):
+    """Brings the caches and the graph up to date after a write commits."""
+    cache.invalidate_conversation(
+        movie_id,
+        {
+            character_id
+            for conversation in conversations
+            for character_id in (
+                conversation.character_1_id,
+                conversation.character_2_id,
+            )
+        },
+    )
+    graph.store.record_conversations(conversations)
+
+
+def conversation_ids(result):
+    """The new conversation ids in the response of either write endpoint."""
+    if "conversation_ids" in result:
+        return result["conversation_ids"]
+    return [result["conversation_id"]]
+
+
+def write_jobs(conn, jobs):
+    # each job is written under the idempotency key of its request, or one of
+    # its own, so a job that is claimed again after a crash, or whose request
+    # was also sent without Prefer, replays its ids instead of writing twice
+    results = {}
+    replayed = set()
+    for job in jobs:
+        result, job_replayed = idempotency.run(
+            conn,
+            job.idempotency_key or f"ingest:{job.job_id}",
+            job.request_hash or job.job_id,
+            write_conversations,
+            job.movie_id,
+            job.conversations,
+        )
+        results[job.job_id] = conversation_ids(result)
+        if job_replayed:
+            replayed.add(job.job_id)
+    return results, replayed
+
+
+async def ingest_jobs(jobs):
+    """Writes a batch of queued jobs in a single transaction."""
+    jobs = [
+        job._replace(
+            conversations=[
+                ConversationJson.parse_obj(conversation)
+                for conversation in job.conversations
+            ]
+        )
+        for job in jobs
+    ]
+    results, replayed = await db.write_transaction(write_jobs, jobs)
+    for job in jobs:
+        # a replayed job's conversations were recorded when they were written
+        if job.job_id not in replayed:
+            recorded(job.movie_id, job.conversations)
+    await idempotency.purger.maybe_purge()
+    return results
+
+
+ingestion = ingest.WorkerPool(ingest.queue, ingest_jobs)
+
+
+@router.on_event("startup")
+async def start_ingestion():
+    if ingest.enabled():
+        ingestion.start()
+
+
+@router.on_event("shutdown")
+async def stop_ingestion():
+    await ingestion.stop()
+
+
+def write_conversation(conn, movie_id: int, conversation: ConversationJson):
+    (conversation_id,) = insert_conversations(conn, movie_id, [conversation])
+    return {"conversation_id": conversation_id}
+
+
+def write_conversations(conn, movie_id: int, conversations: List[ConversationJson]):
+    return {"conversation_ids": insert_conversations(conn, movie_id, conversations)}
+
+
 @router.post("/movies/{movie_id}/conversations/", tags=["movies"])
-def add_conversation(movie_id: int, conversation: ConversationJson):
+async def add_conversation(
+    movie_id: int,
+    conversation: ConversationJson,
+    request: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    prefer: Optional[str] = Header(None),
+):
     """
     This endpoint adds a conversation to a movie. The conversation is represented
     by the two characters involved in the conversation and a series of lines between
@@ -36,61 +261,108 @@ def add_conversation(movie_id: int, conversation: ConversationJson):
     request body.
 
     The endpoint returns the id of the resulting conversation that was created.
+
+    To retry safely, send a unique `Idempotency-Key` header and the same key
+    with every retry of the request. Once one of them has succeeded, the
+    others return its response, with an `Idempotent-Replayed: true` header,
+    instead of adding the conversation again. Reusing a key for a different
+    request returns 422.
+
+    To add the conversation in the background, send a `Prefer: respond-async`
+    header. When the server runs ingestion workers, the conversation is then
+    validated and queued, and the endpoint returns 202 with a `job_id`
+    instead. `/conversations/jobs/{job_id}` reports the job's progress and,
+    once it is written, the conversation id. Servers without workers ignore
+    the header and add the conversation before responding.
     """
-    character_ids = {conversation.character_1_id, conversation.character_2_id}
-    if len(character_ids) != 2:
-        raise HTTPException(status_code=400, detail="Characters must be different")
+    idempotency.validate_key(idempotency_key)
+    await validate_conversations(movie_id, [conversation])
 
-    characters_stmt = (
-        sqlalchemy.select(db.characters.c.character_id)
-        .where((db.characters.c.character_id.in_(character_ids)) & (db.characters.c.movie_id == movie_id))
+    if ingest.enabled() and ingest.respond_async(prefer):
+        return await enqueue(
+            request,
+            response,
+            idempotency_key,
+            conversation.dict(),
+            movie_id,
+            [conversation],
+        )
+
+    result, replayed = await write(
+        request, response, idempotency_key, conversation.dict(),
+        write_conversation, movie_id, conversation,
     )
 
-    with db.engine.connect() as conn:
-        characters_result = conn.execute(characters_stmt)
-        fetched_character_ids = {row.character_id for row in characters_result}
+    if replayed:
+        # the request may have been queued first, and stored a batch response
+        return {"conversation_id": conversation_ids(result)[0]}
+    recorded(movie_id, [conversation])
 
-    if fetched_character_ids != character_ids:
-        raise HTTPException(status_code=400, detail="Invalid characters for movie")
+    return result
 
-    next_conversation_id_stmt = (
-        sqlalchemy.select(sqlalchemy.func.max(db.conversations.c.conversation_id) + 1)
-    )
 
-    new_conversation_stmt = (
-    sqlalchemy.insert(db.conversations)
-    .values(
-        conversation_id=next_conversation_id_stmt.scalar_subquery(),
-        movie_id=movie_id,
-        character1_id=conversation.character_1_id,
-        character2_id=conversation.character_2_id,
-    )
-    .returning(db.conversations.c.conversation_id)
-    )
+@router.post("/movies/{movie_id}/conversations/batch/", tags=["movies"])
+async def add_conversations(
+    movie_id: int,
+    conversations: List[ConversationJson],
+    request: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    prefer: Optional[str] = Header(None),
+):
+    """
+    This endpoint adds many conversations to a movie in a single request. Each
+    conversation is validated the same way as in
+    `/movies/{movie_id}/conversations/`, and either every conversation is
+    added or none are. It accepts the `Idempotency-Key` and
+    `Prefer: respond-async` headers the same way; a queued batch is a single
+    job.
 
-    with db.engine.begin() as conn:
-        new_conversation_result = conn.execute(new_conversation_stmt)
-        new_conversation_id = new_conversation_result.fetchone().conversation_id
+    The endpoint returns the ids of the created conversations, in the same
+    order as the conversations in the request body.
+    """
+    if len(conversations) == 0:
+        return {"conversation_ids": []}
 
-        for idx, line in enumerate(conversation.lines, start=1):
-            if line.character_id not in character_ids:
-                raise HTTPException(status_code=400, detail="Line does not match conversation characters")
+    idempotency.validate_key(idempotency_key)
+    await validate_conversations(movie_id, conversations)
 
-            new_line_id_stmt = (
-                sqlalchemy.select(sqlalchemy.func.max(db.lines.c.line_id) + 1)
-            )
+    body = [conversation.dict() for conversation in conversations]
+    if ingest.enabled() and ingest.respond_async(prefer):
+        return await enqueue(
+            request, response, idempotency_key, body, movie_id, conversations
+        )
 
-            new_line_stmt = (
-                sqlalchemy.insert(db.lines)
-                .values(
-                    line_id=new_line_id_stmt.scalar_subquery(),
-                    character_id=line.character_id,
-                    movie_id=movie_id,
-                    conversation_id=new_conversation_id,
-                    line_sort=idx,
-                    line_text=line.line_text)
-            )
+    result, replayed = await write(
+        request, response, idempotency_key, body,
+        write_conversations, movie_id, conversations,
+    )
+
+    if not replayed:
+        recorded(movie_id, conversations)
 
-            conn.execute(new_line_stmt)
+    return result
 
-    return {"conversation_id": new_conversation_id}
+
+@router.get("/conversations/jobs/{job_id}", tags=["movies"])
+async def get_job(job_id: str):
+    """
+    This endpoint returns the progress of conversations queued with
+    `Prefer: respond-async`. It returns:
+    * `job_id`: the id returned when the conversations were queued.
+    * `movie_id`: The movie the conversations are added to.
+    * `status`: `queued`, `running`, `done` or `failed`.
+    * `number_of_conversations`: The number of conversations in the job.
+    * `attempts`: The number of times writing the job has been tried.
+    * `submitted_at`, `updated_at`: When the job was queued and last changed.
+    * `jobs_ahead`: While queued, the number of jobs that are written first.
+    * `conversation_ids`: Once done, the ids of the new conversations in the
+      order they were sent.
+    * `error`: The last error writing the job, if any.
+
+    Finished jobs are forgotten after a day.
+    """
+    status = await run_in_threadpool(ingest.queue.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
@@ -0,0 +1,128 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.params import Query
+from src import fast_json, graph
+
+router = APIRouter()
+
+# Network queries over the character co-occurrence graph in src/graph.py.
+# They are answered from memory; only the first request after startup reads
+# the database.
+
+
+def require_character(character_graph, character_id):
+    if character_id not in character_graph.names:
+        raise HTTPException(status_code=404, detail="Character not found")
+
+
+@router.get("/graph/characters/{character_id}/partners", tags=["graph"])
+@fast_json.response
+async def get_partners(character_id: int, k: int = Query(10, ge=1, le=100)):
+    """
+    This endpoint returns the characters a character speaks with the most.
+    It returns:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `partners`: Up to `k` characters, ordered by the number of lines spoken
+      in conversations between the two.
+
+    Each partner is represented by a dictionary with the following keys:
+    * `character_id`: the internal id of the partner.
+    * `character`: The name of the partner.
+    * `number_of_lines_together`: The number of lines either of the two
+      speaks in their conversations.
+    * `number_of_conversations`: The number of conversations between the two.
+
+    Unlike `top_conversations` in `/characters/{character_id}`, both sides of
+    every conversation count, whichever character started it.
+    """
+    character_graph = await graph.store.get()
+    require_character(character_graph, character_id)
+
+    return {
+        "character_id": character_id,
+        "character": character_graph.names[character_id],
+        "partners": [
+            {
+                "character_id": partner_id,
+                "character": character_graph.names.get(partner_id),
+                "number_of_lines_together": lines_together,
+                "number_of_conversations": conversations,
+            }
+            for partner_id, lines_together, conversations in character_graph.partners(
+                character_id, k
+            )
+        ],
+    }
+
+
+@router.get("/graph/characters/{character_id}/neighborhood", tags=["graph"])
+@fast_json.response
+async def get_neighborhood(
+    character_id: int,
+    hops: int = Query(2, ge=1, le=4),
+    limit: int = Query(250, ge=1, le=5000),
+):
+    """
+    This endpoint returns every character within `hops` conversations of a
+    character: its partners, their partners, and so on. It returns:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `neighbors`: Up to `limit` characters, closest first.
+
+    Each neighbor is represented by a dictionary with the following keys:
+    * `character_id`: the internal id of the neighbor.
+    * `character`: The name of the neighbor.
+    * `distance`: The number of conversations between the two, 1 for partners.
+    """
+    character_graph = await graph.store.get()
+    require_character(character_graph, character_id)
+
+    return {
+        "character_id": character_id,
+        "character": character_graph.names[character_id],
+        "neighbors": [
+            {
+                "character_id": neighbor_id,
+                "character": character_graph.names.get(neighbor_id),
+                "distance": distance,
+            }
+            for neighbor_id, distance in character_graph.neighborhood(
+                character_id, hops, limit
+            )
+        ],
+    }
+
+
+@router.get("/graph/path/", tags=["graph"])
+@fast_json.response
+async def get_path(source: int, target: int):
+    """
+    This endpoint returns the shortest dialogue path between two characters:
+    the fewest conversations connecting them, where each step is a
+    conversation between consecutive characters. It returns:
+    * `path`: The characters on the path from `source` to `target`, both
+      included, each with its `character_id` and `character` name.
+    * `length`: The number of conversations on the path.
+
+    Returns 404 when the characters are not connected.
+    """
+    character_graph = await graph.store.get()
+    require_character(character_graph, source)
+    require_character(character_graph, target)
+
+    path = character_graph.path(source, target)
+    if path is None:
+        raise HTTPException(
+            status_code=404, detail="No dialogue path between the characters"
+        )
+
+    return {
+        "path": [
+            {
+                "character_id": character_id,
+                "character": character_graph.names.get(character_id),
+            }
+            for character_id in path
+        ],
+        "length": len(path) - 1,
+    }
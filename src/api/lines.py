@@ -1,90 +1,370 @@
-from fastapi import APIRouter, HTTPException
-from src import database as db
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.params import Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from src import database as db, fast_json, http_cache, local, pagination, statements
+import json
 import sqlalchemy
 router = APIRouter()
 
+# Each endpoint below, apart from the streaming one, fetches the character
+# name and its payload in a single statement by outer joining the payload onto
+# the character row. No rows means the character does not exist; a single row
+# with a null payload column means the character exists but has nothing to
+# return.
+#
+# Lines are ranked by word count, then by length in characters, then by id,
+# which is the order of the lines_character_word_count_idx index, so a page of
+# lines is read straight from the index without sorting.
+
+ranking = (db.lines.c.word_count, db.lines.c.line_length, db.lines.c.line_id)
+
+
+def longest_first(stmt, lines=db.lines):
+    """Orders `stmt` by the ranking columns of `lines`, a table or subquery."""
+    return stmt.order_by(
+        sqlalchemy.desc(lines.c.word_count),
+        sqlalchemy.desc(lines.c.line_length),
+        lines.c.line_id,
+    )
+
+
+@statements.prebuilt
+def lines_statement():
+    # the page is a subquery so that a page past the end still yields the
+    # character row rather than looking like a missing character
+    character_id = sqlalchemy.bindparam("character_id")
+    character_lines = longest_first(
+        sqlalchemy.select(db.lines.c.line_text, *ranking)
+        .where(db.lines.c.character_id == character_id)
+    ).limit(
+        sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer)
+    ).offset(
+        sqlalchemy.bindparam("offset", type_=sqlalchemy.Integer)
+    ).subquery("character_lines")
+
+    return longest_first(
+        sqlalchemy.select(db.characters.c.name, character_lines.c.line_text)
+        .select_from(db.characters.outerjoin(character_lines, sqlalchemy.true()))
+        .where(db.characters.c.character_id == character_id),
+        character_lines,
+    )
+
+
+@statements.prebuilt
+def name_statement():
+    return (
+        sqlalchemy.select(db.characters.c.name)
+        .where(db.characters.c.character_id == sqlalchemy.bindparam("character_id"))
+    )
+
+
+@statements.prebuilt
+def stream_statement():
+    return longest_first(
+        sqlalchemy.select(db.lines.c.line_text)
+        .where(db.lines.c.character_id == sqlalchemy.bindparam("character_id"))
+    ).limit(
+        sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer)
+    ).offset(
+        sqlalchemy.bindparam("offset", type_=sqlalchemy.Integer)
+    )
+
+
+@statements.prebuilt
+def conversations_statement(after, preview):
+    # A character is on either side of a conversation. Rather than one lookup
+    # with an OR over both columns, which no index serves, the page is the
+    # union of a lookup per column, each read in order from its index (see
+    # migrations/006_conversation_lookups.sql). Conversations of a character
+    # with itself are only taken from the first.
+    character_id = sqlalchemy.bindparam("character_id")
+    limit = sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer)
+    conversations = db.conversations.c
+
+    def lookup(column, partner_column, *where):
+        stmt = (
+            sqlalchemy.select(
+                conversations.conversation_id, partner_column.label("partner_id")
+            )
+            .where(column == character_id, *where)
+            .order_by(conversations.conversation_id)
+            .limit(limit)
+        )
+        if after:
+            stmt = stmt.where(
+                conversations.conversation_id > sqlalchemy.bindparam("after_id")
+            )
+        return stmt.subquery()
+
+    first = lookup(conversations.character1_id, conversations.character2_id)
+    second = lookup(
+        conversations.character2_id,
+        conversations.character1_id,
+        conversations.character1_id != character_id,
+    )
+    page = (
+        sqlalchemy.union_all(sqlalchemy.select(first), sqlalchemy.select(second))
+        .order_by("conversation_id")
+        .limit(limit)
+        .subquery("page")
+    )
+
+    columns = [db.characters.c.name, page.c.conversation_id]
+    joined = db.characters.outerjoin(page, sqlalchemy.true())
+    order_by = [page.c.conversation_id]
+    if preview:
+        # each conversation's partner and first lines, the lines read from
+        # the conversation's index entries in order and stopping at the
+        # `preview` limit
+        partners = db.characters.alias("partners")
+        preview_lines = (
+            sqlalchemy.select(
+                db.lines.c.character_id,
+                db.lines.c.line_text,
+                db.lines.c.line_sort,
+                db.lines.c.line_id,
+            )
+            .where(db.lines.c.conversation_id == page.c.conversation_id)
+            .order_by(db.lines.c.line_sort, db.lines.c.line_id)
+            .limit(sqlalchemy.bindparam("preview", type_=sqlalchemy.Integer))
+            .lateral("preview_lines")
+        )
+        columns += [
+            partners.c.character_id.label("partner_id"),
+            partners.c.name.label("partner_name"),
+            partners.c.gender.label("partner_gender"),
+            preview_lines.c.character_id.label("line_character_id"),
+            preview_lines.c.line_text,
+        ]
+        joined = joined.outerjoin(
+            partners, partners.c.character_id == page.c.partner_id
+        ).outerjoin(preview_lines, sqlalchemy.true())
+        order_by += [preview_lines.c.line_sort, preview_lines.c.line_id]
+
+    return (
+        sqlalchemy.select(*columns)
+        .select_from(joined)
+        .where(db.characters.c.character_id == character_id)
+        .order_by(*order_by)
+    )
+
+
 @router.get("/lines/{character_id}", tags=["lines"]) #tags are used to group endpoints
-def get_lines(character_id: int):
+@fast_json.response
+async def get_lines(character_id: int,
+                    request: Request,
+                    response: Response,
+                    limit: Optional[int] = Query(None, ge=0),
+                    offset: int = Query(0, ge=0)):
     """
     This endpoint returns a character and all the lines spoken by that
-    character. 
+    character.
     For each character it returns:
     * `character`: The name of the character.
-    * `lines`: A list of lines spoken by the character. 
+    * `lines`: A list of lines spoken by the character.
     The lines are ordered largest to smallest by the number of words in the line.
-    
+
+    The optional `limit` and `offset` query parameters page through the lines
+    the same way as in `/lines/longest/{char_id}`. For characters with many
+    lines, `/lines/{character_id}/stream` returns the same document streamed.
+
+    Like every `/lines` endpoint, responses carry an `ETag` and
+    `Last-Modified` that change whenever a conversation involving the
+    character is added, and conditional requests get an empty 304 while the
+    client's copy is current.
     """
+    not_modified = await http_cache.conditional(
+        request, response, "character", character_id
+    )
+    if not_modified:
+        return not_modified
 
-    character_stmt = (
-        sqlalchemy.select(db.characters.c.name)
-        .where(db.characters.c.character_id == character_id)
-        .limit(1)
+    if local.enabled():
+        return local_lines(character_id, limit, offset)
+
+    rows = await db.fetch_all(
+        lines_statement(),
+        {"character_id": character_id, "limit": limit, "offset": offset},
     )
 
-    with db.engine.connect() as conn:
-        character_result = conn.execute(character_stmt)
-        character_row = character_result.fetchone()
-        if character_row is None:
-            raise HTTPException(status_code=404, detail="Character not found")
-        character_name = character_row.name
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Character not found")
+    lines = [row.line_text for row in rows if row.line_text is not None]
 
-    lines_stmt = (
-        sqlalchemy.select(db.lines.c.line_text)
-        .where(db.lines.c.character_id == character_id)
-        .order_by(sqlalchemy.desc(sqlalchemy.func.length(db.lines.c.line_text)))
+    return {"character": rows[0].name, "lines": lines}
+
+
+@router.get("/lines/{character_id}/stream", tags=["lines"])
+@fast_json.response
+async def stream_lines(character_id: int,
+                       request: Request,
+                       response: Response,
+                       limit: Optional[int] = Query(None, ge=0),
+                       offset: int = Query(0, ge=0)):
+    """
+    This endpoint returns the same document as `/lines/{character_id}`, but
+    writes the lines out as they are read from the database instead of
+    building the whole response first. Use it to export every line of
+    characters with large scripts.
+    """
+    not_modified = await http_cache.conditional(
+        request, response, "character", character_id
+    )
+    if not_modified:
+        return not_modified
+
+    if local.enabled():
+        return local_lines(character_id, limit, offset)
+
+    rows = await db.fetch_all(name_statement(), {"character_id": character_id})
+
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Character not found")
+    character_name = rows[0].name
+
+    parameters = {"character_id": character_id, "limit": limit, "offset": offset}
+
+    async def document():
+        yield '{"character":' + dumps(character_name) + ',"lines":['
+        separator = ""
+        async for batch in db.stream(stream_statement(), parameters):
+            yield separator + ",".join(dumps(row.line_text) for row in batch)
+            separator = ","
+        yield "]}"
+
+    return StreamingResponse(
+        document(), media_type="application/json", headers=response.headers
     )
 
-    with db.engine.connect() as conn:
-        lines_result = conn.execute(lines_stmt)
-        lines = [row.line_text for row in lines_result]
 
-    return {"character": character_name, "lines": lines}
+def local_lines(character_id, limit, offset):
+    lines = local.corpus().character_lines(character_id, limit, offset)
+    if lines is None:
+        raise HTTPException(status_code=404, detail="Character not found")
+    return lines
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False)
 
 
 @router.get("/lines/{char_id}/conversations", tags=["lines"])
-def get_conversations(char_id: int):
+@fast_json.response
+async def get_conversations(char_id: int,
+                            request: Request,
+                            response: Response,
+                            limit: Optional[int] = Query(None, ge=1, le=250),
+                            cursor: Optional[str] = None,
+                            preview: Optional[int] = Query(None, ge=0, le=20)):
     """
     This endpoint returns a character's name and all the conversations the character
     is in. For each character it returns:
     * `character`: The name of the character.
-    * `conversations`: A list of conversation_ID's representing the 
-    conversations the character is in.
+    * `conversations`: A list of conversation_ID's representing the
+    conversations the character is in, in order of id.
+
+    To page through the conversations, pass an empty `cursor` for the first
+    page and the `next_cursor` of each response for the page after it. Pages
+    hold `limit` conversations, or 50 if no `limit` is given. `next_cursor`
+    is null on the last page. `limit` on its own returns just the first
+    conversations.
+
+    With `preview`, each conversation is a dictionary instead of an id, so a
+    timeline of the character's dialogue takes a single request:
+    * `conversation_id`: the internal id of the conversation.
+    * `partner`: the other character in the conversation, with its
+      `character_id`, `character` name and `gender`.
+    * `lines`: the first `preview` lines of the conversation, in the order they
+      were spoken, each with the `character_id` of its speaker and its
+      `line_text`.
     """
-    character_stmt = (
-        sqlalchemy.select(db.characters.c.name)
-        .where(db.characters.c.character_id == char_id)
-        .limit(1)
-    )
+    not_modified = await http_cache.conditional(request, response, "character", char_id)
+    if not_modified:
+        return not_modified
+
+    after = None
+    if cursor is not None:
+        if limit is None:
+            limit = 50
+        position = pagination.decode_cursor(cursor, "conversation_id", int)
+        if position is not None:
+            after = position[1]
 
-    with db.engine.connect() as conn:
-        character_result = conn.execute(character_stmt)
-        character_row = character_result.fetchone()
-        if character_row is None:
+    if local.enabled():
+        conversations = local.corpus().character_conversations(
+            char_id, limit, after, preview
+        )
+        if conversations is None:
             raise HTTPException(status_code=404, detail="Character not found")
-        character_name = character_row.name
+    else:
+        conversations = await fetch_conversations(char_id, limit, after, preview)
 
-    conversations_stmt = (
-        sqlalchemy.select(db.conversations.c.conversation_id)
-        .where((db.conversations.c.character1_id == char_id) | (db.conversations.c.character2_id == char_id))
+    if cursor is not None:
+        next_cursor = None
+        if len(conversations["conversations"]) == limit:
+            last = conversations["conversations"][-1]
+            last_id = last if preview is None else last["conversation_id"]
+            next_cursor = pagination.encode_cursor("conversation_id", last_id, last_id)
+        conversations["next_cursor"] = next_cursor
+    return conversations
+
+
+async def fetch_conversations(char_id, limit, after, preview):
+    parameters = {"character_id": char_id, "limit": limit}
+    if after is not None:
+        parameters["after_id"] = after
+    if preview is not None:
+        parameters["preview"] = preview
+    rows = await db.fetch_all(
+        conversations_statement(after is not None, preview is not None), parameters
     )
 
-    with db.engine.connect() as conn:
-        conversations_result = conn.execute(conversations_stmt)
-        conversations = [row.conversation_id for row in conversations_result]
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Character not found")
+    if preview is None:
+        conversations = [
+            row.conversation_id for row in rows if row.conversation_id is not None
+        ]
+        return {"character": rows[0].name, "conversations": conversations}
+
+    # one row per previewed line, or a single row for a conversation without
+    # any to show
+    by_id = {}
+    for row in rows:
+        if row.conversation_id is None:
+            continue
+        conversation = by_id.get(row.conversation_id)
+        if conversation is None:
+            conversation = by_id[row.conversation_id] = {
+                "conversation_id": row.conversation_id,
+                "partner": {
+                    "character_id": row.partner_id,
+                    "character": row.partner_name,
+                    "gender": row.partner_gender,
+                },
+                "lines": [],
+            }
+        if row.line_text is not None:
+            conversation["lines"].append(
+                {"character_id": row.line_character_id, "line_text": row.line_text}
+            )
+    return {"character": rows[0].name, "conversations": list(by_id.values())}
 
-    return {"character": character_name, "conversations": conversations}
-    
 
 @router.get("/lines/longest/{char_id}", tags=["lines"])
-def get_longest_lines(char_id: int, 
-                      limit: int = 10, 
+@fast_json.response
+async def get_longest_lines(char_id: int,
+                      request: Request,
+                      response: Response,
+                      limit: int = 10,
                       offset: int = 0):
     """
     This endpoint returns a character and the longest lines spoken by that
-    character. 
+    character.
     For each character it returns:
     * `character`: The name of the character.
-    * `lines`: A list of the longest lines spoken by the character. 
+    * `lines`: A list of the longest lines spoken by the character.
     The lines are ordered by the number of words in the line largest to smallest.
 
     The `limit` and `offset` query
@@ -92,29 +372,19 @@ def get_longest_lines(char_id: int,
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.`
     """
-    character_stmt = (
-        sqlalchemy.select(db.characters.c.name)
-        .where(db.characters.c.character_id == char_id)
-        .limit(1)
-    )
+    not_modified = await http_cache.conditional(request, response, "character", char_id)
+    if not_modified:
+        return not_modified
 
-    with db.engine.connect() as conn:
-        character_result = conn.execute(character_stmt)
-        character_row = character_result.fetchone()
-        if character_row is None:
-            raise HTTPException(status_code=404, detail="Character not found")
-        character_name = character_row.name
+    if local.enabled():
+        return local_lines(char_id, limit, offset)
 
-    lines_stmt = (
-        sqlalchemy.select(db.lines.c.line_text)
-        .where(db.lines.c.character_id == char_id)
-        .order_by(sqlalchemy.desc(sqlalchemy.func.length(db.lines.c.line_text)))
-        .limit(limit)
-        .offset(offset)
+    rows = await db.fetch_all(
+        lines_statement(), {"character_id": char_id, "limit": limit, "offset": offset}
     )
 
-    with db.engine.connect() as conn:
-        lines_result = conn.execute(lines_stmt)
-        lines = [row.line_text for row in lines_result]
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Character not found")
+    lines = [row.line_text for row in rows if row.line_text is not None]
 
-    return {"character": character_name, "lines": lines}
+    return {"character": rows[0].name, "lines": lines}
@@ -1,15 +1,43 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from enum import Enum
+from typing import Optional
 
 import sqlalchemy 
-from src import database as db
+from src import (
+    batch,
+    cache,
+    fast_json,
+    http_cache,
+    local,
+    pagination,
+    projection,
+    statements,
+    database as db,
+)
 from fastapi.params import Query
 
 router = APIRouter()
 
+MOVIE_FIELDS = ("movie_id", "title", "top_characters")
+MOVIE_COLUMNS = {
+    "movie_id": db.movies.c.movie_id,
+    "title": db.movies.c.title,
+}
+MOVIES_COLUMNS = {
+    "movie_id": db.movies.c.movie_id,
+    "movie_title": db.movies.c.title,
+    "year": db.movies.c.year,
+    "imdb_rating": db.movies.c.imdb_rating,
+    "imdb_votes": db.movies.c.imdb_votes,
+}
+MOVIES_FIELDS = tuple(MOVIES_COLUMNS)
+
 
 @router.get("/movies/{movie_id}", tags=["movies"])
-def get_movie(movie_id: int):
+@fast_json.response
+async def get_movie(
+    movie_id: int, request: Request, response: Response, fields: Optional[str] = None
+):
     """
     This endpoint returns a single movie by its identifier. For each movie it returns:
     * `movie_id`: the internal id of the movie.
@@ -23,45 +51,139 @@ def get_movie(movie_id: int):
     * `character`: The name of the character.
     * `num_lines`: The number of lines the character has in the movie.
 
+    To get only some of these, list them in `fields`, for example
+    `?fields=movie_id,title`. Leaving out `top_characters` makes the lookup
+    much cheaper.
+
+    Responses carry an `ETag` and `Last-Modified` that change whenever a
+    conversation is added to the movie. Send them back in `If-None-Match` or
+    `If-Modified-Since` to get an empty 304 while your copy is current.
     """
+    fields = projection.parse_fields(fields, MOVIE_FIELDS)
+    not_modified, version = await http_cache.conditional_version(
+        request, response, "movie", movie_id
+    )
+    if not_modified:
+        return not_modified
 
-    # get movie information
-    movie_stmt = (
-        sqlalchemy.select(db.movies.c.movie_id, db.movies.c.title)
-        .where(db.movies.c.movie_id == movie_id)
-        .limit(1)
+    if fields is not None and "top_characters" not in fields:
+        return await movie_summary(movie_id, fields)
+    movie = await cache.movie_cache.get_or_load(
+        movie_id, lambda: movie_details(movie_id), version
     )
+    return projection.project(movie, fields)
+
+
+async def movie_summary(movie_id: int, fields):
+    # a movie without its characters is a single row, read directly rather
+    # than through the cache of whole movies
+    if local.enabled():
+        movie = local.corpus().movie(movie_id)
+    else:
+        rows = await db.fetch_all(
+            movie_summary_statement(fields), {"movie_id": movie_id}
+        )
+        movie = dict(rows[0]._mapping) if rows else None
+    if movie is None:
+        raise HTTPException(status_code=404, detail="Movie not found")
+    return projection.project(movie, fields)
+
+
+@statements.prebuilt
+def movie_summary_statement(fields):
+    return sqlalchemy.select(
+        *[MOVIE_COLUMNS[field].label(field) for field in fields]
+    ).where(db.movies.c.movie_id == sqlalchemy.bindparam("movie_id"))
+
 
-    with db.engine.connect() as conn:
-        movie_result = conn.execute(movie_stmt)
-        movie_row = movie_result.fetchone()
-        if movie_row is None:
+async def movie_details(movie_id: int):
+    if local.enabled():
+        movie = local.corpus().movie(movie_id)
+        if movie is None:
             raise HTTPException(status_code=404, detail="Movie not found")
-        movie = {
-            "movie_id": movie_row.movie_id,
-            "title": movie_row.title,
-        }
+        return movie
+
+    rows = await db.fetch_all(movie_statement(), {"movie_id": movie_id})
+
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Movie not found")
+
+    characters = []
+    for row in rows:
+        if row.character_id is not None:
+            characters.append(
+                {
+                    "character_id": row.character_id,
+                    "character": row.name,
+                    "num_lines": row.num_lines,
+                }
+            )
+
+    return {
+        "movie_id": rows[0].movie_id,
+        "title": rows[0].title,
+        "top_characters": characters,
+    }
+
 
-    character_stmt = (
+@statements.prebuilt
+def movie_statement():
+    # The movie and its top characters, read from the precomputed line counts,
+    # come back from a single statement: one row per top character, or a
+    # single row with null character columns when the movie has no lines. No
+    # rows at all means the movie does not exist.
+    movie_id = sqlalchemy.bindparam("movie_id")
+    top_characters = (
         sqlalchemy.select(
             db.characters.c.character_id,
             db.characters.c.name,
-            sqlalchemy.func.count(db.lines.c.line_text).label("num_lines"),
+            db.character_stats.c.num_lines,
         )
-        .select_from(db.lines.join(db.characters))
-        .where(db.lines.c.movie_id == movie_id)
-        .group_by(db.characters.c.character_id)
-        .order_by(sqlalchemy.desc("num_lines"))
+        .select_from(
+            db.character_stats.join(
+                db.characters,
+                db.characters.c.character_id == db.character_stats.c.character_id,
+            )
+        )
+        .where(
+            (db.character_stats.c.movie_id == movie_id)
+            & (db.character_stats.c.num_lines > 0)
+        )
+        .order_by(sqlalchemy.desc(db.character_stats.c.num_lines))
         .limit(5)
+        .subquery("top_characters")
+    )
+
+    movie_stmt = (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            top_characters.c.character_id,
+            top_characters.c.name,
+            top_characters.c.num_lines,
+        )
+        .select_from(db.movies.outerjoin(top_characters, sqlalchemy.true()))
+        .where(db.movies.c.movie_id == movie_id)
+        .order_by(sqlalchemy.desc(top_characters.c.num_lines))
     )
-    
 
+    return movie_stmt
 
-    with db.engine.connect() as conn:
-        character_result = conn.execute(character_stmt)
-        characters = []
-        for row in character_result:
-            characters.append(
+
+async def fetch_movie_details(movie_ids):
+    rows = await db.fetch_all(movies_details_statement(), {"movie_ids": movie_ids})
+
+    movies = {}
+    for row in rows:
+        movie = movies.get(row.movie_id)
+        if movie is None:
+            movie = movies[row.movie_id] = {
+                "movie_id": row.movie_id,
+                "title": row.title,
+                "top_characters": [],
+            }
+        if row.character_id is not None:
+            movie["top_characters"].append(
                 {
                     "character_id": row.character_id,
                     "character": row.name,
@@ -69,10 +191,64 @@ def get_movie(movie_id: int):
                 }
             )
 
-    movie["top_characters"] = characters
+    return list(movies.values())
+
+
+@statements.prebuilt
+def movies_details_statement():
+    # The same statement as movie_statement for many movies at once. Each
+    # movie's characters are ranked with a window function, and the top five
+    # are joined onto their movie.
+    movie_ids = sqlalchemy.bindparam("movie_ids", expanding=True)
+    ranked_characters = (
+        sqlalchemy.select(
+            db.character_stats.c.movie_id,
+            db.characters.c.character_id,
+            db.characters.c.name,
+            db.character_stats.c.num_lines,
+            sqlalchemy.func.row_number()
+            .over(
+                partition_by=db.character_stats.c.movie_id,
+                order_by=(
+                    sqlalchemy.desc(db.character_stats.c.num_lines),
+                    db.characters.c.character_id,
+                ),
+            )
+            .label("rank"),
+        )
+        .select_from(
+            db.character_stats.join(
+                db.characters,
+                db.characters.c.character_id == db.character_stats.c.character_id,
+            )
+        )
+        .where(
+            db.character_stats.c.movie_id.in_(movie_ids)
+            & (db.character_stats.c.num_lines > 0)
+        )
+        .subquery("ranked_characters")
+    )
+
+    movies_stmt = (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            ranked_characters.c.character_id,
+            ranked_characters.c.name,
+            ranked_characters.c.num_lines,
+        )
+        .select_from(
+            db.movies.outerjoin(
+                ranked_characters,
+                (ranked_characters.c.movie_id == db.movies.c.movie_id)
+                & (ranked_characters.c.rank <= 5),
+            )
+        )
+        .where(db.movies.c.movie_id.in_(movie_ids))
+        .order_by(db.movies.c.movie_id, ranked_characters.c.rank)
+    )
 
-    return movie
-  
+    return movies_stmt
 
 
 class movie_sort_options(str, Enum):
@@ -82,11 +258,17 @@ class movie_sort_options(str, Enum):
 
 
 @router.get("/movies/", tags=["movies"])
-def list_movies(
+@fast_json.response
+async def list_movies(
+    request: Request,
+    response: Response,
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: movie_sort_options = movie_sort_options.movie_title,
+    cursor: Optional[str] = None,
+    ids: Optional[str] = None,
+    fields: Optional[str] = None,
 ):
     """
     This endpoint returns a list of movies. For each movie it returns:
@@ -109,47 +291,133 @@ def list_movies(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    For walking the whole list, use the `cursor` query parameter instead of
+    `offset`. Pass an empty `cursor` for the first page and the `next_cursor`
+    of each response for the page after it. With `cursor` the response is an
+    object with the list of movies under `results` and `next_cursor`, which
+    is null on the last page. Cursor pages cost the same however deep they
+    are and do not shift while data is added.
+
+    To look up many movies at once, pass their ids as a comma separated list
+    in `ids`, for example `?ids=1,2,3`. The response is then an object that
+    maps each id to the movie as returned by `/movies/{movie_id}`, including
+    `top_characters`. Ids of movies that do not exist are left out. The
+    other query parameters are ignored.
+
+    To get only some of the fields of each movie, list them in `fields`, for
+    example `?fields=movie_id,movie_title`. Only those columns are read. With
+    `ids`, the fields are those of `/movies/{movie_id}`.
     """
+    fields = projection.parse_fields(
+        fields, MOVIE_FIELDS if ids is not None else MOVIES_FIELDS
+    )
+    not_modified = await http_cache.conditional(request, response, "corpus")
+    if not_modified:
+        return not_modified
+
+    if ids is not None:
+        if cursor is not None:
+            raise HTTPException(status_code=400, detail="Use either ids or cursor")
+        movie_ids = batch.parse_ids(ids)
+        if local.enabled():
+            movies = [local.corpus().movie(id) for id in movie_ids]
+            movies = [movie for movie in movies if movie is not None]
+        else:
+            movies = await fetch_movie_details(movie_ids)
+        movies = batch.keyed(movie_ids, movies, "movie_id")
+        return {id: projection.project(movie, fields) for id, movie in movies.items()}
+
     if sort is movie_sort_options.movie_title:
-        order_by = db.movies.c.title
+        sort_column, descending, sort_key, key_type = (
+            db.movies.c.title,
+            False,
+            "movie_title",
+            str,
+        )
     elif sort is movie_sort_options.year:
-        order_by = db.movies.c.year
+        sort_column, descending, sort_key, key_type = (
+            db.movies.c.year,
+            False,
+            "year",
+            str,
+        )
     elif sort is movie_sort_options.rating:
-        order_by = sqlalchemy.desc(db.movies.c.imdb_rating)
+        sort_column, descending, sort_key, key_type = (
+            db.movies.c.imdb_rating,
+            True,
+            "imdb_rating",
+            float,
+        )
     else:
         assert False
 
-    stmt = (
-        sqlalchemy.select(
-            db.movies.c.movie_id,
-            db.movies.c.title,
-            db.movies.c.year,
-            db.movies.c.imdb_rating,
-            db.movies.c.imdb_votes,
+    position = None
+    if cursor is not None:
+        if offset != 0:
+            raise HTTPException(status_code=400, detail="Use either offset or cursor")
+        position = pagination.decode_cursor(cursor, sort.value, key_type)
+        # the next cursor is made of the last movie's sort key and id
+        columns = projection.including(fields, sort_key, "movie_id")
+    else:
+        columns = fields
+
+    if local.enabled():
+        json = local.corpus().movies(
+            name, sort_key, descending, limit, offset, position
+        )
+    else:
+        json = await fetch_movies(
+            name, sort_column, descending, limit, offset, position, columns
         )
-        .limit(limit)
-        .offset(offset)
-        .order_by(order_by, db.movies.c.movie_id)
-    )
 
-    # filter only if name parameter is passed
+    if cursor is not None:
+        page = pagination.page(json, sort.value, limit, sort_key, "movie_id")
+        page["results"] = projection.project_all(page["results"], fields)
+        return page
+    return projection.project_all(json, fields)
+
+
+async def fetch_movies(
+    name, sort_column, descending, limit, offset, position, columns=None
+):
+    stmt = movies_statement(
+        sort_column,
+        descending,
+        name != "",
+        position is not None,
+        columns or MOVIES_FIELDS,
+    )
+    parameters = {"limit": limit, "offset": offset}
     if name != "":
-        stmt = stmt.where(db.movies.c.title.ilike(f"%{name}%"))
+        parameters["name"] = f"%{name}%"
+    if position is not None:
+        parameters.update(pagination.position_parameters(position))
 
-    with db.engine.connect() as conn: # with makes it atomic
-        result = conn.execute(stmt)
-        json = []
-        for row in result:
-            json.append(
-                {
-                    "movie_id": row.movie_id,
-                    "movie_title": row.title,
-                    "year": row.year,
-                    "imdb_rating": row.imdb_rating,
-                    "imdb_votes": row.imdb_votes,
-                }
+    result = await db.fetch_all(stmt, parameters)
+    return [dict(row._mapping) for row in result]
+
+
+@statements.prebuilt
+def movies_statement(sort_column, descending, named, after, columns=MOVIES_FIELDS):
+    order_by = sqlalchemy.desc(sort_column) if descending else sort_column
+
+    stmt = (
+        sqlalchemy.select(*[MOVIES_COLUMNS[column].label(column) for column in columns])
+        .limit(sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer))
+        .offset(sqlalchemy.bindparam("offset", type_=sqlalchemy.Integer))
+        .order_by(order_by, db.movies.c.movie_id)
+    )
+
+    if after:
+        stmt = stmt.where(
+            pagination.after(
+                sort_column, descending, db.movies.c.movie_id, pagination.POSITION
             )
+        )
 
-    return json
+    # filter only if name parameter is passed
+    if named:
+        stmt = stmt.where(db.movies.c.title.ilike(sqlalchemy.bindparam("name")))
 
-   
+    return stmt
@@ -1,8 +1,11 @@
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
 import os
 import pkg_resources
 import sys
 
+from src import cache, metrics, statements
+
 router = APIRouter()
 
 # This file is purely for debugging purposes. You can ignore.
@@ -44,3 +47,25 @@ def get_pkgsize():
 
     message = sorted(message, key=lambda d: d["size_in_mb"], reverse=True)
     return {"message": message}
+
+
+@router.get("/cache/stats/")
+def get_cache_stats():
+    return {
+        "caches": cache.stats(),
+        "statements": statements.stats(),
+        "compiled_statements": metrics.registry.compiled_cache_stats(),
+    }
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Request and database metrics in the Prometheus text format."""
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@router.get("/metrics/routes/")
+def get_route_metrics():
+    return {"routes": metrics.registry.summary()}
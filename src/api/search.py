@@ -0,0 +1,177 @@
+from fastapi import APIRouter
+from enum import Enum
+from fastapi.params import Query
+from src import database as db, fast_json, local, search
+import sqlalchemy
+
+router = APIRouter()
+
+
+@router.get("/search/movies/", tags=["search"])
+@fast_json.response
+async def search_movies(
+    q: str = Query(..., min_length=1),
+    fuzzy: bool = False,
+    limit: int = Query(10, ge=1, le=50),
+):
+    """
+    This endpoint searches movie titles and returns the best matches first.
+    For each movie it returns:
+    * `movie_id`: the internal id of the movie. Can be used to query the
+      `/movies/{movie_id}` endpoint.
+    * `movie_title`: The title of the movie.
+    * `year`: The year the movie was released.
+    * `score`: How closely the title matches, from 0 to 1.
+
+    By default titles must contain `q`. With `fuzzy` set, titles containing a
+    word similar to `q` also match, so misspelled searches still find results.
+    """
+    if local.enabled():
+        return local.corpus().search_movies(q, fuzzy, limit)
+
+    if fuzzy:
+        match = search.fuzzy(db.movies.c.title, q)
+    else:
+        match = search.contains(db.movies.c.title, q)
+    score = search.score(db.movies.c.title, q, fuzzy).label("score")
+
+    stmt = (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            db.movies.c.year,
+            score,
+        )
+        .where(match)
+        .order_by(sqlalchemy.desc(score), db.movies.c.title, db.movies.c.movie_id)
+        .limit(limit)
+    )
+
+    result = await db.fetch_all(stmt)
+    movies = []
+    for row in result:
+        movies.append(
+            {
+                "movie_id": row.movie_id,
+                "movie_title": row.title,
+                "year": row.year,
+                "score": row.score,
+            }
+        )
+
+    return movies
+
+
+@router.get("/search/characters/", tags=["search"])
+@fast_json.response
+async def search_characters(
+    q: str = Query(..., min_length=1),
+    fuzzy: bool = False,
+    limit: int = Query(10, ge=1, le=50),
+):
+    """
+    This endpoint searches character names and returns the best matches first.
+    For each character it returns:
+    * `character_id`: the internal id of the character. Can be used to query the
+      `/characters/{character_id}` endpoint.
+    * `character`: The name of the character.
+    * `movie`: The movie the character is from.
+    * `score`: How closely the name matches, from 0 to 1.
+
+    By default names must contain `q`. With `fuzzy` set, names containing a
+    word similar to `q` also match, so misspelled searches still find results.
+    """
+    if local.enabled():
+        return local.corpus().search_characters(q, fuzzy, limit)
+
+    if fuzzy:
+        match = search.fuzzy(db.characters.c.name, q)
+    else:
+        match = search.contains(db.characters.c.name, q)
+    score = search.score(db.characters.c.name, q, fuzzy).label("score")
+
+    # the name match runs against Characters alone before joining movies
+    matches = (
+        sqlalchemy.select(
+            db.characters.c.character_id,
+            db.characters.c.name,
+            db.characters.c.movie_id,
+            score,
+        )
+        .where(match)
+        .order_by(
+            sqlalchemy.desc(score), db.characters.c.name, db.characters.c.character_id
+        )
+        .limit(limit)
+        .subquery("matches")
+    )
+
+    stmt = (
+        sqlalchemy.select(
+            matches.c.character_id,
+            matches.c.name,
+            db.movies.c.title.label("movie"),
+            matches.c.score,
+        )
+        .select_from(
+            matches.join(db.movies, db.movies.c.movie_id == matches.c.movie_id)
+        )
+        .order_by(
+            sqlalchemy.desc(matches.c.score), matches.c.name, matches.c.character_id
+        )
+    )
+
+    result = await db.fetch_all(stmt)
+    characters = []
+    for row in result:
+        characters.append(
+            {
+                "character_id": row.character_id,
+                "character": row.name,
+                "movie": row.movie,
+                "score": row.score,
+            }
+        )
+
+    return characters
+
+
+class autocomplete_options(str, Enum):
+    movies = "movies"
+    characters = "characters"
+
+
+@router.get("/search/autocomplete/", tags=["search"])
+@fast_json.response
+async def autocomplete(
+    prefix: str = Query(..., min_length=1),
+    kind: autocomplete_options = autocomplete_options.movies,
+    limit: int = Query(10, ge=1, le=50),
+):
+    """
+    This endpoint suggests completions for a partially typed movie title or
+    character name. It returns a list of suggestions, shortest first, each with:
+    * `id`: the internal id of the movie or character.
+    * `name`: The movie title or character name.
+
+    Use `kind` to choose between `movies` and `characters`.
+    """
+    if local.enabled():
+        return local.corpus().autocomplete(prefix, kind.value, limit)
+
+    if kind is autocomplete_options.movies:
+        id_column, name_column = db.movies.c.movie_id, db.movies.c.title
+    else:
+        id_column, name_column = db.characters.c.character_id, db.characters.c.name
+
+    stmt = (
+        sqlalchemy.select(id_column.label("id"), name_column.label("name"))
+        .where(search.starts_with(name_column, prefix))
+        .order_by(sqlalchemy.func.length(name_column), name_column, id_column)
+        .limit(limit)
+    )
+
+    result = await db.fetch_all(stmt)
+    suggestions = [{"id": row.id, "name": row.name} for row in result]
+
+    return suggestions
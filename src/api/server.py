@@ -1,5 +1,16 @@
 from fastapi import FastAPI
-from src.api import characters, movies, pkg_util, lines, conversations
+from src import compression, metrics, database as db
+from src.api import (
+    analytics,
+    characters,
+    movies,
+    pkg_util,
+    lines,
+    conversations,
+    search,
+    graph,
+    transcripts,
+)
 
 description = """
 Movie API returns dialog statistics on top hollywood movies from decades past.
@@ -15,6 +26,25 @@ You can:
 You can:
 * **list movies with sorting and filtering options.**
 * **retrieve a specific movie by id**
+* **read a movie's script, or the transcript of a single conversation**
+
+## Search
+
+You can:
+* **search movie titles and character names, optionally with fuzzy matching**
+* **autocomplete partially typed titles and names**
+
+## Graph
+
+You can:
+* **find the characters a character talks to the most**
+* **explore everyone within a few conversations of a character**
+* **find the shortest chain of conversations between two characters**
+
+## Analytics
+
+You can:
+* **compare dialogue across years, genders, ratings and casts of the whole corpus**
 """
 tags_metadata = [
     {
@@ -27,7 +57,19 @@ tags_metadata = [
     },
     {   "name": "lines", 
         "description": "Access information on movie lines."
-    }
+    },
+    {
+        "name": "search",
+        "description": "Search and autocomplete movie titles and character names.",
+    },
+    {
+        "name": "graph",
+        "description": "Network queries over who talks to whom.",
+    },
+    {
+        "name": "analytics",
+        "description": "Aggregates over the whole corpus.",
+    },
 ]
 
 app = FastAPI(
@@ -40,11 +82,18 @@ app = FastAPI(
     },
     openapi_tags=tags_metadata,
 )
+app.add_middleware(compression.CompressionMiddleware)
+app.add_middleware(db.ReadYourWritesMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 app.include_router(characters.router)
 app.include_router(movies.router)
 app.include_router(lines.router)
 app.include_router(pkg_util.router)
 app.include_router(conversations.router)
+app.include_router(transcripts.router)
+app.include_router(search.router)
+app.include_router(graph.router)
+app.include_router(analytics.router)
 
 
 @app.get("/")
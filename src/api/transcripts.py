@@ -0,0 +1,211 @@
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from src import database as db, fast_json, http_cache, local, statements
+import sqlalchemy
+
+router = APIRouter()
+
+# Conversations read back in the order their lines were spoken, one
+# conversation at a time or a whole movie at once. Lines are ordered by
+# line_sort, and by line id between lines with the same line_sort.
+
+
+@statements.prebuilt
+def conversation_statement():
+    # one row per line, or a single row with null line columns for a
+    # conversation without lines; no rows means there is no such conversation
+    first = db.characters.alias("first_character")
+    second = db.characters.alias("second_character")
+    speakers = db.characters.alias("speakers")
+    conversations = db.conversations.c
+    return (
+        sqlalchemy.select(
+            conversations.conversation_id,
+            conversations.movie_id,
+            db.movies.c.title,
+            conversations.character1_id,
+            first.c.name.label("character1_name"),
+            conversations.character2_id,
+            second.c.name.label("character2_name"),
+            db.lines.c.line_id,
+            db.lines.c.line_sort,
+            db.lines.c.character_id,
+            speakers.c.name.label("speaker"),
+            db.lines.c.line_text,
+        )
+        .select_from(
+            db.conversations.join(
+                db.movies, db.movies.c.movie_id == conversations.movie_id
+            )
+            .join(first, first.c.character_id == conversations.character1_id)
+            .join(second, second.c.character_id == conversations.character2_id)
+            .outerjoin(
+                db.lines, db.lines.c.conversation_id == conversations.conversation_id
+            )
+            .outerjoin(speakers, speakers.c.character_id == db.lines.c.character_id)
+        )
+        .where(conversations.conversation_id == sqlalchemy.bindparam("conversation_id"))
+        .order_by(db.lines.c.line_sort, db.lines.c.line_id)
+    )
+
+
+@statements.prebuilt
+def cast_statement():
+    # the movie and the names of its characters, one row per character; no
+    # rows means there is no such movie
+    return (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            db.characters.c.character_id,
+            db.characters.c.name,
+        )
+        .select_from(
+            db.movies.outerjoin(
+                db.characters, db.characters.c.movie_id == db.movies.c.movie_id
+            )
+        )
+        .where(db.movies.c.movie_id == sqlalchemy.bindparam("movie_id"))
+    )
+
+
+@statements.prebuilt
+def script_statement():
+    # a scan of lines_movie_conversation_line_sort_idx in index order; the
+    # speakers' names are looked up in the movie's cast rather than joined,
+    # which would have the rows sorted again before the first one is sent
+    return (
+        sqlalchemy.select(
+            db.lines.c.conversation_id,
+            db.lines.c.line_sort,
+            db.lines.c.character_id,
+            db.lines.c.line_text,
+        )
+        .where(db.lines.c.movie_id == sqlalchemy.bindparam("movie_id"))
+        .order_by(db.lines.c.conversation_id, db.lines.c.line_sort, db.lines.c.line_id)
+    )
+
+
+@router.get("/conversations/{conversation_id}", tags=["lines"])
+@fast_json.response
+async def get_conversation(conversation_id: int, request: Request, response: Response):
+    """
+    This endpoint returns a conversation and its transcript. It returns:
+    * `conversation_id`: the internal id of the conversation.
+    * `movie_id`: the internal id of the movie the conversation is from.
+    * `movie`: The title of the movie.
+    * `characters`: The two characters in the conversation, each with its
+      `character_id` and `character` name.
+    * `lines`: The lines of the conversation in the order they were spoken.
+
+    Each line is represented by a dictionary with the following keys:
+    * `line_sort`: The position of the line in the conversation.
+    * `character_id`: the internal id of the character who speaks the line.
+    * `character`: The name of that character.
+    * `line_text`: The text of the line.
+
+    Conversations do not change once they are added, and responses carry an
+    `ETag` for conditional requests like the other read endpoints.
+    """
+    not_modified = await http_cache.conditional(
+        request, response, "conversation", conversation_id
+    )
+    if not_modified:
+        return not_modified
+
+    if local.enabled():
+        conversation = local.corpus().conversation(conversation_id)
+        if conversation is None:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        return conversation
+
+    rows = await db.fetch_all(
+        conversation_statement(), {"conversation_id": conversation_id}
+    )
+
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    first = rows[0]
+    return {
+        "conversation_id": first.conversation_id,
+        "movie_id": first.movie_id,
+        "movie": first.title,
+        "characters": [
+            {"character_id": first.character1_id, "character": first.character1_name},
+            {"character_id": first.character2_id, "character": first.character2_name},
+        ],
+        "lines": [
+            {
+                "line_sort": row.line_sort,
+                "character_id": row.character_id,
+                "character": row.speaker,
+                "line_text": row.line_text,
+            }
+            for row in rows
+            if row.line_id is not None
+        ],
+    }
+
+
+@router.get("/movies/{movie_id}/script", tags=["lines"])
+@fast_json.response
+async def get_script(movie_id: int, request: Request, response: Response):
+    """
+    This endpoint returns every line of a movie, for reading its script. It
+    returns:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `lines`: The lines of the movie, conversation by conversation in order
+      of conversation id, and in the order they were spoken within each.
+
+    Each line is represented by a dictionary with the following keys:
+    * `conversation_id`: the internal id of the conversation of the line.
+    * `line_sort`: The position of the line in its conversation.
+    * `character_id`: the internal id of the character who speaks the line.
+    * `character`: The name of that character.
+    * `line_text`: The text of the line.
+
+    The lines are written out as they are read from the database, so whole
+    scripts are never held in memory. Responses carry an `ETag` and
+    `Last-Modified` that change whenever a conversation is added to the
+    movie.
+    """
+    not_modified = await http_cache.conditional(request, response, "movie", movie_id)
+    if not_modified:
+        return not_modified
+
+    if local.enabled():
+        script = local.corpus().movie_script(movie_id)
+        if script is None:
+            raise HTTPException(status_code=404, detail="Movie not found")
+        return script
+
+    rows = await db.fetch_all(cast_statement(), {"movie_id": movie_id})
+
+    if len(rows) == 0:
+        raise HTTPException(status_code=404, detail="Movie not found")
+    head = fast_json.dumps({"movie_id": rows[0].movie_id, "title": rows[0].title})
+    names = {row.character_id: row.name for row in rows}
+
+    async def document():
+        yield head[:-1] + b',"lines":['
+        separator = b""
+        async for batch in db.stream(script_statement(), {"movie_id": movie_id}):
+            yield separator + b",".join(
+                fast_json.dumps(
+                    {
+                        "conversation_id": row.conversation_id,
+                        "line_sort": row.line_sort,
+                        "character_id": row.character_id,
+                        "character": names.get(row.character_id),
+                        "line_text": row.line_text,
+                    }
+                )
+                for row in batch
+            )
+            separator = b","
+        yield b"]}"
+
+    return StreamingResponse(
+        document(), media_type="application/json", headers=response.headers
+    )
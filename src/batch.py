@@ -0,0 +1,32 @@
+from fastapi import HTTPException
+
+# Batch lookups by id, shared by the list endpoints' `ids` parameter.
+
+MAX_IDS = 250
+
+
+def parse_ids(ids):
+    """
+    Parses a comma separated list of ids such as "1,2,3" into a list of
+    distinct ids in the order given.
+    """
+    try:
+        parsed = [int(id) for id in ids.split(",") if id.strip() != ""]
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="ids must be a comma separated list of integers"
+        )
+    parsed = list(dict.fromkeys(parsed))
+    if len(parsed) == 0:
+        raise HTTPException(status_code=400, detail="ids must not be empty")
+    if len(parsed) > MAX_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_IDS} ids can be looked up at once"
+        )
+    return parsed
+
+
+def keyed(ids, results, id_key):
+    """Orders `results` by `ids` and keys them by id. Unknown ids are left out."""
+    by_id = {result[id_key]: result for result in results}
+    return {id: by_id[id] for id in ids if id in by_id}
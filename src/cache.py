@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Read-through caches for the detail endpoints. The corpus barely changes, so
+# entries live until they expire or a write touches the movie or character
+# they describe. Writes by other processes are caught by storing each entry
+# with the version of its data from movie_stats or character_stats (see
+# src/http_cache.py): an entry read with any other version is a miss.
+
+CACHE_SIZE = int(os.environ.get("MOVIE_API_CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.environ.get("MOVIE_API_CACHE_TTL", "300"))
+
+
+class TTLCache:
+    """
+    A bounded mapping that evicts the least recently used entry once it is
+    full and treats entries older than `ttl` seconds as missing.
+    """
+
+    def __init__(self, name, maxsize=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by every invalidation so a load that raced with a write does
+        # not cache what it read before the write
+        self._generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        """
+        Returns the cached value for `key`, or None on a miss, which includes
+        a value cached for another `version` of the data.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, entry_version, value = entry
+                if expires_at > self.clock() and entry_version == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, version=None):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def get_or_load(self, key, load, version=None):
+        """
+        Returns the cached value for `version` of `key`, awaiting `load()`
+        and caching its result on a miss. Exceptions from `load` (such as a
+        404) are not cached. `version` must have been read before the data
+        `load` reads, so a load can only be newer than its version.
+        """
+        value = self.get(key, version)
+        if value is None:
+            generation = self._generation
+            value = await load()
+            if generation == self._generation:
+                self.set(key, value, version)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+movie_cache = TTLCache("movies")
+character_cache = TTLCache("characters")
+
+
+def invalidate_conversation(movie_id, character_ids):
+    """
+    Drops every cached response that a new conversation in `movie_id` between
+    `character_ids` can change: the movie's top characters and each
+    character's top conversations.
+    """
+    movie_cache.invalidate(movie_id)
+    for character_id in character_ids:
+        character_cache.invalidate(character_id)
+
+
+def stats():
+    return [movie_cache.stats(), character_cache.stats()]
@@ -0,0 +1,178 @@
+import os
+import zlib
+
+import dotenv
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response compression. JSON responses of at least
+# MOVIE_API_COMPRESSION_MIN_BYTES are compressed with the best encoding the
+# client accepts: brotli when the optional `brotli` package is installed, and
+# gzip otherwise. Streamed responses are compressed chunk by chunk, and each
+# chunk is flushed so the client still receives it straight away.
+#
+# A compressed response carries a weak version of its ETag, since its bytes
+# differ from the uncompressed response. http_cache compares ETags weakly, so
+# revalidation works either way. MOVIE_API_COMPRESSION_MIN_BYTES=0 compresses
+# everything compressible; set MOVIE_API_COMPRESSION=false to turn it off.
+
+dotenv.load_dotenv()
+ENABLED = os.environ.get("MOVIE_API_COMPRESSION", "true").lower() == "true"
+MINIMUM_SIZE = int(os.environ.get("MOVIE_API_COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("MOVIE_API_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("MOVIE_API_BROTLI_QUALITY", "4"))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+def accepted_encodings(accept_encoding):
+    """The quality the client gives each content coding in Accept-Encoding."""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if coding == "":
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities
+
+
+def negotiate(accept_encoding):
+    """Picks "br", "gzip" or None for a request's Accept-Encoding header."""
+    if accept_encoding is None:
+        return None
+    qualities = accepted_encodings(accept_encoding)
+    offers = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_quality = None, 0.0
+    for coding in offers:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+class Compressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data, final):
+        """Compresses the next chunk, flushing it so it can be sent as is."""
+        if self.encoding == "br":
+            out = self._brotli.process(data)
+            return out + (self._brotli.finish() if final else self._brotli.flush())
+        out = self._zlib.compress(data)
+        return out + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    """Compresses large enough responses with the encoding the client prefers."""
+
+    def __init__(self, app, minimum_size=MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = negotiate(accept_encoding)
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # held back until the first body shows how large it is
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is None:
+                headers = dict(start.get("headers", []))
+                compressible = (
+                    start["status"] not in (204, 304)
+                    and b"content-encoding" not in headers
+                    and headers.get(b"content-type", b"")
+                    .decode("latin-1")
+                    .startswith(COMPRESSIBLE_TYPES)
+                )
+                if compressible:
+                    start["headers"] = vary(start.get("headers", []))
+                if (
+                    not compressible
+                    or encoding is None
+                    or (not more_body and len(body) < self.minimum_size)
+                ):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = Compressor(encoding)
+                body = compressor.compress(body, final=not more_body)
+                start["headers"] = compressed_headers(
+                    start["headers"], encoding, None if more_body else len(body)
+                )
+                await send(start)
+                await send(
+                    {"type": "http.response.body", "body": body, "more_body": more_body}
+                )
+                return
+
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": compressor.compress(body, final=not more_body),
+                    "more_body": more_body,
+                }
+            )
+
+        await self.app(scope, receive, send_compressed)
+
+
+def vary(headers):
+    for i, (name, value) in enumerate(headers):
+        if name == b"vary":
+            if b"accept-encoding" not in value.lower():
+                headers = list(headers)
+                headers[i] = (name, value + b", Accept-Encoding")
+            return headers
+    return list(headers) + [(b"vary", b"Accept-Encoding")]
+
+
+def compressed_headers(headers, encoding, content_length):
+    out = []
+    for name, value in headers:
+        if name == b"content-length":
+            continue
+        if name == b"etag" and not value.startswith(b"W/"):
+            value = b"W/" + value
+        out.append((name, value))
+    out.append((b"content-encoding", encoding.encode("latin-1")))
+    if content_length is not None:
+        out.append((b"content-length", str(content_length).encode("latin-1")))
+    return out
@@ -1,7 +1,26 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import http.cookies
+import itertools
+import logging
+import math
 import os
+import random
+import threading
+import time
+import weakref
 import dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import NullPool
+from starlette.concurrency import run_in_threadpool
 import sqlalchemy
+from src import metrics
+
+logger = logging.getLogger(__name__)
 
 # DO NOT CHANGE THIS TO BE HARDCODED. ONLY PULL FROM ENVIRONMENT VARIABLES.
 
@@ -14,12 +33,606 @@ def database_connection_url():
     DB_NAME: str = os.environ.get("POSTGRES_DB")
     return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
 
-engine = create_engine(database_connection_url())
 
-conn = engine.connect()
+def pool_options():
+    """
+    Pool settings from the environment. POSTGRES_POOL_SIZE=0 disables pooling
+    entirely, which suits serverless deploys where each instance only lives
+    for a handful of requests.
+    """
+    dotenv.load_dotenv()
+    pool_size = int(os.environ.get("POSTGRES_POOL_SIZE", "5"))
+    options = {
+        "pool_pre_ping": os.environ.get("POSTGRES_POOL_PRE_PING", "true").lower()
+        == "true",
+    }
+    if pool_size == 0:
+        options["poolclass"] = NullPool
+    else:
+        options["pool_size"] = pool_size
+        options["max_overflow"] = int(os.environ.get("POSTGRES_MAX_OVERFLOW", "10"))
+        options["pool_timeout"] = float(os.environ.get("POSTGRES_POOL_TIMEOUT", "30"))
+        options["pool_recycle"] = int(os.environ.get("POSTGRES_POOL_RECYCLE", "1800"))
+    return options
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine():
+    """
+    Creates the engine on first use rather than at import time, so importing
+    the app does not open a connection.
+    """
+    return create_engine(database_connection_url(), **pool_options())
+
+
+@functools.lru_cache(maxsize=None)
+def async_mode():
+    """
+    POSTGRES_ASYNC=true runs queries on an asyncpg engine inside the event
+    loop. Otherwise they run on the psycopg2 engine in the threadpool.
+    """
+    dotenv.load_dotenv()
+    return os.environ.get("POSTGRES_ASYNC", "false").lower() == "true"
+
+
+# asyncpg connections belong to the event loop that opened them, so each loop
+# gets its own engine. A server runs a single loop; test clients may start
+# several.
+async_engines = weakref.WeakKeyDictionary()
+
+
+def create_asyncpg_engine(url):
+    url = url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    # asyncpg prepares each statement on the server and keeps up to this
+    # many prepared per connection. Use 0 behind a PgBouncer in
+    # transaction mode, which cannot share prepared statements.
+    url += (
+        ("&" if "?" in url else "?")
+        + "prepared_statement_cache_size="
+        + os.environ.get("POSTGRES_PREPARED_STATEMENT_CACHE_SIZE", "256")
+    )
+    return create_async_engine(url, **pool_options())
+
+
+def get_async_engine():
+    loop = asyncio.get_running_loop()
+    engine = async_engines.get(loop)
+    if engine is None:
+        engine = async_engines[loop] = create_asyncpg_engine(database_connection_url())
+    return engine
+
+
+# Read replicas. POSTGRES_REPLICA_URLS is a comma separated list of
+# connection URLs for read-only copies of the database. When it is set,
+# fetch_all and stream read from the replicas in turn, while transactions,
+# and so every write, go to the primary. A replica that cannot be reached is
+# skipped for POSTGRES_REPLICA_RETRY_SECONDS, and reads fall back to the
+# primary when no replica can be reached.
+#
+# Replicas lag behind the primary, so for POSTGRES_READ_YOUR_WRITES_SECONDS
+# after a write, the reads that have to see it go to the primary: those of
+# the client that wrote, which ReadYourWritesMiddleware recognizes by a
+# cookie, and those of data that was just written (see
+# http_cache.conditional).
+
+def replica_urls():
+    dotenv.load_dotenv()
+    urls = os.environ.get("POSTGRES_REPLICA_URLS", "")
+    return [url.strip() for url in urls.split(",") if url.strip() != ""]
+
+
+REPLICA_RETRY_SECONDS = float(os.environ.get("POSTGRES_REPLICA_RETRY_SECONDS", "30"))
+READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get("POSTGRES_READ_YOUR_WRITES_SECONDS", "5")
+)
+
+
+class Replicas:
+    """
+    Hands out replicas in turn, leaving out those that recently failed to
+    connect. Engines are created on first use, per event loop for asyncpg.
+    """
+
+    def __init__(self, urls, clock=time.monotonic):
+        self.urls = urls
+        self.clock = clock
+        self.engines = {}
+        self.async_engines = weakref.WeakKeyDictionary()
+        self.down_until = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        """The reachable replicas, starting from the next one in turn."""
+        if not self.urls:
+            return []
+        start = next(self._turn)
+        now = self.clock()
+        urls = [self.urls[(start + i) % len(self.urls)] for i in range(len(self.urls))]
+        return [url for url in urls if self.down_until.get(url, 0) <= now]
+
+    def engine(self, url):
+        with self._lock:
+            engine = self.engines.get(url)
+            if engine is None:
+                engine = self.engines[url] = create_engine(url, **pool_options())
+            return engine
+
+    def async_engine(self, url):
+        with self._lock:
+            engines = self.async_engines.setdefault(asyncio.get_running_loop(), {})
+            engine = engines.get(url)
+            if engine is None:
+                engine = engines[url] = create_asyncpg_engine(url)
+            return engine
+
+    def failed(self, url, error):
+        self.down_until[url] = self.clock() + REPLICA_RETRY_SECONDS
+        logger.warning(
+            "cannot connect to replica %s, skipping it for %s s: %s",
+            sqlalchemy.engine.make_url(url).render_as_string(hide_password=True),
+            REPLICA_RETRY_SECONDS,
+            error,
+        )
+
+
+replicas = Replicas(replica_urls())
+
+
+class Session:
+    """How the current request uses the database."""
+
+    __slots__ = ("primary", "wrote")
+
+    def __init__(self, primary=False):
+        self.primary = primary
+        self.wrote = False
+
+
+# The session of the request being served, like metrics.current_request.
+current_session = contextvars.ContextVar("current_session", default=None)
+
+
+def use_primary():
+    """Sends the current request's remaining reads to the primary."""
+    session = current_session.get()
+    if session is not None:
+        session.primary = True
+
+
+def reads_from_primary():
+    session = current_session.get()
+    return session is not None and session.primary
+
+
+class ReadYourWritesMiddleware:
+    """
+    Lets clients read their own writes while the replicas catch up. The
+    response to a request that wrote sets a cookie with the time of the
+    write, and requests that carry a recent one read from the primary, as
+    do the requests that write.
+    """
+
+    cookie = "movie_api_wrote_at"
 
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replicas.urls:
+            await self.app(scope, receive, send)
+            return
+
+        # writes also make their reads, such as validation, on the primary
+        writes = scope["method"] not in ("GET", "HEAD", "OPTIONS")
+        session = Session(primary=writes or self.wrote_recently(scope))
+        token = current_session.set(session)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and session.wrote:
+                cookie = (
+                    f"{self.cookie}={time.time():.3f}; "
+                    f"Max-Age={math.ceil(READ_YOUR_WRITES_SECONDS)}; "
+                    "Path=/; HttpOnly; SameSite=Lax"
+                )
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"set-cookie", cookie.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            current_session.reset(token)
+
+    def wrote_recently(self, scope):
+        for name, value in scope["headers"]:
+            if name != b"cookie":
+                continue
+            cookies = http.cookies.SimpleCookie()
+            try:
+                cookies.load(value.decode("latin-1"))
+                wrote_at = float(cookies[self.cookie].value)
+            except (http.cookies.CookieError, KeyError, ValueError):
+                continue
+            # the cookie comes from the client, so a time in the future would
+            # pin it to the primary for as long as it likes; a second ahead is
+            # allowed for servers whose clocks differ
+            return -1.0 <= time.time() - wrote_at < READ_YOUR_WRITES_SECONDS
+        return False
+
+
+@contextlib.contextmanager
+def connect_sync():
+    """A pooled connection, recording how long the checkout took."""
+    start = time.perf_counter()
+    with get_engine().connect() as conn:
+        metrics.record_pool_wait(time.perf_counter() - start)
+        yield conn
+
+
+@contextlib.asynccontextmanager
+async def connect_async():
+    start = time.perf_counter()
+    async with get_async_engine().connect() as conn:
+        metrics.record_pool_wait(time.perf_counter() - start)
+        yield conn
+
+
+@contextlib.contextmanager
+def connect_read_sync():
+    """
+    A pooled connection for reads: to the next reachable replica, or to the
+    primary when the request has to read from it or no replica is reachable.
+    """
+    if not reads_from_primary():
+        for url in replicas.candidates():
+            start = time.perf_counter()
+            try:
+                conn = replicas.engine(url).connect()
+            except (sqlalchemy.exc.DBAPIError, OSError) as error:
+                replicas.failed(url, error)
+                continue
+            metrics.record_pool_wait(time.perf_counter() - start)
+            with conn:
+                yield conn
+            return
+    with connect_sync() as conn:
+        yield conn
+
+
+@contextlib.asynccontextmanager
+async def connect_read_async():
+    if not reads_from_primary():
+        for url in replicas.candidates():
+            start = time.perf_counter()
+            conn = replicas.async_engine(url).connect()
+            try:
+                await conn.start()
+            except (sqlalchemy.exc.DBAPIError, OSError) as error:
+                replicas.failed(url, error)
+                continue
+            metrics.record_pool_wait(time.perf_counter() - start)
+            try:
+                yield conn
+            finally:
+                await conn.close()
+            return
+    async with connect_async() as conn:
+        yield conn
+
+
+def fetch_all_sync(stmt, parameters=None):
+    with connect_read_sync() as conn:
+        return conn.execute(stmt, parameters).fetchall()
+
+
+def transaction_sync(fn, *args, isolation_level=None):
+    with connect_sync() as conn:
+        if isolation_level is not None:
+            conn.execution_options(isolation_level=isolation_level)
+        with conn.begin():
+            return fn(conn, *args)
+
+
+async def fetch_all(stmt, parameters=None):
+    """
+    Executes `stmt` with the values of its bound `parameters`, if any, on a
+    pooled connection to a replica or the primary, and returns all of its
+    rows.
+    """
+    if async_mode():
+        async with connect_read_async() as conn:
+            result = await conn.execute(stmt, parameters)
+            return result.fetchall()
+    return await run_in_threadpool(fetch_all_sync, stmt, parameters)
+
+
+async def transaction(fn, *args, isolation_level=None):
+    """
+    Calls `fn(conn, *args)` inside a transaction and returns its result. `fn`
+    is written against a regular synchronous connection in either mode.
+    """
+    if async_mode():
+        async with connect_async() as conn:
+            if isolation_level is not None:
+                await conn.execution_options(isolation_level=isolation_level)
+            async with conn.begin():
+                return await conn.run_sync(fn, *args)
+    return await run_in_threadpool(
+        transaction_sync, fn, *args, isolation_level=isolation_level
+    )
+
+
+# serialization_failure and deadlock_detected: the transaction did nothing
+# wrong and succeeds if run again
+RETRYABLE_ERRORS = {"40001", "40P01"}
+WRITE_RETRIES = int(os.environ.get("POSTGRES_WRITE_RETRIES", "5"))
+WRITE_ISOLATION = os.environ.get("POSTGRES_WRITE_ISOLATION", "READ COMMITTED")
+
+
+def retryable(error):
+    return getattr(error.orig, "pgcode", None) in RETRYABLE_ERRORS
+
+
+async def write_transaction(fn, *args):
+    """
+    Calls `fn(conn, *args)` inside a transaction at POSTGRES_WRITE_ISOLATION.
+    When Postgres aborts it because of a deadlock or, at the stricter levels,
+    a serialization failure, it is run again after a short randomized
+    backoff, up to POSTGRES_WRITE_RETRIES times. `fn` may therefore run more
+    than once and must not change anything outside the transaction.
+
+    The rest of the request reads from the primary, and its client will too
+    for a while (see ReadYourWritesMiddleware).
+    """
+    session = current_session.get()
+    if session is not None:
+        session.primary = True
+    attempt = 0
+    while True:
+        try:
+            result = await transaction(fn, *args, isolation_level=WRITE_ISOLATION)
+            if session is not None:
+                session.wrote = True
+            return result
+        except sqlalchemy.exc.DBAPIError as error:
+            if attempt >= WRITE_RETRIES or not retryable(error):
+                raise
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, 0.005 * 2 ** attempt))
+
+
+def stream_sync(stmt, parameters, batch_size):
+    with connect_read_sync() as conn:
+        result = conn.execution_options(
+            stream_results=True, yield_per=batch_size
+        ).execute(stmt, parameters)
+        for batch in result.partitions():
+            yield batch
+
+
+async def stream(stmt, parameters=None, batch_size=500):
+    """
+    Executes `stmt` with a server-side cursor and yields its rows in lists of
+    up to `batch_size`, so large results never sit in memory all at once.
+    """
+    if async_mode():
+        async with connect_read_async() as conn:
+            result = await conn.stream(
+                stmt.execution_options(yield_per=batch_size), parameters
+            )
+            async for batch in result.partitions():
+                yield batch
+        return
+
+    batches = stream_sync(stmt, parameters, batch_size)
+    try:
+        while True:
+            batch = await run_in_threadpool(next, batches, None)
+            if batch is None:
+                break
+            yield batch
+    finally:
+        # release the connection even if the client went away mid-stream
+        await run_in_threadpool(batches.close)
+
+
+def __getattr__(name):
+    # keeps `db.engine` working for callers while deferring engine creation
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# The tables are declared here instead of reflected so that startup does not
+# need any catalog queries. Keep these in sync with the database schema.
 metadata_obj = sqlalchemy.MetaData()
-movies = sqlalchemy.Table("Movies", metadata_obj, autoload_with=engine)
-characters = sqlalchemy.Table("Characters", metadata_obj, autoload_with=engine)
-conversations = sqlalchemy.Table("Conversations", metadata_obj, autoload_with=engine)
-lines = sqlalchemy.Table("Lines", metadata_obj, autoload_with=engine)
+
+# Created by migrations/001_conversation_line_sequences.sql, which also makes
+# them the column defaults for the two ids.
+conversation_id_seq = sqlalchemy.Sequence(
+    "conversations_conversation_id_seq", metadata=metadata_obj
+)
+line_id_seq = sqlalchemy.Sequence("lines_line_id_seq", metadata=metadata_obj)
+
+movies = sqlalchemy.Table(
+    "Movies",
+    metadata_obj,
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("title", sqlalchemy.Text),
+    sqlalchemy.Column("year", sqlalchemy.Text),
+    sqlalchemy.Column("imdb_rating", sqlalchemy.Float),
+    sqlalchemy.Column("imdb_votes", sqlalchemy.Integer),
+    sqlalchemy.Column("raw_script_url", sqlalchemy.Text),
+)
+characters = sqlalchemy.Table(
+    "Characters",
+    metadata_obj,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.Text),
+    sqlalchemy.Column(
+        "movie_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("Movies.movie_id")
+    ),
+    sqlalchemy.Column("gender", sqlalchemy.Text),
+    sqlalchemy.Column("age", sqlalchemy.Integer),
+)
+conversations = sqlalchemy.Table(
+    "Conversations",
+    metadata_obj,
+    sqlalchemy.Column(
+        "conversation_id",
+        sqlalchemy.Integer,
+        primary_key=True,
+        server_default=sqlalchemy.text("nextval('conversations_conversation_id_seq')"),
+    ),
+    sqlalchemy.Column(
+        "character1_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Characters.character_id"),
+    ),
+    sqlalchemy.Column(
+        "character2_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Characters.character_id"),
+    ),
+    sqlalchemy.Column(
+        "movie_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("Movies.movie_id")
+    ),
+)
+lines = sqlalchemy.Table(
+    "Lines",
+    metadata_obj,
+    sqlalchemy.Column(
+        "line_id",
+        sqlalchemy.Integer,
+        primary_key=True,
+        server_default=sqlalchemy.text("nextval('lines_line_id_seq')"),
+    ),
+    sqlalchemy.Column(
+        "character_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Characters.character_id"),
+    ),
+    sqlalchemy.Column(
+        "movie_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("Movies.movie_id")
+    ),
+    sqlalchemy.Column(
+        "conversation_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Conversations.conversation_id"),
+    ),
+    sqlalchemy.Column("line_sort", sqlalchemy.Integer),
+    sqlalchemy.Column("line_text", sqlalchemy.Text),
+    # generated columns from migrations/004_line_word_counts.sql
+    sqlalchemy.Column(
+        "word_count",
+        sqlalchemy.Integer,
+        sqlalchemy.Computed(
+            "CASE WHEN btrim(line_text, E' \\t\\n\\r\\f\\v') = '' THEN 0 "
+            "ELSE array_length(regexp_split_to_array("
+            "btrim(line_text, E' \\t\\n\\r\\f\\v'), E'\\\\s+'), 1) END"
+        ),
+    ),
+    sqlalchemy.Column(
+        "line_length", sqlalchemy.Integer, sqlalchemy.Computed("length(line_text)")
+    ),
+)
+
+# Precomputed line counts from migrations/002_line_statistics.sql, kept
+# current by src/stats.py whenever conversations are written.
+character_stats = sqlalchemy.Table(
+    "character_stats",
+    metadata_obj,
+    sqlalchemy.Column(
+        "character_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Characters.character_id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column(
+        "movie_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Movies.movie_id"),
+        nullable=False,
+    ),
+    sqlalchemy.Column(
+        "num_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "num_distinct_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    # from migrations/009_stats_versions.sql
+    sqlalchemy.Column(
+        "version", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "updated_at",
+        sqlalchemy.DateTime(timezone=True),
+        nullable=False,
+        server_default=sqlalchemy.func.now(),
+    ),
+)
+movie_stats = sqlalchemy.Table(
+    "movie_stats",
+    metadata_obj,
+    sqlalchemy.Column(
+        "movie_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Movies.movie_id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column(
+        "num_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "num_conversations", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    # from migrations/009_stats_versions.sql
+    sqlalchemy.Column(
+        "version", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "updated_at",
+        sqlalchemy.DateTime(timezone=True),
+        nullable=False,
+        server_default=sqlalchemy.func.now(),
+    ),
+)
+character_pair_stats = sqlalchemy.Table(
+    "character_pair_stats",
+    metadata_obj,
+    sqlalchemy.Column(
+        "character_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Characters.character_id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column(
+        "partner_id",
+        sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("Characters.character_id"),
+        primary_key=True,
+    ),
+    sqlalchemy.Column(
+        "num_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "num_conversations", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+)
+
+# Written by src/idempotency.py, from migrations/005_idempotency_keys.sql.
+idempotency_keys = sqlalchemy.Table(
+    "idempotency_keys",
+    metadata_obj,
+    sqlalchemy.Column("key", sqlalchemy.Text, primary_key=True),
+    sqlalchemy.Column("request_hash", sqlalchemy.Text, nullable=False),
+    sqlalchemy.Column("response", postgresql.JSONB),
+    sqlalchemy.Column(
+        "created_at",
+        sqlalchemy.DateTime(timezone=True),
+        nullable=False,
+        server_default=sqlalchemy.func.now(),
+    ),
+)
@@ -0,0 +1,71 @@
+import functools
+import json
+import os
+
+import dotenv
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# A faster way to send the read endpoints' JSON. By default FastAPI sends
+# what a handler returns by copying it with jsonable_encoder, which visits
+# every value to make it something json.dumps accepts, and then encoding the
+# copy with json.dumps. The handlers only ever return dicts, lists, strings,
+# numbers and None, so the copy is wasted work, and for a 250 row page it is
+# most of the time spent on the request. Handlers wrapped with `response`
+# instead encode their result to bytes once, with orjson when it is
+# installed, and send the bytes as they are.
+#
+# MOVIE_API_FAST_JSON selects the handlers that do this: "all" (the
+# default), "none", or a comma separated list of handler names such as
+# "list_characters,get_lines". Every other handler goes through FastAPI as
+# before, which makes it easy to compare the two.
+
+dotenv.load_dotenv()
+FAST_JSON = os.environ.get("MOVIE_API_FAST_JSON", "all")
+
+
+def dumps(value):
+    """Encodes `value` as compact UTF-8 JSON, the same as FastAPI would."""
+    if orjson is not None:
+        # ids keyed responses have integer keys, which JSON writes as strings
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def enabled(name):
+    if FAST_JSON == "all":
+        return True
+    if FAST_JSON == "none":
+        return False
+    return name in {route.strip() for route in FAST_JSON.split(",")}
+
+
+def response(endpoint):
+    """
+    Wraps an async handler so that, when enabled for it, its result is sent
+    as already encoded JSON. The status code and headers the handler set on
+    its `response` parameter, such as the caching validators, are kept.
+    Responses the handler returns itself, such as a 304, are sent unchanged.
+    """
+
+    @functools.wraps(endpoint)
+    async def encoded(*args, **kwargs):
+        content = await endpoint(*args, **kwargs)
+        if isinstance(content, Response) or not enabled(endpoint.__name__):
+            return content
+        sub_response = kwargs.get("response")
+        if sub_response is None:
+            return Response(dumps(content), media_type="application/json")
+        return Response(
+            dumps(content),
+            # FastAPI leaves it None unless the handler sets it
+            status_code=sub_response.status_code or 200,
+            media_type="application/json",
+            headers=sub_response.headers,
+        )
+
+    return encoded
@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import os
+import time
+from collections import deque
+
+import dotenv
+import sqlalchemy
+from src import database as db, http_cache, local
+
+# The character co-occurrence graph, held in memory for network queries.
+# Characters are vertices, and two characters are adjacent when they share a
+# conversation. adjacency[a][b] is a two item list: the number of lines a
+# speaks in conversations with b, and the number of conversations they share,
+# so the lines the pair speak together are adjacency[a][b][0] +
+# adjacency[b][a][0].
+#
+# The graph is built in bulk from character_pair_stats (or the local corpus)
+# on first use, and updated in place as conversations are added. Other
+# processes add conversations too, so every MOVIE_API_GRAPH_REFRESH_SECONDS
+# the version of the corpus is read, and the graph is rebuilt when it has
+# moved further than this process's own writes moved it. Set it to 0 to
+# never check.
+
+dotenv.load_dotenv()
+REFRESH_SECONDS = float(os.environ.get("MOVIE_API_GRAPH_REFRESH_SECONDS", "60"))
+
+
+class CharacterGraph:
+    def __init__(self):
+        self.names = {}
+        self.adjacency = {}
+
+    def add_character(self, character_id, name):
+        self.names[character_id] = name
+        self.adjacency.setdefault(character_id, {})
+
+    def add_edge(self, character_id, partner_id, num_lines, num_conversations):
+        """Adds counts to the edge in the direction character -> partner."""
+        edge = self.adjacency.setdefault(character_id, {}).setdefault(
+            partner_id, [0, 0]
+        )
+        edge[0] += num_lines
+        edge[1] += num_conversations
+
+    def add_conversations(self, conversations):
+        """Adds new conversations, mirroring stats.record_conversations."""
+        for conversation in conversations:
+            partners = {
+                conversation.character_1_id: conversation.character_2_id,
+                conversation.character_2_id: conversation.character_1_id,
+            }
+            for character_id, partner_id in partners.items():
+                self.add_edge(character_id, partner_id, 0, 1)
+            for line in conversation.lines:
+                self.add_edge(line.character_id, partners[line.character_id], 1, 0)
+
+    def lines_together(self, character_id, partner_id):
+        return (
+            self.adjacency[character_id][partner_id][0]
+            + self.adjacency[partner_id][character_id][0]
+        )
+
+    def partners(self, character_id, k):
+        """
+        The `k` characters `character_id` speaks the most lines with, as
+        (partner_id, lines together, conversations together) tuples.
+        """
+        edges = self.adjacency.get(character_id, {})
+        top = heapq.nsmallest(
+            k,
+            edges.items(),
+            key=lambda item: (
+                -self.lines_together(character_id, item[0]),
+                -item[1][1],
+                item[0],
+            ),
+        )
+        return [
+            (partner_id, self.lines_together(character_id, partner_id), edge[1])
+            for partner_id, edge in top
+        ]
+
+    def neighborhood(self, character_id, hops, limit):
+        """
+        The characters within `hops` conversations of `character_id`, as
+        (character_id, distance) pairs, closest first, at most `limit`.
+        """
+        distances = {character_id: 0}
+        frontier = [character_id]
+        for distance in range(1, hops + 1):
+            next_frontier = []
+            for vertex in frontier:
+                for neighbor in self.adjacency.get(vertex, ()):
+                    if neighbor not in distances:
+                        distances[neighbor] = distance
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        del distances[character_id]
+        neighbors = sorted(distances.items(), key=lambda item: (item[1], item[0]))
+        return neighbors[:limit]
+
+    def path(self, source, target):
+        """
+        The shortest chain of conversations from `source` to `target` as a
+        list of character ids including both ends, or None when the two are
+        not connected.
+        """
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            vertex = queue.popleft()
+            if vertex == target:
+                path = []
+                while vertex is not None:
+                    path.append(vertex)
+                    vertex = previous[vertex]
+                return path[::-1]
+            # neighbors are visited in id order so the path is deterministic
+            for neighbor in sorted(self.adjacency.get(vertex, ())):
+                if neighbor not in previous:
+                    previous[neighbor] = vertex
+                    queue.append(neighbor)
+        return None
+
+
+async def build():
+    graph = CharacterGraph()
+
+    if local.enabled():
+        corpus = local.corpus()
+        for row, character_id in enumerate(corpus.character_id):
+            graph.add_character(character_id, corpus.character_name[row])
+        for row in range(len(corpus.conversation_id)):
+            character1 = corpus.conversation_character1[row]
+            character2 = corpus.conversation_character2[row]
+            graph.add_edge(character1, character2, 0, 1)
+            graph.add_edge(character2, character1, 0, 1)
+        for row, conversation_id in enumerate(corpus.line_conversation):
+            conversation_row = corpus.conversation_row.get(conversation_id)
+            if conversation_row is None:
+                continue
+            character_id = corpus.line_character[row]
+            character1 = corpus.conversation_character1[conversation_row]
+            character2 = corpus.conversation_character2[conversation_row]
+            if character_id == character1:
+                graph.add_edge(character1, character2, 1, 0)
+            elif character_id == character2:
+                graph.add_edge(character2, character1, 1, 0)
+        return graph
+
+    characters = await db.fetch_all(
+        sqlalchemy.select(db.characters.c.character_id, db.characters.c.name)
+    )
+    for row in characters:
+        graph.add_character(row.character_id, row.name)
+
+    pairs = await db.fetch_all(
+        sqlalchemy.select(
+            db.character_pair_stats.c.character_id,
+            db.character_pair_stats.c.partner_id,
+            db.character_pair_stats.c.num_lines,
+            db.character_pair_stats.c.num_conversations,
+        )
+    )
+    for row in pairs:
+        graph.add_edge(
+            row.character_id, row.partner_id, row.num_lines, row.num_conversations
+        )
+    return graph
+
+
+async def corpus_version():
+    # the sum of the movies' versions, which each write of conversations
+    # moves up by one (see src/stats.py)
+    current = await http_cache.version("corpus")
+    return None if current is None else current[0]
+
+
+class GraphStore:
+    """
+    Builds the graph on first use and keeps it current. A write that lands
+    while the graph is being built may or may not be in what was read, so
+    the build is discarded and repeated.
+
+    One build runs at a time: requests that arrive during the first build
+    wait for it, and those that arrive during a rebuild get the previous
+    graph.
+    """
+
+    def __init__(
+        self,
+        build=build,
+        version=corpus_version,
+        interval=REFRESH_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.build = build
+        self.version = version
+        self.interval = interval
+        self.clock = clock
+        self.graph = None
+        self._graph_version = None
+        self._checked_at = None
+        self._generation = 0
+        self._building = None
+
+    async def get(self):
+        if self._building is not None:
+            if self.graph is None:
+                await self._building
+        elif self.graph is None or self._due():
+            self._building = asyncio.ensure_future(self._refresh())
+            try:
+                await self._building
+            finally:
+                self._building = None
+        return self.graph
+
+    def _due(self):
+        return self.interval > 0 and self.clock() - self._checked_at >= self.interval
+
+    async def _refresh(self):
+        self._checked_at = self.clock()
+        version = await self.version()
+        if self.graph is not None and version == self._graph_version:
+            return
+        while True:
+            generation = self._generation
+            graph = await self.build()
+            if generation == self._generation:
+                break
+            version = await self.version()
+        self.graph = graph
+        self._graph_version = version
+
+    def record_conversations(self, conversations):
+        """Call once per committed write, with the conversations it added."""
+        self._generation += 1
+        if self.graph is not None:
+            self.graph.add_conversations(conversations)
+            # the write moved the corpus version by one, and its edges are in
+            # the graph now, so the next check does not rebuild for it
+            if self._graph_version is not None:
+                self._graph_version += 1
+
+
+store = GraphStore()
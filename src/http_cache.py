@@ -0,0 +1,157 @@
+import email.utils
+import os
+import time
+
+import dotenv
+import sqlalchemy
+from fastapi import Request, Response
+
+from src import database as db, local, statements
+
+# Conditional GET support for the read endpoints. Each response carries an
+# ETag and Last-Modified derived from the version of the data it is built
+# from, read in a single row lookup before anything else, so a client or CDN
+# revalidating a copy that is still current gets an empty 304 without the
+# payload being computed at all.
+#
+# Versions live next to the counts in movie_stats and character_stats, and
+# the write that adds conversations bumps them in its own transaction (see
+# src/stats.py), so every process serves the same validators for the same
+# data and they survive restarts. The version is read before the data, so a
+# write in between can only make the response newer than its ETag, which
+# costs the client a 200 on its next revalidation but never a stale 304.
+#
+# MOVIE_API_CACHE_CONTROL sets the Cache-Control header of these responses.
+
+dotenv.load_dotenv()
+CACHE_CONTROL = os.environ.get(
+    "MOVIE_API_CACHE_CONTROL", "public, max-age=60, stale-while-revalidate=300"
+)
+
+
+@statements.prebuilt
+def version_statement(kind):
+    if kind == "movie":
+        return sqlalchemy.select(
+            db.movie_stats.c.version, db.movie_stats.c.updated_at
+        ).where(db.movie_stats.c.movie_id == sqlalchemy.bindparam("id"))
+    if kind == "character":
+        return sqlalchemy.select(
+            db.character_stats.c.version, db.character_stats.c.updated_at
+        ).where(db.character_stats.c.character_id == sqlalchemy.bindparam("id"))
+    if kind == "conversation":
+        # conversations never change once written, so the version of their
+        # movie, bumped by the write that added them, is a safe stand-in
+        return (
+            sqlalchemy.select(db.movie_stats.c.version, db.movie_stats.c.updated_at)
+            .select_from(
+                db.conversations.join(
+                    db.movie_stats,
+                    db.movie_stats.c.movie_id == db.conversations.c.movie_id,
+                )
+            )
+            .where(db.conversations.c.conversation_id == sqlalchemy.bindparam("id"))
+        )
+    if kind == "corpus":
+        # every write bumps one movie's version, so their sum changes with
+        # each commit in whatever order writers commit
+        return sqlalchemy.select(
+            sqlalchemy.func.sum(db.movie_stats.c.version),
+            sqlalchemy.func.max(db.movie_stats.c.updated_at),
+        ).having(sqlalchemy.func.count() > 0)
+    raise ValueError(f"unknown kind of data: {kind}")
+
+
+async def version(*key):
+    """
+    Returns (version, time of the last write) for the data `key` names, such
+    as ("movie", 44) or ("corpus",), or None when there is no such data.
+    """
+    if local.enabled():
+        # the local backend is read-only
+        return 0, local.corpus().modified_at
+    kind, *id = key
+    rows = await db.fetch_all(version_statement(kind), {"id": id[0]} if id else None)
+    if not rows:
+        return None
+    return int(rows[0][0]), rows[0][1].timestamp()
+
+
+def validators(key, version, modified_at):
+    """
+    The ETag, Last-Modified and Cache-Control headers for a response built
+    from `version` of the data `key` names. The ETag includes the time too,
+    so versions that start over in a reloaded database are told apart.
+    """
+    name = "-".join(str(part) for part in key)
+    return {
+        "ETag": f'"{name}-{version}-{int(modified_at * 1000):x}"',
+        "Last-Modified": email.utils.formatdate(modified_at, usegmt=True),
+        "Cache-Control": CACHE_CONTROL,
+    }
+
+
+def not_modified(request, headers):
+    """Whether the request's conditional headers match `headers`."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since and compares
+        # weakly, so a CDN's W/ prefix still matches
+        etag = headers["ETag"]
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip()
+            if candidate == "*" or candidate.removeprefix("W/") == etag:
+                return True
+        return False
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        last_modified = email.utils.parsedate_to_datetime(headers["Last-Modified"])
+        return last_modified <= since
+    return False
+
+
+def conditional_on(request: Request, response: Response, key, version, modified_at):
+    """
+    Sets the validators for `version` of `key` on `response`. Returns an
+    empty 304 response to send instead when the client's copy is current,
+    and None otherwise.
+    """
+    headers = validators(key, version, modified_at)
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+async def conditional(request: Request, response: Response, *key):
+    """
+    Like conditional_on, for the current version of the data `key` names.
+    Data that does not exist gets no validators, and its handler the 404.
+    """
+    not_modified, _ = await conditional_version(request, response, *key)
+    return not_modified
+
+
+async def conditional_version(request: Request, response: Response, *key):
+    """
+    Like conditional, but returns a (not_modified, version) pair, where
+    `version` is what `version(*key)` returned, for caching the response
+    under the version its validators name.
+    """
+    current = await version(*key)
+    if current is None:
+        return None, None
+    not_modified = conditional_on(request, response, key, *current)
+    if not_modified:
+        return not_modified, current
+
+    # data written moments ago may not have reached every replica, and must
+    # not be served, or cached, under its new validators
+    if time.time() - current[1] < db.READ_YOUR_WRITES_SECONDS:
+        db.use_primary()
+    return None, current
@@ -0,0 +1,137 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+
+import dotenv
+import sqlalchemy
+from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import insert
+from src import database as db
+
+# Idempotency keys for the write endpoints. A client sends a unique
+# Idempotency-Key header with a write, and sends the same key again when it
+# retries. The first request to commit stores its response under the key;
+# later requests with that key get the stored response back without writing
+# anything. Keys are claimed in the same transaction as the write, so a key
+# is stored if and only if the write committed.
+#
+# Keys can be reused for a different request once they are older than
+# IDEMPOTENCY_KEY_TTL_HOURS. Expired keys are deleted in batches after a
+# write that used a key, at most once every IDEMPOTENCY_KEY_PURGE_SECONDS
+# per process. Set it to 0 to purge from a cron job instead, with
+# DELETE FROM idempotency_keys WHERE created_at < now() - interval '24 hours'.
+
+dotenv.load_dotenv()
+KEY_TTL = datetime.timedelta(
+    hours=float(os.environ.get("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+)
+PURGE_SECONDS = float(os.environ.get("IDEMPOTENCY_KEY_PURGE_SECONDS", "600"))
+PURGE_BATCH_SIZE = 1000
+MAX_KEY_LENGTH = 255
+
+logger = logging.getLogger(__name__)
+
+
+def request_hash(method, path, body):
+    """A fingerprint of a request, to tell retries apart from key reuse."""
+    payload = json.dumps([method, path, body], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def run(conn, key, fingerprint, fn, *args):
+    """
+    Calls `fn(conn, *args)` unless `key` has already been used, and returns
+    a (response, replayed) pair. Must be called inside the write's
+    transaction. A concurrent request with the same key waits on the claim
+    until this transaction ends, and then sees the stored response, or at
+    SERIALIZABLE fails and is retried by db.write_transaction.
+    """
+    claim_stmt = insert(db.idempotency_keys).values(key=key, request_hash=fingerprint)
+    claimed = conn.execute(
+        claim_stmt.on_conflict_do_update(
+            index_elements=[db.idempotency_keys.c.key],
+            set_={
+                "request_hash": claim_stmt.excluded.request_hash,
+                "response": None,
+                "created_at": sqlalchemy.func.now(),
+            },
+            where=db.idempotency_keys.c.created_at < sqlalchemy.func.now() - KEY_TTL,
+        ).returning(db.idempotency_keys.c.key)
+    ).first()
+
+    if claimed is None:
+        stored = conn.execute(
+            sqlalchemy.select(
+                db.idempotency_keys.c.request_hash, db.idempotency_keys.c.response
+            ).where(db.idempotency_keys.c.key == key)
+        ).one()
+        if stored.request_hash != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was already used for a different request",
+            )
+        return stored.response, True
+
+    response = fn(conn, *args)
+    conn.execute(
+        sqlalchemy.update(db.idempotency_keys)
+        .where(db.idempotency_keys.c.key == key)
+        .values(response=response)
+    )
+    return response, False
+
+
+def purge(conn, limit=PURGE_BATCH_SIZE):
+    """
+    Deletes up to `limit` of the oldest expired keys and returns how many
+    were deleted. Keys locked by a concurrent claim or purge are skipped.
+    """
+    expired = (
+        sqlalchemy.select(db.idempotency_keys.c.key)
+        .where(db.idempotency_keys.c.created_at < sqlalchemy.func.now() - KEY_TTL)
+        .order_by(db.idempotency_keys.c.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    return conn.execute(
+        sqlalchemy.delete(db.idempotency_keys).where(
+            db.idempotency_keys.c.key.in_(expired)
+        )
+    ).rowcount
+
+
+class Purger:
+    """Runs purge in a transaction of its own every `interval` seconds."""
+
+    def __init__(self, interval=PURGE_SECONDS, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.purged_at = None
+
+    async def maybe_purge(self):
+        if self.interval <= 0:
+            return
+        now = self.clock()
+        if self.purged_at is not None and now - self.purged_at < self.interval:
+            return
+        self.purged_at = now
+        try:
+            await db.write_transaction(purge)
+        except Exception as error:
+            # the write it follows has committed, so it must not fail now
+            logger.warning("purging expired idempotency keys failed: %r", error)
+
+
+purger = Purger()
+
+
+def validate_key(key):
+    if key is not None and not 0 < len(key) <= MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Idempotency-Key must be between 1 and {MAX_KEY_LENGTH} characters",
+        )
@@ -0,0 +1,351 @@
+import asyncio
+import collections
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import dotenv
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+# Write-behind ingestion of conversations. A write sent with
+# `Prefer: respond-async` is validated, stored as a job in a local SQLite
+# queue and answered with 202 straight away. A pool of background workers
+# takes queued jobs in order and writes as many of them as fit in
+# MOVIE_API_INGEST_BATCH_SIZE conversations in one transaction, so a burst
+# of small writes turns into a few large ones instead of holding a database
+# connection per request.
+#
+# The queue survives restarts: a job is leased to the worker that claims it
+# for MOVIE_API_INGEST_LEASE_SECONDS, which must be longer than a batch takes
+# to write, and a job whose lease runs out, because its process stopped, is
+# queued again. Each job is written together with an idempotency key (see
+# src/idempotency.py) so a job that had in fact been committed is not written
+# twice. That is the request's own Idempotency-Key when it sent one, so a
+# retry of the request that is written during its request, or queued again,
+# gets the same conversations instead of new ones.
+#
+# MOVIE_API_INGEST_WORKERS sets the number of workers. With the default of 0
+# there is no queue and every write is made during its request.
+
+dotenv.load_dotenv()
+QUEUE_PATH = os.environ.get("MOVIE_API_INGEST_QUEUE", "ingest_queue.sqlite3")
+WORKERS = int(os.environ.get("MOVIE_API_INGEST_WORKERS", "0"))
+BATCH_SIZE = int(os.environ.get("MOVIE_API_INGEST_BATCH_SIZE", "500"))
+MAX_ATTEMPTS = int(os.environ.get("MOVIE_API_INGEST_ATTEMPTS", "3"))
+RETENTION = datetime.timedelta(
+    hours=float(os.environ.get("MOVIE_API_INGEST_RETENTION_HOURS", "24"))
+)
+LEASE_SECONDS = float(os.environ.get("MOVIE_API_INGEST_LEASE_SECONDS", "300"))
+POLL_INTERVAL = 1.0
+
+Job = collections.namedtuple(
+    "Job",
+    ["job_id", "movie_id", "conversations", "idempotency_key", "request_hash"],
+)
+
+
+def enabled():
+    return WORKERS > 0
+
+
+def respond_async(prefer):
+    """Whether a Prefer header asks for the request to be processed later."""
+    if prefer is None:
+        return False
+    preferences = {
+        preference.split("=")[0].strip().lower() for preference in prefer.split(",")
+    }
+    return "respond-async" in preferences
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+
+class JobQueue:
+    """
+    A durable first-in first-out queue of jobs in an SQLite database. Every
+    method commits before returning, and claims are made in an immediate
+    transaction, so several processes may share one queue file.
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL UNIQUE,
+                    idempotency_key TEXT UNIQUE,
+                    request_hash TEXT,
+                    movie_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    num_conversations INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    conversation_ids TEXT,
+                    error TEXT,
+                    submitted_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status_seq ON jobs (status, seq)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def enqueue(self, movie_id, conversations, idempotency_key=None, fingerprint=None):
+        """
+        Queues `conversations`, a list of dicts, for `movie_id` and returns
+        the job id. A job that was already queued with the same idempotency
+        key is returned instead of queueing another.
+        """
+        now = self.clock()
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                """
+                INSERT INTO jobs (job_id, idempotency_key, request_hash, movie_id,
+                                  payload, num_conversations, status, submitted_at,
+                                  updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)
+                ON CONFLICT (idempotency_key) DO NOTHING
+                """,
+                (
+                    job_id,
+                    idempotency_key,
+                    fingerprint,
+                    movie_id,
+                    json.dumps(conversations),
+                    len(conversations),
+                    now,
+                    now,
+                ),
+            )
+            if idempotency_key is None:
+                return job_id
+            stored = conn.execute(
+                "SELECT job_id, request_hash FROM jobs WHERE idempotency_key = ?",
+                (idempotency_key,),
+            ).fetchone()
+        if stored["request_hash"] != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was already used for a different request",
+            )
+        return stored["job_id"]
+
+    def claim(self, batch_size):
+        """
+        Marks the oldest queued jobs as running and returns them: as many as
+        fit in `batch_size` conversations, and at least one. A running job's
+        updated_at is when it was claimed, which starts its lease.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT job_id, movie_id, payload, num_conversations, "
+                    "idempotency_key, request_hash FROM jobs "
+                    "WHERE status = 'queued' ORDER BY seq LIMIT ?",
+                    (batch_size,),
+                ).fetchall()
+                jobs = []
+                total = 0
+                for row in rows:
+                    if jobs and total + row["num_conversations"] > batch_size:
+                        break
+                    total += row["num_conversations"]
+                    jobs.append(
+                        Job(
+                            row["job_id"],
+                            row["movie_id"],
+                            json.loads(row["payload"]),
+                            row["idempotency_key"],
+                            row["request_hash"],
+                        )
+                    )
+                conn.executemany(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                    "updated_at = ? WHERE job_id = ?",
+                    [(self.clock(), job.job_id) for job in jobs],
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return jobs
+
+    def complete(self, conversation_ids):
+        """Records the new conversation ids of finished jobs, keyed by job id."""
+        with self._lock:
+            self._connection().executemany(
+                "UPDATE jobs SET status = 'done', conversation_ids = ?, error = NULL, "
+                "updated_at = ? WHERE job_id = ?",
+                [
+                    (json.dumps(ids), self.clock(), job_id)
+                    for job_id, ids in conversation_ids.items()
+                ],
+            )
+
+    def release(self, job_id, error):
+        """Queues a job whose write failed again, or fails it once out of attempts."""
+        with self._lock:
+            self._connection().execute(
+                "UPDATE jobs "
+                "SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                "error = ?, updated_at = ? WHERE job_id = ?",
+                (MAX_ATTEMPTS, error, self.clock(), job_id),
+            )
+
+    def recover(self):
+        """
+        Queues jobs left running by a process that stopped mid-write: those
+        claimed over LEASE_SECONDS ago. Jobs other processes are writing
+        now are left alone.
+        """
+        now = self.clock()
+        with self._lock:
+            self._connection().execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? "
+                "WHERE status = 'running' AND updated_at < ?",
+                (now, now - LEASE_SECONDS),
+            )
+
+    def purge(self):
+        """Forgets finished jobs older than MOVIE_API_INGEST_RETENTION_HOURS."""
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM jobs "
+                "WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (self.clock() - RETENTION.total_seconds(),),
+            )
+
+    def status(self, job_id):
+        """Describes a job, or returns None for an unknown job id."""
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            ahead = None
+            if row["status"] == "queued":
+                ahead = conn.execute(
+                    "SELECT count(*) FROM jobs WHERE status = 'queued' AND seq < ?",
+                    (row["seq"],),
+                ).fetchone()[0]
+
+        status = {
+            "job_id": row["job_id"],
+            "movie_id": row["movie_id"],
+            "status": row["status"],
+            "number_of_conversations": row["num_conversations"],
+            "attempts": row["attempts"],
+            "submitted_at": timestamp(row["submitted_at"]),
+            "updated_at": timestamp(row["updated_at"]),
+        }
+        if ahead is not None:
+            status["jobs_ahead"] = ahead
+        if row["conversation_ids"] is not None:
+            status["conversation_ids"] = json.loads(row["conversation_ids"])
+        if row["error"] is not None:
+            status["error"] = row["error"]
+        return status
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class WorkerPool:
+    """
+    Background tasks that take batches of jobs off `queue` and pass them to
+    `process`, a coroutine function that writes a list of jobs and returns
+    the new conversation ids of each, keyed by job id.
+    """
+
+    def __init__(self, queue, process, workers=WORKERS, batch_size=BATCH_SIZE):
+        self.queue = queue
+        self.process = process
+        self.workers = workers
+        self.batch_size = batch_size
+        self._tasks = []
+        self._wakeup = None
+        self._stopping = False
+
+    def start(self):
+        self.queue.recover()
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Lets the workers finish the batch they are writing, then stops them."""
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+    def notify(self):
+        """Wakes idle workers after a job was queued."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._stopping:
+            # cleared before claiming so a job queued meanwhile still wakes us
+            self._wakeup.clear()
+            jobs = await run_in_threadpool(self.queue.claim, self.batch_size)
+            if jobs:
+                await self._write(jobs)
+                continue
+            await run_in_threadpool(self.queue.recover)
+            await run_in_threadpool(self.queue.purge)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _write(self, jobs):
+        try:
+            conversation_ids = await self.process(jobs)
+        except Exception as error:
+            if len(jobs) > 1:
+                # write the jobs one by one so that a bad job does not hold
+                # back the rest of the batch
+                for job in jobs:
+                    await self._write([job])
+                return
+            await run_in_threadpool(self.queue.release, jobs[0].job_id, repr(error))
+            return
+        await run_in_threadpool(self.queue.complete, conversation_ids)
+
+
+queue = JobQueue(QUEUE_PATH)
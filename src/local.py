@@ -0,0 +1,512 @@
+import csv
+import functools
+import os
+import pathlib
+from array import array
+from collections import Counter, defaultdict
+
+import dotenv
+from src import search
+
+# An in-memory backend that serves the read endpoints from the CSV files
+# bundled with the repository, with no database. Select it with
+# MOVIE_API_BACKEND=local; MOVIE_API_DATA_DIR points at a different directory
+# of CSVs. The repository ships movies.csv, characters.csv and
+# conversations.csv. Line data is read from a lines.csv with the columns of
+# the Lines table when one is present, and is empty otherwise.
+#
+# Each table is stored column by column in typed arrays, with dictionaries
+# indexing rows by id, by movie, by character and by character pair. Every
+# method returns exactly what the matching endpoint returns, or None where the
+# endpoint would return a 404.
+
+DEFAULT_DATA_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+
+@functools.lru_cache(maxsize=None)
+def enabled():
+    dotenv.load_dotenv()
+    return os.environ.get("MOVIE_API_BACKEND", "postgres") == "local"
+
+
+@functools.lru_cache(maxsize=None)
+def corpus():
+    dotenv.load_dotenv()
+    return LocalCorpus(os.environ.get("MOVIE_API_DATA_DIR", DEFAULT_DATA_DIR))
+
+
+def read_csv(path):
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def optional_int(value):
+    return int(value) if value != "" else None
+
+
+def optional_str(value):
+    return value if value != "" else None
+
+
+def word_count(text):
+    """Mirrors the word_count column of migrations/004_line_word_counts.sql."""
+    return len(text.split())
+
+
+def after(key, id, position, descending):
+    """Mirrors pagination.after for rows held in memory."""
+    cursor_key, cursor_id = position
+    if key == cursor_key:
+        return id > cursor_id
+    return key < cursor_key if descending else key > cursor_key
+
+
+class LocalCorpus:
+    def __init__(self, data_dir):
+        data_dir = pathlib.Path(data_dir)
+        # the time the data last changed, for the caching validators
+        self.modified_at = max(
+            (path.stat().st_mtime for path in data_dir.glob("*.csv")), default=0.0
+        )
+
+        movies = read_csv(data_dir / "movies.csv")
+        self.movie_id = array("i", (int(row["movie_id"]) for row in movies))
+        self.movie_title = [row["title"] for row in movies]
+        self.movie_year = [optional_str(row["year"]) for row in movies]
+        self.movie_rating = array(
+            "d", (float(row["imdb_rating"] or "nan") for row in movies)
+        )
+        self.movie_votes = array("i", (int(row["imdb_votes"] or 0) for row in movies))
+        self.movie_row = {id: row for row, id in enumerate(self.movie_id)}
+
+        characters = read_csv(data_dir / "characters.csv")
+        self.character_id = array("i", (int(row["character_id"]) for row in characters))
+        self.character_name = [row["name"] for row in characters]
+        self.character_movie = array("i", (int(row["movie_id"]) for row in characters))
+        self.character_gender = [optional_str(row["gender"]) for row in characters]
+        self.character_row = {id: row for row, id in enumerate(self.character_id)}
+        self.characters_by_movie = defaultdict(list)
+        for row, movie_id in enumerate(self.character_movie):
+            self.characters_by_movie[movie_id].append(row)
+
+        conversations = read_csv(data_dir / "conversations.csv")
+        self.conversation_id = array(
+            "i", (int(row["conversation_id"]) for row in conversations)
+        )
+        self.conversation_character1 = array(
+            "i", (int(row["character1_id"]) for row in conversations)
+        )
+        self.conversation_character2 = array(
+            "i", (int(row["character2_id"]) for row in conversations)
+        )
+        self.conversation_movie = array(
+            "i", (int(row["movie_id"]) for row in conversations)
+        )
+        self.conversation_row = {id: row for row, id in enumerate(self.conversation_id)}
+        self.conversations_by_character = defaultdict(list)
+        self.conversations_by_pair = defaultdict(list)
+        self.conversations_by_movie = defaultdict(list)
+        for row in range(len(self.conversation_id)):
+            self.conversations_by_movie[self.conversation_movie[row]].append(row)
+            character1 = self.conversation_character1[row]
+            character2 = self.conversation_character2[row]
+            self.conversations_by_character[character1].append(row)
+            if character2 != character1:
+                self.conversations_by_character[character2].append(row)
+            self.conversations_by_pair[
+                (min(character1, character2), max(character1, character2))
+            ].append(row)
+
+        lines = read_csv(data_dir / "lines.csv")
+        lines.sort(key=lambda row: int(row["line_id"]))
+        self.line_character = array("i", (int(row["character_id"]) for row in lines))
+        self.line_conversation = array(
+            "i", (int(row["conversation_id"]) for row in lines)
+        )
+        self.line_sort = array("i", (int(row["line_sort"]) for row in lines))
+        self.line_text = [row["line_text"] for row in lines]
+        self.line_words = array("i", (word_count(text) for text in self.line_text))
+        self.lines_by_character = defaultdict(list)
+        self.lines_by_conversation = defaultdict(list)
+        for row in range(len(self.line_text)):
+            self.lines_by_character[self.line_character[row]].append(row)
+            self.lines_by_conversation[self.line_conversation[row]].append(row)
+        # each character's lines are kept longest first, like the
+        # lines_character_word_count_idx index; the sort is stable, so ties
+        # stay in line id order
+        for rows in self.lines_by_character.values():
+            rows.sort(
+                key=lambda row: (-self.line_words[row], -len(self.line_text[row]))
+            )
+
+        # the same counts the statistics tables hold
+        self.num_lines = Counter(
+            {id: len(rows) for id, rows in self.lines_by_character.items()}
+        )
+        self.num_distinct_lines = Counter(
+            {
+                id: len({self.line_text[row] for row in rows})
+                for id, rows in self.lines_by_character.items()
+            }
+        )
+
+    # movies
+
+    def movie(self, movie_id):
+        row = self.movie_row.get(movie_id)
+        if row is None:
+            return None
+        speakers = [
+            character_row
+            for character_row in self.characters_by_movie[movie_id]
+            if self.num_lines[self.character_id[character_row]] > 0
+        ]
+        speakers.sort(
+            key=lambda character_row: (
+                -self.num_lines[self.character_id[character_row]],
+                self.character_id[character_row],
+            )
+        )
+        return {
+            "movie_id": movie_id,
+            "title": self.movie_title[row],
+            "top_characters": [
+                {
+                    "character_id": self.character_id[character_row],
+                    "character": self.character_name[character_row],
+                    "num_lines": self.num_lines[self.character_id[character_row]],
+                }
+                for character_row in speakers[:5]
+            ],
+        }
+
+    def movie_counts(self, movie_id):
+        """The num_lines and num_conversations movie_stats holds for a movie."""
+        rows = self.conversations_by_movie[movie_id]
+        num_lines = sum(
+            len(self.lines_by_conversation[self.conversation_id[row]]) for row in rows
+        )
+        return num_lines, len(rows)
+
+    def movie_summary(self, row):
+        return {
+            "movie_id": self.movie_id[row],
+            "movie_title": self.movie_title[row],
+            "year": self.movie_year[row],
+            "imdb_rating": self.movie_rating[row],
+            "imdb_votes": self.movie_votes[row],
+        }
+
+    def movies(self, name, sort_key, descending, limit, offset=0, position=None):
+        """
+        Lists movies like /movies/. `sort_key` is a key of the returned movies
+        and `position` is a decoded cursor.
+        """
+        columns = {
+            "movie_title": self.movie_title,
+            "year": self.movie_year,
+            "imdb_rating": self.movie_rating,
+        }
+        column = columns[sort_key]
+        pattern = search.like_pattern(f"%{name}%")
+        rows = [
+            row
+            for row in range(len(self.movie_id))
+            if pattern.fullmatch(self.movie_title[row])
+            and (
+                position is None
+                or after(column[row], self.movie_id[row], position, descending)
+            )
+        ]
+        rows.sort(key=lambda row: self.movie_id[row])
+        rows.sort(key=lambda row: column[row], reverse=descending)
+        return [self.movie_summary(row) for row in rows[offset : offset + limit]]
+
+    # characters
+
+    def character(self, id):
+        row = self.character_row.get(id)
+        if row is None or self.character_movie[row] not in self.movie_row:
+            return None
+        # the character's lines in conversations they are part of, grouped
+        # by the other character, like character_pair_stats
+        together = Counter()
+        for line_row in self.lines_by_character[id]:
+            conversation_row = self.conversation_row.get(
+                self.line_conversation[line_row]
+            )
+            if conversation_row is not None:
+                character1 = self.conversation_character1[conversation_row]
+                character2 = self.conversation_character2[conversation_row]
+                together[character2 if character1 == id else character1] += 1
+        top_conversations = []
+        for partner_id, count in sorted(
+            together.items(), key=lambda item: (-item[1], item[0])
+        ):
+            partner_row = self.character_row.get(partner_id)
+            if partner_row is not None:
+                top_conversations.append(
+                    {
+                        "character_id": partner_id,
+                        "character": self.character_name[partner_row],
+                        "gender": self.character_gender[partner_row],
+                        "number_of_lines_together": count,
+                    }
+                )
+        return {
+            "character_id": id,
+            "character": self.character_name[row],
+            "movie": self.movie_title[self.movie_row[self.character_movie[row]]],
+            "gender": self.character_gender[row],
+            "top_conversations": top_conversations,
+        }
+
+    def characters(self, name, sort_key, descending, limit, offset=0, position=None):
+        """
+        Lists characters like /characters/. `sort_key` is a key of the
+        returned characters and `position` is a decoded cursor.
+        """
+        pattern = search.like_pattern(f"%{name}%")
+        results = []
+        for row in range(len(self.character_id)):
+            movie_row = self.movie_row.get(self.character_movie[row])
+            if movie_row is None or not pattern.fullmatch(self.character_name[row]):
+                continue
+            id = self.character_id[row]
+            results.append(
+                {
+                    "character_id": id,
+                    "character": self.character_name[row],
+                    "movie": self.movie_title[movie_row],
+                    "number_of_lines": self.num_distinct_lines[id],
+                }
+            )
+        if position is not None:
+            results = [
+                result
+                for result in results
+                if after(result[sort_key], result["character_id"], position, descending)
+            ]
+        results.sort(key=lambda result: result["character_id"])
+        results.sort(key=lambda result: result[sort_key], reverse=descending)
+        return results[offset : offset + limit]
+
+    # lines
+
+    def character_lines(self, character_id, limit=None, offset=0):
+        """The character's lines, most words first, like /lines/{character_id}."""
+        row = self.character_row.get(character_id)
+        if row is None:
+            return None
+        line_rows = self.lines_by_character[character_id]
+        end = None if limit is None else offset + limit
+        return {
+            "character": self.character_name[row],
+            "lines": [self.line_text[line_row] for line_row in line_rows[offset:end]],
+        }
+
+    def character_conversations(
+        self, character_id, limit=None, after=None, preview=None
+    ):
+        """
+        The character's conversations in id order, like
+        /lines/{char_id}/conversations: up to `limit` of them with ids above
+        `after`, as ids, or when `preview` is given, as conversations with
+        their partner and first `preview` lines.
+        """
+        row = self.character_row.get(character_id)
+        if row is None:
+            return None
+        conversation_rows = sorted(
+            self.conversations_by_character[character_id],
+            key=lambda conversation_row: self.conversation_id[conversation_row],
+        )
+        if after is not None:
+            conversation_rows = [
+                conversation_row
+                for conversation_row in conversation_rows
+                if self.conversation_id[conversation_row] > after
+            ]
+        conversation_rows = conversation_rows[:limit]
+        if preview is None:
+            conversations = [
+                self.conversation_id[conversation_row]
+                for conversation_row in conversation_rows
+            ]
+        else:
+            conversations = [
+                self.conversation_preview(conversation_row, character_id, preview)
+                for conversation_row in conversation_rows
+            ]
+        return {"character": self.character_name[row], "conversations": conversations}
+
+    def conversation_preview(self, conversation_row, character_id, preview):
+        conversation_id = self.conversation_id[conversation_row]
+        partner_id = self.conversation_character2[conversation_row]
+        if partner_id == character_id:
+            partner_id = self.conversation_character1[conversation_row]
+        partner_row = self.character_row[partner_id]
+        line_rows = sorted(
+            self.lines_by_conversation[conversation_id],
+            key=lambda line_row: self.line_sort[line_row],
+        )
+        return {
+            "conversation_id": conversation_id,
+            "partner": {
+                "character_id": partner_id,
+                "character": self.character_name[partner_row],
+                "gender": self.character_gender[partner_row],
+            },
+            "lines": [
+                {
+                    "character_id": self.line_character[line_row],
+                    "line_text": self.line_text[line_row],
+                }
+                for line_row in line_rows[:preview]
+            ],
+        }
+
+    def name_of(self, character_id):
+        row = self.character_row.get(character_id)
+        return None if row is None else self.character_name[row]
+
+    def conversation_lines(self, conversation_id):
+        """A conversation's lines in the order they were spoken."""
+        line_rows = sorted(
+            self.lines_by_conversation[conversation_id],
+            key=lambda line_row: self.line_sort[line_row],
+        )
+        return [
+            {
+                "line_sort": self.line_sort[line_row],
+                "character_id": self.line_character[line_row],
+                "character": self.name_of(self.line_character[line_row]),
+                "line_text": self.line_text[line_row],
+            }
+            for line_row in line_rows
+        ]
+
+    def conversation(self, conversation_id):
+        """A conversation and its transcript, like /conversations/{conversation_id}."""
+        row = self.conversation_row.get(conversation_id)
+        if row is None:
+            return None
+        movie_id = self.conversation_movie[row]
+        characters = []
+        for character_id in (
+            self.conversation_character1[row],
+            self.conversation_character2[row],
+        ):
+            characters.append(
+                {
+                    "character_id": character_id,
+                    "character": self.name_of(character_id),
+                }
+            )
+        return {
+            "conversation_id": conversation_id,
+            "movie_id": movie_id,
+            "movie": self.movie_title[self.movie_row[movie_id]],
+            "characters": characters,
+            "lines": self.conversation_lines(conversation_id),
+        }
+
+    def movie_script(self, movie_id):
+        """Every line of a movie, like /movies/{movie_id}/script."""
+        row = self.movie_row.get(movie_id)
+        if row is None:
+            return None
+        conversation_ids = sorted(
+            self.conversation_id[conversation_row]
+            for conversation_row in self.conversations_by_movie[movie_id]
+        )
+        lines = []
+        for conversation_id in conversation_ids:
+            for line in self.conversation_lines(conversation_id):
+                lines.append({"conversation_id": conversation_id, **line})
+        return {"movie_id": movie_id, "title": self.movie_title[row], "lines": lines}
+
+    # search
+
+    def search_movies(self, q, fuzzy, limit):
+        results = []
+        for row in range(len(self.movie_id)):
+            title = self.movie_title[row]
+            if fuzzy:
+                score = search.word_similarity(q, title)
+                if score < search.WORD_SIMILARITY_THRESHOLD:
+                    continue
+            elif q.lower() in title.lower():
+                score = search.similarity(title, q)
+            else:
+                continue
+            results.append(
+                {
+                    "movie_id": self.movie_id[row],
+                    "movie_title": title,
+                    "year": self.movie_year[row],
+                    "score": score,
+                }
+            )
+        results.sort(
+            key=lambda result: (
+                -result["score"],
+                result["movie_title"],
+                result["movie_id"],
+            )
+        )
+        return results[:limit]
+
+    def search_characters(self, q, fuzzy, limit):
+        results = []
+        for row in range(len(self.character_id)):
+            name = self.character_name[row]
+            movie_row = self.movie_row.get(self.character_movie[row])
+            if movie_row is None:
+                continue
+            if fuzzy:
+                score = search.word_similarity(q, name)
+                if score < search.WORD_SIMILARITY_THRESHOLD:
+                    continue
+            elif q.lower() in name.lower():
+                score = search.similarity(name, q)
+            else:
+                continue
+            results.append(
+                {
+                    "character_id": self.character_id[row],
+                    "character": name,
+                    "movie": self.movie_title[movie_row],
+                    "score": score,
+                }
+            )
+        results.sort(
+            key=lambda result: (
+                -result["score"],
+                result["character"],
+                result["character_id"],
+            )
+        )
+        return results[:limit]
+
+    def autocomplete(self, prefix, kind, limit):
+        if kind == "movies":
+            ids, names = self.movie_id, self.movie_title
+        else:
+            ids, names = self.character_id, self.character_name
+        prefix = prefix.lower()
+        suggestions = [
+            {"id": ids[row], "name": names[row]}
+            for row in range(len(ids))
+            if names[row].lower().startswith(prefix)
+        ]
+        suggestions.sort(
+            key=lambda suggestion: (
+                len(suggestion["name"]),
+                suggestion["name"],
+                suggestion["id"],
+            )
+        )
+        return suggestions[:limit]
@@ -0,0 +1,404 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+
+import dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+
+# Request-level instrumentation. MetricsMiddleware times every request and
+# attributes it to the route that served it, while engine events count the
+# statements each request executes and the time they spend in the database.
+# The database helpers report how long they waited for a pooled connection.
+# Everything is exposed at /metrics in the Prometheus text format.
+#
+# Statements are also counted by whether SQLAlchemy found their compiled SQL
+# in its cache, which shows how well prebuilt statements (src/statements.py)
+# are being reused.
+#
+# Set MOVIE_API_SLOW_QUERY_MS to log every statement slower than that many
+# milliseconds, with its SQL and parameters.
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def slow_query_threshold():
+    """Seconds after which a statement is logged, or None when disabled."""
+    dotenv.load_dotenv()
+    value = os.environ.get("MOVIE_API_SLOW_QUERY_MS")
+    return float(value) / 1000 if value else None
+
+
+SLOW_QUERY_THRESHOLD = slow_query_threshold()
+
+
+class Histogram:
+    """Cumulative bucket counts plus a running sum, as Prometheus expects."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates the `q` quantile by interpolating within its bucket, the
+        same way Prometheus' histogram_quantile does.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class RequestStats:
+    """Database activity of a single request."""
+
+    __slots__ = ("statements", "db_seconds", "pool_wait_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+
+
+# The stats object of the request being served. Threadpool workers and
+# asyncpg's greenlets run with a copy of the request's context, which still
+# refers to the same object, so they can add to it.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.responses = {}
+
+
+class Registry:
+    def __init__(self):
+        self.routes = {}
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.slow_queries = 0
+        self.compiled_cache = {"hit": 0, "miss": 0, "uncached": 0}
+        self._lock = threading.Lock()
+
+    def record_request(self, method, route, status, seconds, stats):
+        with self._lock:
+            metrics = self.routes.get((method, route))
+            if metrics is None:
+                metrics = self.routes[(method, route)] = RouteMetrics()
+            metrics.latency.observe(seconds)
+            metrics.statements.observe(stats.statements)
+            metrics.db_seconds += stats.db_seconds
+            metrics.pool_wait_seconds += stats.pool_wait_seconds
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+
+    def record_statement(self, seconds, slow, cache_result):
+        with self._lock:
+            self.statements += 1
+            self.db_seconds += seconds
+            if slow:
+                self.slow_queries += 1
+            self.compiled_cache[cache_result] += 1
+
+    def compiled_cache_stats(self):
+        with self._lock:
+            hits, misses = self.compiled_cache["hit"], self.compiled_cache["miss"]
+            return {
+                "hits": hits,
+                "misses": misses,
+                "uncached": self.compiled_cache["uncached"],
+                "hit_rate": hits / (hits + misses) if hits + misses else None,
+            }
+
+    def summary(self):
+        """Per-route percentiles and database totals, for humans."""
+        with self._lock:
+            return [
+                {
+                    "method": method,
+                    "route": route,
+                    "requests": metrics.latency.count,
+                    "p50_ms": quantile_ms(metrics.latency, 0.5),
+                    "p95_ms": quantile_ms(metrics.latency, 0.95),
+                    "p99_ms": quantile_ms(metrics.latency, 0.99),
+                    "statements_per_request": (
+                        metrics.statements.sum / metrics.statements.count
+                    ),
+                    "db_ms_per_request": (
+                        metrics.db_seconds * 1000 / metrics.latency.count
+                    ),
+                    "pool_wait_ms_per_request": (
+                        metrics.pool_wait_seconds * 1000 / metrics.latency.count
+                    ),
+                }
+                for (method, route), metrics in sorted(
+                    self.routes.items(), key=lambda item: item[0][::-1]
+                )
+            ]
+
+    def render(self):
+        """The registry in the Prometheus text exposition format."""
+        out = []
+        with self._lock:
+            routes = sorted(self.routes.items(), key=lambda item: item[0][::-1])
+
+            out.append(
+                "# HELP movie_api_request_duration_seconds Request latency by route."
+            )
+            out.append("# TYPE movie_api_request_duration_seconds histogram")
+            for (method, route), metrics in routes:
+                render_histogram(
+                    out,
+                    "movie_api_request_duration_seconds",
+                    labels(method, route),
+                    metrics.latency,
+                )
+
+            out.append(
+                "# HELP movie_api_request_statements "
+                "Statements executed per request by route."
+            )
+            out.append("# TYPE movie_api_request_statements histogram")
+            for (method, route), metrics in routes:
+                render_histogram(
+                    out,
+                    "movie_api_request_statements",
+                    labels(method, route),
+                    metrics.statements,
+                )
+
+            out.append(
+                "# HELP movie_api_request_db_seconds_total "
+                "Time spent executing statements by route."
+            )
+            out.append("# TYPE movie_api_request_db_seconds_total counter")
+            for (method, route), metrics in routes:
+                out.append(
+                    f"movie_api_request_db_seconds_total{{{labels(method, route)}}} "
+                    f"{metrics.db_seconds}"
+                )
+
+            out.append(
+                "# HELP movie_api_request_pool_wait_seconds_total "
+                "Time spent waiting for a pooled connection by route."
+            )
+            out.append("# TYPE movie_api_request_pool_wait_seconds_total counter")
+            for (method, route), metrics in routes:
+                out.append(
+                    "movie_api_request_pool_wait_seconds_total"
+                    f"{{{labels(method, route)}}} {metrics.pool_wait_seconds}"
+                )
+
+            out.append(
+                "# HELP movie_api_responses_total Responses by route and status code."
+            )
+            out.append("# TYPE movie_api_responses_total counter")
+            for (method, route), metrics in routes:
+                for status, count in sorted(metrics.responses.items()):
+                    out.append(
+                        f"movie_api_responses_total{{{labels(method, route)},"
+                        f'status="{status}"}} {count}'
+                    )
+
+            out.append(
+                "# HELP movie_api_statements_total "
+                "Statements executed, including outside requests."
+            )
+            out.append("# TYPE movie_api_statements_total counter")
+            out.append(f"movie_api_statements_total {self.statements}")
+            out.append(
+                "# HELP movie_api_db_seconds_total Time spent executing statements."
+            )
+            out.append("# TYPE movie_api_db_seconds_total counter")
+            out.append(f"movie_api_db_seconds_total {self.db_seconds}")
+            out.append(
+                "# HELP movie_api_slow_queries_total "
+                "Statements slower than MOVIE_API_SLOW_QUERY_MS."
+            )
+            out.append("# TYPE movie_api_slow_queries_total counter")
+            out.append(f"movie_api_slow_queries_total {self.slow_queries}")
+            out.append(
+                "# HELP movie_api_compiled_cache_total "
+                "Statements by whether their compiled SQL was cached."
+            )
+            out.append("# TYPE movie_api_compiled_cache_total counter")
+            for result, count in self.compiled_cache.items():
+                out.append(
+                    f'movie_api_compiled_cache_total{{result="{result}"}} {count}'
+                )
+        return "\n".join(out) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.routes.clear()
+            self.statements = 0
+            self.db_seconds = 0.0
+            self.slow_queries = 0
+            self.compiled_cache = {"hit": 0, "miss": 0, "uncached": 0}
+
+
+def quantile_ms(histogram, q):
+    value = histogram.quantile(q)
+    return None if value is None else value * 1000
+
+
+def labels(method, route):
+    route = route.replace("\\", "\\\\").replace('"', '\\"')
+    return f'method="{method}",route="{route}"'
+
+
+def render_histogram(out, name, label_text, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        out.append(f'{name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+    out.append(f'{name}_bucket{{{label_text},le="+Inf"}} {histogram.count}')
+    out.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+    out.append(f"{name}_count{{{label_text}}} {histogram.count}")
+
+
+registry = Registry()
+
+
+def record_pool_wait(seconds):
+    stats = current_request.get()
+    if stats is not None:
+        stats.pool_wait_seconds += seconds
+
+
+# Engine is the class every engine's connections report to, including the
+# synchronous engine inside each async engine, so these listeners cover both
+# database modes.
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_start"].pop()
+    slow = SLOW_QUERY_THRESHOLD is not None and seconds >= SLOW_QUERY_THRESHOLD
+    registry.record_statement(seconds, slow, cache_result(context))
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += seconds
+    if slow:
+        logger.warning(
+            "slow query (%.1f ms%s): %s parameters=%r",
+            seconds * 1000,
+            ", executemany" if executemany else "",
+            statement,
+            parameters,
+        )
+
+
+@event.listens_for(Engine, "handle_error")
+def handle_error(context):
+    # a statement that fails never reaches after_cursor_execute, and the
+    # connection's info outlives the checkout, so drop its start time here.
+    # Errors fetching results come without a statement and after it was
+    # already popped.
+    if context.connection is None or context.statement is None:
+        return
+    starts = context.connection.info.get("query_start")
+    if starts:
+        starts.pop()
+
+
+def cache_result(context):
+    cache_hit = getattr(context, "cache_hit", None)
+    if cache_hit is CACHE_HIT:
+        return "hit"
+    if cache_hit is CACHE_MISS:
+        return "miss"
+    # raw SQL, or a statement that cannot be cached
+    return "uncached"
+
+
+class MetricsMiddleware:
+    """
+    Times each HTTP request and records it against its route template, so
+    /movies/1 and /movies/2 count towards the same /movies/{movie_id}.
+    Responses carry a Server-Timing header with the request's database time.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.route_paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timing = (
+                    f'db;dur={stats.db_seconds * 1000:.1f};'
+                    f'desc="{stats.statements} statements", '
+                    f"pool;dur={stats.pool_wait_seconds * 1000:.1f}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", timing.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            registry.record_request(
+                scope["method"],
+                self.route_path(scope),
+                status,
+                time.perf_counter() - start,
+                stats,
+            )
+
+    def route_path(self, scope):
+        # The router stores the matched endpoint in the scope. Unmatched
+        # paths share one label so that scanning for URLs cannot create
+        # unbounded series.
+        if self.route_paths is None:
+            self.route_paths = {
+                route.endpoint: route.path
+                for route in scope["app"].routes
+                if hasattr(route, "endpoint")
+            }
+        return self.route_paths.get(scope.get("endpoint"), "unmatched")
@@ -0,0 +1,54 @@
+import pathlib
+
+import sqlalchemy
+from src import database as db
+
+# Applies the SQL files in migrations/ that have not been run against the
+# database yet, in file name order. Run with:
+#
+#     python -m src.migrate
+
+MIGRATIONS_DIR = pathlib.Path(__file__).resolve().parent.parent / "migrations"
+
+
+def pending_migrations(conn):
+    conn.execute(
+        sqlalchemy.text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "name text PRIMARY KEY, "
+            "applied_at timestamptz NOT NULL DEFAULT now())"
+        )
+    )
+    applied = set(
+        conn.execute(sqlalchemy.text("SELECT name FROM schema_migrations")).scalars()
+    )
+    return [
+        path
+        for path in sorted(MIGRATIONS_DIR.glob("*.sql"))
+        if path.name not in applied
+    ]
+
+
+def migrate():
+    with db.engine.begin() as conn:
+        pending = pending_migrations(conn)
+
+    for path in pending:
+        # each file runs in its own transaction so a failure leaves the
+        # earlier migrations applied and recorded
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(
+                path.read_text(), execution_options={"no_parameters": True}
+            )
+            conn.execute(
+                sqlalchemy.text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                {"name": path.name},
+            )
+        print(f"applied {path.name}")
+
+    if not pending:
+        print("database is up to date")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,87 @@
+import base64
+import json
+
+import sqlalchemy
+from fastapi import HTTPException
+
+# Keyset (cursor) pagination shared by the list endpoints. A cursor records the
+# sort option plus the sort key and id of the last row of a page; the next page
+# is every row that sorts after that pair. Unlike offsets this costs the same
+# for every page and does not skip or repeat rows while data is being added.
+# Sort keys are assumed to be non-null.
+
+
+def encode_cursor(sort, key, id):
+    payload = json.dumps([sort, key, id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+# cursor values end up as bound parameters, and the id and integer sort
+# columns are 32-bit integers
+INT_MIN, INT_MAX = -2**31, 2**31 - 1
+
+
+def is_key(value, key_type):
+    """Whether a decoded cursor value can be compared with a `key_type` column."""
+    if isinstance(value, bool):
+        return False
+    if key_type is float:
+        return isinstance(value, (int, float))
+    if key_type is int:
+        return isinstance(value, int) and INT_MIN <= value <= INT_MAX
+    return isinstance(value, key_type)
+
+
+def decode_cursor(cursor, sort, key_type):
+    """
+    Returns the `(key, id)` pair stored in `cursor`, or None for the empty
+    cursor that starts from the first page. `key_type` is the type of the
+    sort column's values: str, int or float.
+    """
+    if cursor == "":
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, key, id = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort")
+    if not is_key(key, key_type) or not is_key(id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key, id
+
+
+def after(sort_column, descending, id_column, position):
+    """
+    Filters to the rows that come after `position` when ordering by
+    `sort_column` (descending if `descending`) and then by `id_column`.
+    """
+    key, id = position
+    if descending:
+        beyond = sort_column < key
+    else:
+        beyond = sort_column > key
+    return beyond | ((sort_column == key) & (id_column > id))
+
+
+# Prebuilt statements (see src/statements.py) filter with `after(...,
+# POSITION)`, and the cursor's values are passed as parameters.
+POSITION = (sqlalchemy.bindparam("after_key"), sqlalchemy.bindparam("after_id"))
+
+
+def position_parameters(position):
+    key, id = position
+    return {"after_key": key, "after_id": id}
+
+
+def page(results, sort, limit, sort_key, id_key):
+    """
+    Wraps a page of results together with the cursor for the following page,
+    which is None once a short page shows there is nothing left.
+    """
+    next_cursor = None
+    if len(results) == limit:
+        last = results[-1]
+        next_cursor = encode_cursor(sort, last[sort_key], last[id_key])
+    return {"results": results, "next_cursor": next_cursor}
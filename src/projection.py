@@ -0,0 +1,49 @@
+from fastapi import HTTPException
+
+# Field projection, shared by the list and detail endpoints' `fields`
+# parameter. `?fields=movie_id,movie_title` returns only those keys of each
+# object. Handlers pass the parsed fields down to their statements, so
+# columns and joins that were not asked for are not read at all.
+
+
+def parse_fields(fields, allowed):
+    """
+    Parses a comma separated list of field names such as "movie_id,year"
+    into a tuple in the order of `allowed`, or None when `fields` was not
+    given and every field is returned.
+    """
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip() != ""}
+    if len(requested) == 0:
+        raise HTTPException(status_code=400, detail="fields must not be empty")
+    unknown = requested.difference(allowed)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"Unknown fields: {', '.join(sorted(unknown))}. "
+                f"Choose from: {', '.join(allowed)}"
+            ),
+        )
+    return tuple(field for field in allowed if field in requested)
+
+
+def including(fields, *required):
+    """`fields` plus the `required` ones, such as the keys a cursor is made of."""
+    if fields is None:
+        return None
+    return tuple(dict.fromkeys(fields + required))
+
+
+def project(item, fields):
+    """Keeps only `fields` of `item`, or all of it when `fields` is None."""
+    if fields is None:
+        return item
+    return {field: item[field] for field in fields}
+
+
+def project_all(items, fields):
+    if fields is None:
+        return items
+    return [project(item, fields) for item in items]
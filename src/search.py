@@ -0,0 +1,93 @@
+import re
+
+import sqlalchemy
+
+# Name and title matching for the /search/ endpoints. Every predicate here can
+# use the trigram indexes from migrations/003_name_search.sql, except
+# starts_with, which uses the prefix indexes from migrations/008_name_prefixes.sql.
+
+
+def escape_like(text):
+    """Escapes the LIKE wildcards in `text` so it is matched literally."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def contains(column, text):
+    return column.ilike(f"%{escape_like(text)}%", escape="\\")
+
+
+def starts_with(column, text):
+    # the same expression as the index, lower(column), and a pattern with no
+    # leading wildcard make this a range scan of the index
+    pattern = sqlalchemy.func.lower(sqlalchemy.literal(f"{escape_like(text)}%"))
+    return sqlalchemy.func.lower(column).like(pattern, escape="\\")
+
+
+def fuzzy(column, text):
+    """
+    Matches values containing a word similar to `text`, which tolerates typos
+    as well as partial words.
+    """
+    return sqlalchemy.literal(text).op("<%")(column)
+
+
+def score(column, text, is_fuzzy):
+    """How closely `column` matches `text`, from 0 to 1, for ranking results."""
+    if is_fuzzy:
+        return sqlalchemy.func.word_similarity(text, column)
+    return sqlalchemy.func.similarity(column, text)
+
+
+# Python versions of the pg_trgm functions, for backends without Postgres.
+# `similarity` follows pg_trgm exactly; `word_similarity` approximates it by
+# comparing against each word rather than every run of trigrams.
+
+WORD_SIMILARITY_THRESHOLD = 0.6
+
+
+def trigrams(text):
+    grams = set()
+    for word in re.findall(r"[^\W_]+", text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(a, b):
+    a_grams, b_grams = trigrams(a), trigrams(b)
+    if not a_grams or not b_grams:
+        return 0.0
+    shared = len(a_grams & b_grams)
+    return shared / (len(a_grams) + len(b_grams) - shared)
+
+
+def word_similarity(a, b):
+    a_grams = trigrams(a)
+    if not a_grams:
+        return 0.0
+    return max(
+        (len(a_grams & trigrams(word)) / len(a_grams) for word in b.split()),
+        default=0.0,
+    )
+
+
+def like_pattern(pattern):
+    """
+    Compiles a LIKE pattern (with `%` and `_` wildcards and `\\` escapes) to a
+    case-insensitive regular expression with the semantics of ILIKE.
+    """
+    parts = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            parts.append(re.escape(char))
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
@@ -0,0 +1,41 @@
+import functools
+
+# Prebuilt statements for the hot read endpoints. Building a select with its
+# joins and ordering, and SQLAlchemy working out how to compile it, used to
+# happen on every request. Instead, each statement is built once per variant,
+# meaning per combination of the options that change its SQL, such as the
+# sort. The values that only fill it in, such as the name filter, ids, limit
+# and offset, are bound parameters passed when it is executed.
+#
+# SQLAlchemy caches compiled SQL by the structure of a statement, so a
+# prebuilt statement is also compiled only once per engine. With asyncpg
+# (POSTGRES_ASYNC=true) the driver also prepares each statement on the
+# server, once per connection (see database.get_async_engine).
+
+builders = []
+
+
+def prebuilt(build):
+    """
+    Caches the statements returned by `build` by its arguments, which must
+    be hashable and describe the variant, never per-request values.
+    """
+    cached = functools.lru_cache(maxsize=None)(build)
+    builders.append(cached)
+    return cached
+
+
+def stats():
+    """How often each builder's statements were reused."""
+    out = []
+    for builder in builders:
+        info = builder.cache_info()
+        out.append(
+            {
+                "name": builder.__module__.rsplit(".", 1)[-1] + "." + builder.__name__,
+                "variants": info.currsize,
+                "hits": info.hits,
+                "misses": info.misses,
+            }
+        )
+    return out
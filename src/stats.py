@@ -0,0 +1,153 @@
+from collections import Counter, defaultdict
+
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+from src import database as db
+
+# Incremental maintenance of the precomputed line and conversation counts
+# created by migrations/002_line_statistics.sql, and of the versions added
+# by migrations/009_stats_versions.sql.
+
+
+def record_conversations(conn, movie_id, conversations):
+    """
+    Adds the lines of `conversations` to the statistics tables, and bumps
+    the versions of the movie and of every character in a conversation.
+    Must run on the connection that inserts the conversations, before the
+    lines are inserted, so the counts commit or roll back together with
+    them. Rows are locked and upserted in key order so concurrent writers
+    lock them in the same order.
+    """
+    character_ids = set()
+    num_lines = Counter()
+    new_texts = defaultdict(set)
+    pair_lines = Counter()
+    pair_conversations = Counter()
+    for conversation in conversations:
+        partners = {
+            conversation.character_1_id: conversation.character_2_id,
+            conversation.character_2_id: conversation.character_1_id,
+        }
+        character_ids.update(partners)
+        for character_id, partner_id in partners.items():
+            pair_conversations[(character_id, partner_id)] += 1
+        for line in conversation.lines:
+            num_lines[line.character_id] += 1
+            new_texts[line.character_id].add(line.line_text)
+            pair_lines[(line.character_id, partners[line.character_id])] += 1
+
+    # texts the characters have already spoken do not change their distinct
+    # line counts. Locking the characters' rows first makes concurrent writers
+    # for the same character take turns, so each one sees the lines of those
+    # before it and no text is counted twice. Characters without a row yet get
+    # an empty one first, which waits for a concurrent writer inserting the
+    # same row, so there is a row to lock for every one of them.
+    if character_ids:
+        conn.execute(
+            insert(db.character_stats).on_conflict_do_nothing(
+                index_elements=[db.character_stats.c.character_id]
+            ),
+            [
+                {"character_id": character_id, "movie_id": movie_id}
+                for character_id in sorted(character_ids)
+            ],
+        )
+        conn.execute(
+            sqlalchemy.select(db.character_stats.c.character_id)
+            .where(db.character_stats.c.character_id.in_(character_ids))
+            .order_by(db.character_stats.c.character_id)
+            .with_for_update()
+        )
+    if new_texts:
+        existing_stmt = (
+            sqlalchemy.select(db.lines.c.character_id, db.lines.c.line_text)
+            .where(
+                db.lines.c.character_id.in_(new_texts.keys())
+                & db.lines.c.line_text.in_(
+                    {text for texts in new_texts.values() for text in texts}
+                )
+            )
+            .distinct()
+        )
+        for row in conn.execute(existing_stmt):
+            new_texts[row.character_id].discard(row.line_text)
+
+    # clock_timestamp(), unlike now(), is read once the row is locked, so a
+    # row's updated_at never goes back even when a writer that started
+    # earlier gets the lock later
+    if character_ids:
+        character_rows = [
+            {
+                "character_id": character_id,
+                "movie_id": movie_id,
+                "num_lines": num_lines[character_id],
+                "num_distinct_lines": len(new_texts[character_id]),
+            }
+            for character_id in sorted(character_ids)
+        ]
+        character_stmt = insert(db.character_stats).values(
+            version=1, updated_at=sqlalchemy.func.clock_timestamp()
+        )
+        conn.execute(
+            character_stmt.on_conflict_do_update(
+                index_elements=[db.character_stats.c.character_id],
+                set_={
+                    "num_lines": db.character_stats.c.num_lines
+                    + character_stmt.excluded.num_lines,
+                    "num_distinct_lines": db.character_stats.c.num_distinct_lines
+                    + character_stmt.excluded.num_distinct_lines,
+                    "version": db.character_stats.c.version + 1,
+                    "updated_at": sqlalchemy.func.clock_timestamp(),
+                },
+            ),
+            character_rows,
+        )
+
+    if conversations:
+        movie_stmt = insert(db.movie_stats).values(
+            movie_id=movie_id,
+            num_lines=sum(num_lines.values()),
+            num_conversations=len(conversations),
+            version=1,
+            updated_at=sqlalchemy.func.clock_timestamp(),
+        )
+        conn.execute(
+            movie_stmt.on_conflict_do_update(
+                index_elements=[db.movie_stats.c.movie_id],
+                set_={
+                    "num_lines": db.movie_stats.c.num_lines
+                    + movie_stmt.excluded.num_lines,
+                    "num_conversations": db.movie_stats.c.num_conversations
+                    + movie_stmt.excluded.num_conversations,
+                    "version": db.movie_stats.c.version + 1,
+                    "updated_at": sqlalchemy.func.clock_timestamp(),
+                },
+            )
+        )
+
+    if pair_conversations:
+        pair_rows = [
+            {
+                "character_id": character_id,
+                "partner_id": partner_id,
+                "num_lines": pair_lines[(character_id, partner_id)],
+                "num_conversations": count,
+            }
+            for (character_id, partner_id), count in sorted(pair_conversations.items())
+        ]
+        pair_stmt = insert(db.character_pair_stats)
+        conn.execute(
+            pair_stmt.on_conflict_do_update(
+                index_elements=[
+                    db.character_pair_stats.c.character_id,
+                    db.character_pair_stats.c.partner_id,
+                ],
+                set_={
+                    "num_lines": db.character_pair_stats.c.num_lines
+                    + pair_stmt.excluded.num_lines,
+                    "num_conversations": db.character_pair_stats.c.num_conversations
+                    + pair_stmt.excluded.num_conversations,
+                },
+            ),
+            pair_rows,
+        )
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from src import analytics
+from src.api.server import app
+
+client = TestClient(app)
+
+MOVIES = [
+    (2, "b", "1998/I", None, 5, 1),
+    (1, "a", "1999", 7.5, 40, 4),
+    (3, "c", "1999", 8.1, 0, 0),
+]
+CHARACTERS = [
+    (10, 1, "F", 30),
+    (11, 1, "M", 10),
+    (12, 1, None, 0),
+    (20, 2, "m", 5),
+    (30, 3, "?", 0),
+    (40, 9, "F", 100),
+]
+PAIRS = [(10, 11), (11, 10), (10, 12), (20, 20), (10, 20), (40, 10)]
+
+
+def test_snapshot():
+    snapshot = analytics.Snapshot(MOVIES, CHARACTERS, PAIRS, 0)
+
+    assert snapshot.lines_by_year == [
+        {
+            "year": 1998,
+            "movies": 1,
+            "lines": 5,
+            "lines_per_movie": 5.0,
+            "conversations": 1,
+        },
+        {
+            "year": 1999,
+            "movies": 2,
+            "lines": 40,
+            "lines_per_movie": 20.0,
+            "conversations": 4,
+        },
+    ]
+    assert snapshot.gender_share[0] == {
+        "movie_id": 1,
+        "title": "a",
+        "lines": 40,
+        "female": 0.75,
+        "male": 0.25,
+        "unknown": 0.0,
+    }
+    assert snapshot.gender_share[2]["female"] is None
+    assert [movie["pairs"] for movie in snapshot.pair_density] == [2, 0, 0]
+    assert snapshot.pair_density[0]["density"] == round(2 / 3, 4)
+    assert snapshot.pair_density[1]["density"] is None
+    assert snapshot.rating_vs_dialogue["movies"] == 2
+    assert [
+        bucket["rating"] for bucket in snapshot.rating_vs_dialogue["by_rating"]
+    ] == [7, 8]
+    assert snapshot.rating_vs_dialogue["correlation"] == -1.0
+
+
+def test_correlation():
+    assert analytics.correlation([1.0, 2.5, 4.0, 7.0], [3, 1, 4, 15]) == (
+        pytest.approx(0.8919017, abs=1e-7)
+    )
+    assert analytics.correlation([7.5], [40]) is None
+    assert analytics.correlation([7.5, 7.5], [40, 10]) is None
+
+
+def test_failed_refresh_keeps_snapshot():
+    snapshots = []
+
+    async def load():
+        if snapshots:
+            raise RuntimeError("database unavailable")
+        snapshots.append(analytics.Snapshot(MOVIES, CHARACTERS, PAIRS, 0))
+        return snapshots[0]
+
+    async def run():
+        store = analytics.SnapshotStore(load, interval=0.01)
+        assert await store.get() is snapshots[0]
+        store.start()
+        await asyncio.sleep(0.05)
+        await store.stop()
+        assert store.snapshot is snapshots[0]
+
+    asyncio.run(run())
+
+
+def test_endpoints():
+    for route in [
+        "lines-by-year",
+        "gender-share",
+        "rating-vs-dialogue",
+        "pair-density",
+    ]:
+        response = client.get(f"/analytics/{route}")
+        assert response.status_code == 200
+        assert "refreshed_at" in response.json()
+
+        not_modified = client.get(
+            f"/analytics/{route}", headers={"If-None-Match": response.headers["etag"]}
+        )
+        assert not_modified.status_code == 304
+
+    movies = client.get("/analytics/gender-share").json()["results"]
+    movie = next(movie for movie in movies if movie["movie_id"] == 44)
+    assert movie["title"] == client.get("/movies/44").json()["title"]
+
+
+def test_counts_follow_writes():
+    def totals():
+        snapshot = asyncio.run(analytics.load())
+        movie = next(movie for movie in snapshot.gender_share if movie["movie_id"] == 0)
+        lines = sum(row["lines"] for row in snapshot.lines_by_year)
+        conversations = sum(row["conversations"] for row in snapshot.lines_by_year)
+        return movie["lines"], lines, conversations
+
+    before = totals()
+    response = client.post("/movies/0/conversations/", json={
+        "character_1_id": 10,
+        "character_2_id": 11,
+        "lines": [
+            {"character_id": 10, "line_text": "Counted once."},
+            {"character_id": 11, "line_text": "And once more."},
+        ],
+    })
+    assert response.status_code == 200
+    assert totals() == (before[0] + 2, before[1] + 2, before[2] + 1)
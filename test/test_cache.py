@@ -0,0 +1,71 @@
+import asyncio
+
+from src.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction():
+    cache = TTLCache("test", maxsize=2, ttl=60)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    assert cache.get(1) == "a"
+    cache.set(3, "c")
+
+    assert cache.get(2) is None
+    assert cache.get(1) == "a"
+    assert cache.get(3) == "c"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expiry():
+    clock = FakeClock()
+    cache = TTLCache("test", maxsize=10, ttl=5, clock=clock)
+    cache.set(1, "a")
+    clock.now = 4.9
+    assert cache.get(1) == "a"
+    clock.now = 5.0
+    assert cache.get(1) is None
+
+
+def test_get_or_load_counts():
+    cache = TTLCache("test", maxsize=10, ttl=60)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        return {"movie_id": 44}
+
+    assert asyncio.run(cache.get_or_load(44, load)) == {"movie_id": 44}
+    assert asyncio.run(cache.get_or_load(44, load)) == {"movie_id": 44}
+    assert len(calls) == 1
+
+    cache.invalidate(44)
+    asyncio.run(cache.get_or_load(44, load))
+    assert len(calls) == 2
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+
+def test_other_versions_miss():
+    cache = TTLCache("test", maxsize=10, ttl=60)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        return {"movie_id": 44, "version": len(calls)}
+
+    assert asyncio.run(cache.get_or_load(44, load, (1, 0.0)))["version"] == 1
+    assert asyncio.run(cache.get_or_load(44, load, (1, 0.0)))["version"] == 1
+    # written by another process, which this one was not told about
+    assert asyncio.run(cache.get_or_load(44, load, (2, 1.0)))["version"] == 2
+    assert cache.get(44, (1, 0.0)) is None
+    assert len(calls) == 2
@@ -1,5 +1,6 @@
 from fastapi.testclient import TestClient
 
+from src import pagination
 from src.api.server import app
 
 import json
@@ -59,3 +60,50 @@ def test_sort_filter2():
 def test_404():
     response = client.get("/characters/400")
     assert response.status_code == 404
+
+
+def test_batch():
+    response = client.get("/characters/?ids=7421,2,400000")
+    assert response.status_code == 200
+
+    # partners with the same number of lines may come back in any order
+    def key(partner):
+        return (-partner["number_of_lines_together"], partner["character_id"])
+
+    characters = response.json()
+    assert list(characters) == ["7421", "2"]
+    for id in ["7421", "2"]:
+        character = client.get(f"/characters/{id}").json()
+        character["top_conversations"].sort(key=key)
+        characters[id]["top_conversations"].sort(key=key)
+        assert characters[id] == character
+
+
+def test_fields():
+    response = client.get("/characters/?sort=number_of_lines&limit=5&fields=character")
+    assert response.status_code == 200
+    full = client.get("/characters/?sort=number_of_lines&limit=5").json()
+    assert response.json() == [
+        {"character": character["character"]} for character in full
+    ]
+
+    response = client.get("/characters/2?fields=movie,gender")
+    full = client.get("/characters/2").json()
+    assert response.json() == {"movie": full["movie"], "gender": full["gender"]}
+
+    response = client.get("/characters/?ids=2,4&fields=top_conversations")
+    assert response.json()["2"] == {"top_conversations": full["top_conversations"]}
+
+    assert client.get("/characters/?fields=gender").status_code == 400
+
+
+def test_cursor_wrong_key_type():
+    cursor = pagination.encode_cursor("number_of_lines", "12", 1)
+    assert (
+        client.get(f"/characters/?cursor={cursor}&sort=number_of_lines").status_code
+        == 400
+    )
+    cursor = pagination.encode_cursor("character", 12, 1)
+    assert client.get(f"/characters/?cursor={cursor}").status_code == 400
+    cursor = pagination.encode_cursor("conversation_id", 2**40, 2**40)
+    assert client.get(f"/lines/2/conversations?cursor={cursor}").status_code == 400
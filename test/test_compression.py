@@ -0,0 +1,81 @@
+import asyncio
+import gzip
+
+from fastapi.testclient import TestClient
+
+from src import compression
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_negotiate():
+    assert compression.negotiate(None) is None
+    assert compression.negotiate("identity") is None
+    assert compression.negotiate("gzip, deflate") == "gzip"
+    assert compression.negotiate("gzip;q=0") is None
+    assert compression.negotiate("*") in ("br", "gzip")
+    if compression.brotli is not None:
+        assert compression.negotiate("gzip;q=0.5, br") == "br"
+    else:
+        assert compression.negotiate("br") is None
+
+
+def test_large_responses_are_compressed():
+    route = "/characters/?limit=250"
+    plain = client.get(route, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["vary"] == "Accept-Encoding"
+
+    response = client.get(route, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == "W/" + plain.headers["etag"]
+    assert int(response.headers["content-length"]) < len(plain.content)
+    assert response.json() == plain.json()
+
+    # the weak ETag of the compressed copy still revalidates
+    not_modified = client.get(
+        route, headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert not_modified.status_code == 304
+
+
+def test_small_responses_are_not():
+    response = client.get(
+        "/movies/44?fields=title", headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+def test_streamed_responses_are_compressed_in_chunks():
+    chunks = []
+
+    async def stream(scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        })
+        for chunk in (b'["a",', b'"b"]'):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        chunks.append(message)
+
+    middleware = compression.CompressionMiddleware(stream, minimum_size=1024)
+    scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+    asyncio.run(middleware(scope, receive, send))
+
+    headers = dict(chunks[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    # every chunk is flushed, so it can be decoded on arrival
+    assert chunks[1]["body"] != b""
+    assert (
+        gzip.decompress(b"".join(chunk["body"] for chunk in chunks[1:])) == b'["a","b"]'
+    )
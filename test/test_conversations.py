@@ -1,8 +1,14 @@
 from fastapi.testclient import TestClient
 
+from src import database as db, idempotency
+from src.api.conversations import ConversationJson, write_conversation
 from src.api.server import app
 
+import asyncio
 import json
+import sqlalchemy
+import threading
+import uuid
 
 
 client = TestClient(app)
@@ -45,4 +51,108 @@ def test_add_conversation2():
     })
     lines_response_2 = client.get("/lines/49/conversations/")
     assert response.status_code == 200
-    assert lines_response != lines_response_2
\ No newline at end of file
+    assert lines_response != lines_response_2
+
+def test_idempotency_key():
+    key = str(uuid.uuid4())
+    conversation = {
+        "character_1_id": 10,
+        "character_2_id": 11,
+        "lines": [{"character_id": 10, "line_text": "Only once, please."}],
+    }
+    response = client.post(
+        "/movies/0/conversations/", json=conversation, headers={"Idempotency-Key": key}
+    )
+    assert response.status_code == 200
+    assert "idempotent-replayed" not in response.headers
+
+    retry = client.post(
+        "/movies/0/conversations/", json=conversation, headers={"Idempotency-Key": key}
+    )
+    assert retry.status_code == 200
+    assert retry.json() == response.json()
+    assert retry.headers["idempotent-replayed"] == "true"
+
+    conversation["lines"][0]["line_text"] = "Something else."
+    reused = client.post(
+        "/movies/0/conversations/", json=conversation, headers={"Idempotency-Key": key}
+    )
+    assert reused.status_code == 422
+
+
+def test_expired_idempotency_keys_are_purged():
+    expired, current = str(uuid.uuid4()), str(uuid.uuid4())
+    with db.engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.insert(db.idempotency_keys).values(
+                key=expired,
+                request_hash="hash",
+                created_at=sqlalchemy.func.now() - idempotency.KEY_TTL * 2,
+            )
+        )
+        conn.execute(
+            sqlalchemy.insert(db.idempotency_keys).values(
+                key=current, request_hash="hash"
+            )
+        )
+
+    now = [0.0]
+    purger = idempotency.Purger(interval=60, clock=lambda: now[0])
+    asyncio.run(purger.maybe_purge())
+
+    with db.engine.connect() as conn:
+        keys = conn.execute(
+            sqlalchemy.select(db.idempotency_keys.c.key).where(
+                db.idempotency_keys.c.key.in_([expired, current])
+            )
+        ).scalars().all()
+    assert keys == [current]
+
+    # and not again until the interval has passed
+    purged_at = purger.purged_at
+    now[0] = 30.0
+    asyncio.run(purger.maybe_purge())
+    assert purger.purged_at == purged_at
+
+
+def test_first_writes_for_a_character_take_turns():
+    # characters without a character_stats row yet
+    with db.engine.begin() as conn:
+        conn.execute(
+            sqlalchemy.delete(db.character_stats).where(
+                db.character_stats.c.character_id.in_([6, 8])
+            )
+        )
+    conversation = ConversationJson(
+        character_1_id=6,
+        character_2_id=8,
+        lines=[{"character_id": 6, "line_text": f"Said twice {uuid.uuid4()}"}],
+    )
+    written, commit = threading.Event(), threading.Event()
+
+    def write(wait=None):
+        with db.engine.begin() as conn:
+            write_conversation(conn, 0, conversation)
+            written.set()
+            if wait is not None:
+                wait.wait(5)
+
+    first = threading.Thread(target=write, args=(commit,))
+    first.start()
+    assert written.wait(5)
+    second = threading.Thread(target=write)
+    second.start()
+    # the second writer waits for the row the first one inserted
+    second.join(0.5)
+    assert second.is_alive()
+    commit.set()
+    first.join()
+    second.join()
+
+    with db.engine.connect() as conn:
+        counts = conn.execute(
+            sqlalchemy.select(
+                db.character_stats.c.num_lines, db.character_stats.c.num_distinct_lines
+            ).where(db.character_stats.c.character_id == 6)
+        ).one()
+    assert tuple(counts) == (2, 1)
@@ -0,0 +1,69 @@
+import json
+
+from fastapi import FastAPI, Response
+from fastapi.testclient import TestClient
+
+from src import fast_json
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_dumps_matches_fastapi():
+    value = {1: {"title": "ça", "rating": 7.5, "lines": ["a", None]}}
+    assert json.loads(fast_json.dumps(value)) == {
+        "1": {"title": "ça", "rating": 7.5, "lines": ["a", None]}
+    }
+    assert "ça".encode() in fast_json.dumps(value)
+
+
+def test_enabled(monkeypatch):
+    monkeypatch.setattr(fast_json, "FAST_JSON", "list_movies, get_lines")
+    assert fast_json.enabled("get_lines")
+    assert not fast_json.enabled("get_movie")
+    monkeypatch.setattr(fast_json, "FAST_JSON", "none")
+    assert not fast_json.enabled("get_lines")
+
+
+def test_same_response_either_way(monkeypatch):
+    routes = [
+        "/movies/?sort=rating&limit=250",
+        "/characters/?ids=2,4",
+        "/lines/longest/2",
+    ]
+    for route in routes:
+        monkeypatch.setattr(fast_json, "FAST_JSON", "none")
+        default = client.get(route)
+        monkeypatch.setattr(fast_json, "FAST_JSON", "all")
+        fast = client.get(route)
+        assert fast.status_code == default.status_code == 200
+        assert fast.json() == default.json()
+        assert fast.headers["content-type"] == default.headers["content-type"]
+        assert fast.headers["etag"] == default.headers["etag"]
+
+        not_modified = client.get(
+            route, headers={"If-None-Match": fast.headers["etag"]}
+        )
+        assert not_modified.status_code == 304
+
+
+def test_status_code_and_headers_are_kept():
+    small_app = FastAPI()
+
+    @small_app.post("/jobs")
+    @fast_json.response
+    async def create_job(response: Response):
+        response.status_code = 202
+        response.headers["Location"] = "/jobs/1"
+        return {"job_id": 1}
+
+    @small_app.get("/jobs/1")
+    @fast_json.response
+    async def get_job(response: Response):
+        return {"job_id": 1}
+
+    created = TestClient(small_app).post("/jobs")
+    assert created.status_code == 202
+    assert created.headers["location"] == "/jobs/1"
+    assert created.json() == {"job_id": 1}
+    assert TestClient(small_app).get("/jobs/1").status_code == 200
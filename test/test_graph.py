@@ -0,0 +1,132 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+from src.api.conversations import ConversationJson
+from src.api.server import app
+from src.graph import CharacterGraph, GraphStore
+
+client = TestClient(app)
+
+
+def conversation(character_1_id, character_2_id, *speakers):
+    return ConversationJson(
+        character_1_id=character_1_id,
+        character_2_id=character_2_id,
+        lines=[{"character_id": id, "line_text": "line"} for id in speakers],
+    )
+
+
+def small_graph():
+    graph = CharacterGraph()
+    for id, name in enumerate(["A", "B", "C", "D", "E"]):
+        graph.add_character(id, name)
+    graph.add_conversations(
+        [
+            conversation(0, 1, 0, 1, 0),
+            # 0 is the second character here, which the graph still counts
+            conversation(2, 0, 2, 2, 0, 2),
+            conversation(2, 3, 3),
+        ]
+    )
+    return graph
+
+
+def test_partners():
+    graph = small_graph()
+    assert graph.partners(0, 10) == [(2, 4, 1), (1, 3, 1)]
+    assert graph.partners(0, 1) == [(2, 4, 1)]
+    assert graph.partners(4, 10) == []
+
+
+def test_neighborhood_and_path():
+    graph = small_graph()
+    assert graph.neighborhood(1, 1, 10) == [(0, 1)]
+    assert graph.neighborhood(1, 3, 10) == [(0, 1), (2, 2), (3, 3)]
+    assert graph.path(1, 3) == [1, 0, 2, 3]
+    assert graph.path(1, 4) is None
+
+
+def test_store_rebuilds_after_concurrent_write():
+    builds = []
+
+    async def build():
+        builds.append(1)
+        if len(builds) == 1:
+            store.record_conversations([conversation(0, 1, 0)])
+        return small_graph()
+
+    store = GraphStore(build, version=settled)
+    graph = asyncio.run(store.get())
+    assert len(builds) == 2
+    assert graph.partners(0, 1) == [(2, 4, 1)]
+
+
+async def settled():
+    return 0
+
+
+def test_store_builds_once_for_concurrent_requests():
+    builds = []
+
+    async def build():
+        builds.append(1)
+        await asyncio.sleep(0.01)
+        return small_graph()
+
+    async def cold_requests():
+        store = GraphStore(build, version=settled)
+        return await asyncio.gather(*(store.get() for _ in range(5)))
+
+    graphs = asyncio.run(cold_requests())
+    assert len(builds) == 1
+    assert all(graph is graphs[0] for graph in graphs)
+
+
+def test_store_rebuilds_when_the_version_moves():
+    now = [0.0]
+    versions = [1]
+    builds = []
+
+    async def build():
+        builds.append(1)
+        return small_graph()
+
+    async def version():
+        return versions[-1]
+
+    async def requests():
+        store = GraphStore(build, version=version, interval=60, clock=lambda: now[0])
+        first = await store.get()
+        # a write by this process is applied in place
+        store.record_conversations([conversation(0, 1, 0)])
+        versions.append(2)
+        now[0] = 60.0
+        assert await store.get() is first
+        assert first.partners(0, 1) == [(1, 4, 2)]
+        # one by another process is only seen in the version
+        versions.append(3)
+        now[0] = 90.0
+        assert await store.get() is first
+        now[0] = 120.0
+        second = await store.get()
+        assert second is not first
+        now[0] = 180.0
+        assert await store.get() is second
+
+    asyncio.run(requests())
+    assert len(builds) == 2
+
+
+def test_partners_endpoint():
+    response = client.get("/graph/characters/2/partners?k=3")
+    assert response.status_code == 200
+    partners = response.json()["partners"]
+    assert len(partners) <= 3
+    counts = [partner["number_of_lines_together"] for partner in partners]
+    assert counts == sorted(counts, reverse=True)
+
+
+def test_404():
+    response = client.get("/graph/characters/400000/partners")
+    assert response.status_code == 404
@@ -0,0 +1,92 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+from src import database as db, http_cache
+from src.api.conversations import ConversationJson, write_conversation
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_not_modified():
+    response = client.get("/movies/44")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == http_cache.CACHE_CONTROL
+
+    response = client.get("/movies/44", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    # CDNs weaken validators and clients may send several
+    response = client.get("/movies/44", headers={"If-None-Match": f'"other", W/{etag}'})
+    assert response.status_code == 304
+
+    response = client.get("/movies/44", headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+
+def test_if_modified_since():
+    response = client.get("/lines/longest/2")
+    last_modified = response.headers["last-modified"]
+
+    response = client.get(
+        "/lines/longest/2", headers={"If-Modified-Since": last_modified}
+    )
+    assert response.status_code == 304
+
+    response = client.get(
+        "/lines/longest/2",
+        headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"},
+    )
+    assert response.status_code == 200
+
+
+def test_writes_change_validators():
+    def etags():
+        return [
+            client.get(path).headers["etag"]
+            for path in ("/movies/0", "/characters/10", "/characters/49", "/movies/")
+        ]
+
+    before = etags()
+    assert etags() == before
+
+    # written the way another API process would, so nothing in this process
+    # hears about it: the validators come from the database
+    conversation = ConversationJson(
+        character_1_id=10,
+        character_2_id=11,
+        lines=[{"character_id": 11, "line_text": "Did anyone else see that?"}],
+    )
+    asyncio.run(db.write_transaction(write_conversation, 0, conversation))
+
+    movie, character, other, corpus = etags()
+    assert movie != before[0]
+    assert character != before[1]
+    assert other == before[2]
+    assert corpus != before[3]
+
+
+def test_writes_by_other_processes_reach_cached_details():
+    paths = ("/movies/0", "/characters/9")
+    before = [client.get(path).json() for path in paths]
+
+    conversation = ConversationJson(
+        character_1_id=9,
+        character_2_id=5,
+        lines=[{"character_id": 9, "line_text": "Is this thing on?"}],
+    )
+    asyncio.run(db.write_transaction(write_conversation, 0, conversation))
+
+    after = [client.get(path).json() for path in paths]
+    assert after[0] != before[0]
+    assert after[1] != before[1]
+
+
+def test_missing_data_has_no_validators():
+    response = client.get("/movies/1")
+    assert response.status_code == 404
+    assert "etag" not in response.headers
@@ -0,0 +1,147 @@
+import asyncio
+import time
+import uuid
+
+from fastapi.testclient import TestClient
+
+from src import ingest
+from src.api import conversations
+from src.api.server import app
+
+
+def conversation(text):
+    return {
+        "character_1_id": 10,
+        "character_2_id": 11,
+        "lines": [{"character_id": 10, "line_text": text}],
+    }
+
+
+def test_queue(tmp_path):
+    now = [0.0]
+    queue = ingest.JobQueue(str(tmp_path / "queue.sqlite3"), clock=lambda: now[0])
+    first = queue.enqueue(0, [conversation("a")] * 3)
+    second = queue.enqueue(0, [conversation("b")] * 3)
+    third = queue.enqueue(0, [conversation("c")])
+    assert queue.status(third)["jobs_ahead"] == 2
+
+    # a batch holds whole jobs, and always at least one
+    assert [job.job_id for job in queue.claim(4)] == [first]
+    assert [job.job_id for job in queue.claim(4)] == [second, third]
+
+    queue.complete({second: [1, 2, 3]})
+    assert queue.status(second)["conversation_ids"] == [1, 2, 3]
+
+    # a job another process is writing is left to it, and one whose lease
+    # ran out because its process stopped is queued again
+    queue.recover()
+    assert queue.status(first)["status"] == "running"
+    now[0] += ingest.LEASE_SECONDS + 1
+    queue.recover()
+    assert queue.status(first)["status"] == "queued"
+    for attempt in range(ingest.MAX_ATTEMPTS - 1):
+        queue.claim(1)
+        queue.release(first, "boom")
+    assert queue.status(first)["status"] == "failed"
+    assert queue.status(first)["error"] == "boom"
+
+
+def test_idempotent_enqueue(tmp_path):
+    queue = ingest.JobQueue(str(tmp_path / "queue.sqlite3"))
+    job_id = queue.enqueue(0, [conversation("a")], "key", "hash")
+    assert queue.enqueue(0, [conversation("a")], "key", "hash") == job_id
+    assert queue.status(job_id)["number_of_conversations"] == 1
+
+
+def test_respond_async(tmp_path, monkeypatch):
+    queue = ingest.JobQueue(str(tmp_path / "queue.sqlite3"))
+    monkeypatch.setattr(ingest, "WORKERS", 1)
+    monkeypatch.setattr(ingest, "queue", queue)
+    monkeypatch.setattr(
+        conversations,
+        "ingestion",
+        ingest.WorkerPool(queue, conversations.ingest_jobs, workers=1),
+    )
+
+    with TestClient(app) as client:
+        response = client.post(
+            "/movies/0/conversations/batch/",
+            json=[conversation("Queued line one."), conversation("Queued line two.")],
+            headers={"Prefer": "respond-async"},
+        )
+        assert response.status_code == 202
+        status_url = response.headers["location"]
+        assert status_url == response.json()["status_url"]
+
+        for _ in range(100):
+            status = client.get(status_url).json()
+            if status["status"] == "done":
+                break
+            time.sleep(0.05)
+        assert status["status"] == "done"
+        assert len(status["conversation_ids"]) == 2
+
+    assert client.get("/conversations/jobs/unknown").status_code == 404
+
+
+def test_replayed_jobs_are_not_recorded_again(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(conversations, "recorded", lambda *args: recorded.append(args))
+    job = ingest.Job(str(uuid.uuid4()), 0, [conversation("Written once.")], None, None)
+
+    first = asyncio.run(conversations.ingest_jobs([job]))
+    # claimed again after a crash that came after the commit
+    second = asyncio.run(conversations.ingest_jobs([job]))
+    assert first == second
+    assert len(recorded) == 1
+
+
+def wait_for(client, status_url):
+    for _ in range(100):
+        status = client.get(status_url).json()
+        if status["status"] == "done":
+            return status
+        time.sleep(0.05)
+    return status
+
+
+def test_sync_and_async_requests_share_idempotency_keys(tmp_path, monkeypatch):
+    queue = ingest.JobQueue(str(tmp_path / "queue.sqlite3"))
+    monkeypatch.setattr(ingest, "WORKERS", 1)
+    monkeypatch.setattr(ingest, "queue", queue)
+    monkeypatch.setattr(
+        conversations,
+        "ingestion",
+        ingest.WorkerPool(queue, conversations.ingest_jobs, workers=1),
+    )
+    body = conversation("Sent both ways.")
+
+    with TestClient(app) as client:
+        # queued first, then retried without Prefer
+        key = str(uuid.uuid4())
+        queued = client.post(
+            "/movies/0/conversations/",
+            json=body,
+            headers={"Idempotency-Key": key, "Prefer": "respond-async"},
+        )
+        status = wait_for(client, queued.headers["location"])
+        assert status["status"] == "done"
+        written = client.post(
+            "/movies/0/conversations/", json=body, headers={"Idempotency-Key": key}
+        )
+        assert written.headers["idempotent-replayed"] == "true"
+        assert written.json() == {"conversation_id": status["conversation_ids"][0]}
+
+        # written first, then retried with Prefer
+        key = str(uuid.uuid4())
+        written = client.post(
+            "/movies/0/conversations/", json=body, headers={"Idempotency-Key": key}
+        )
+        queued = client.post(
+            "/movies/0/conversations/",
+            json=body,
+            headers={"Idempotency-Key": key, "Prefer": "respond-async"},
+        )
+        status = wait_for(client, queued.headers["location"])
+        assert status["status"] == "done"
+        assert status["conversation_ids"] == [written.json()["conversation_id"]]
@@ -20,6 +20,18 @@ def test_get_lines2():
     with open("test/lines/2.json", encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
+def test_stream_lines():
+    response = client.get("/lines/2/stream")
+    assert response.status_code == 200
+
+    with open("test/lines/2.json", encoding="utf-8") as f:
+        assert json.loads(response.text) == json.load(f)
+
+
+def test_stream_lines_404():
+    response = client.get("/lines/400/stream")
+    assert response.status_code == 404
+
 def test_get_conversations():
     response = client.get("/lines/2/conversations")
     assert response.status_code == 200
@@ -34,6 +46,39 @@ def test_get_conversations2():
     with open("test/lines/conv4.json", encoding="utf-8") as f:
         assert response.json() == json.load(f)
 
+def test_conversation_pages():
+    with open("test/lines/conv2.json", encoding="utf-8") as f:
+        expected = json.load(f)["conversations"]
+
+    conversations = []
+    response = client.get("/lines/2/conversations?cursor=&limit=7")
+    while True:
+        assert response.status_code == 200
+        conversations += response.json()["conversations"]
+        next_cursor = response.json()["next_cursor"]
+        if next_cursor is None:
+            break
+        response = client.get(f"/lines/2/conversations?cursor={next_cursor}&limit=7")
+    assert conversations == expected
+
+def test_conversation_previews():
+    response = client.get("/lines/2/conversations?limit=3&preview=2")
+    assert response.status_code == 200
+
+    with open("test/lines/conv2.json", encoding="utf-8") as f:
+        expected = json.load(f)["conversations"][:3]
+    conversations = response.json()["conversations"]
+    assert [
+        conversation["conversation_id"] for conversation in conversations
+    ] == expected
+    for conversation in conversations:
+        assert conversation["partner"]["character_id"] != 2
+        assert 0 < len(conversation["lines"]) <= 2
+        assert {line["character_id"] for line in conversation["lines"]} <= {
+            2,
+            conversation["partner"]["character_id"],
+        }
+
 def test_get_longest_lines():
     response = client.get("/lines/longest/1?limit=1&offset=2")
     assert response.status_code == 200
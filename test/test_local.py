@@ -0,0 +1,77 @@
+from src.local import DEFAULT_DATA_DIR, LocalCorpus
+
+import json
+
+corpus = LocalCorpus(DEFAULT_DATA_DIR)
+
+
+def test_movies():
+    with open("test/movies/root.json", encoding="utf-8") as f:
+        assert corpus.movies("", "movie_title", False, 50) == json.load(f)
+
+
+def test_sort_filter():
+    with open(
+        "test/movies/movies-name=big&limit=50&offset=0&sort=rating.json",
+        encoding="utf-8",
+    ) as f:
+        assert corpus.movies("big", "imdb_rating", True, 50) == json.load(f)
+
+
+def test_sort_filter2():
+    with open(
+        "test/movies/limit=250&offset=200&sort=year.json",
+        encoding="utf-8",
+    ) as f:
+        assert corpus.movies("", "year", False, 250, offset=200) == json.load(f)
+
+
+def test_cursor_matches_offset():
+    first_page = corpus.movies("", "year", False, 20)
+    last = first_page[-1]
+    next_page = corpus.movies(
+        "", "year", False, 20, position=(last["year"], last["movie_id"])
+    )
+    assert next_page == corpus.movies("", "year", False, 20, offset=20)
+
+
+def test_get_character():
+    character = corpus.character(2)
+    assert character["character"] == "CAMERON"
+    assert character["movie"] == "10 things i hate about you"
+    assert character["gender"] == "M"
+
+
+def test_conversations():
+    with open("test/lines/conv2.json", encoding="utf-8") as f:
+        assert corpus.character_conversations(2) == json.load(f)
+
+
+def test_conversation_pages():
+    conversations = corpus.character_conversations(2)["conversations"]
+    first_page = corpus.character_conversations(2, limit=5)["conversations"]
+    next_page = corpus.character_conversations(2, limit=5, after=first_page[-1])[
+        "conversations"
+    ]
+    assert first_page + next_page == conversations[:10]
+
+    previews = corpus.character_conversations(2, limit=5, preview=1)["conversations"]
+    assert [preview["conversation_id"] for preview in previews] == first_page
+    assert all(len(preview["lines"]) <= 1 for preview in previews)
+
+
+def test_404():
+    assert corpus.movie(1) is None
+    assert corpus.character(400) is None
+    assert corpus.character_lines(400) is None
+
+
+def test_transcripts():
+    conversation = corpus.conversation(0)
+    assert conversation["movie_id"] == 0
+    assert [character["character_id"] for character in conversation["characters"]] == [
+        0,
+        2,
+    ]
+    assert corpus.conversation(99999999) is None
+    assert corpus.movie_script(1) is None
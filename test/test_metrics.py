@@ -0,0 +1,72 @@
+import pytest
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from src import database as db, metrics
+from src.api.server import app
+from src.metrics import Histogram
+
+client = TestClient(app)
+
+
+def test_histogram_quantile():
+    histogram = Histogram((1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3):
+        histogram.observe(value)
+
+    assert histogram.count == 4
+    assert histogram.sum == 6.5
+    assert histogram.counts == [1, 2, 1, 0]
+    assert histogram.quantile(0.5) == 1.5
+    assert histogram.quantile(1) == 4
+
+
+def test_requests_are_recorded_by_route():
+    metrics.registry.clear()
+    response = client.get("/")
+    assert response.status_code == 200
+    assert response.headers["server-timing"].startswith("db;dur=0.0")
+    client.get("/no/such/route")
+
+    text = client.get("/metrics").text
+    assert 'movie_api_request_duration_seconds_count{method="GET",route="/"} 1' in text
+    assert (
+        'movie_api_responses_total{method="GET",route="unmatched",status="404"} 1'
+        in text
+    )
+
+    routes = client.get("/metrics/routes/").json()["routes"]
+    root = next(route for route in routes if route["route"] == "/")
+    assert root["requests"] == 1
+    assert root["statements_per_request"] == 0
+
+
+def test_prebuilt_statements_hit_the_compiled_cache():
+    # one client lifetime keeps to one event loop, and so one async engine
+    with TestClient(app) as client:
+        client.get("/characters/?name=a&limit=5")
+        hits = metrics.registry.compiled_cache_stats()["hits"]
+        client.get("/characters/?name=b&limit=7")
+        # the version lookup for the validators, and the list itself
+        assert metrics.registry.compiled_cache_stats()["hits"] == hits + 2
+
+        stats = client.get("/cache/stats/").json()
+        builder = next(
+            builder for builder in stats["statements"]
+            if builder["name"] == "characters.characters_statement"
+        )
+        assert builder["hits"] >= 1
+        assert (
+            'movie_api_compiled_cache_total{result="hit"}'
+            in client.get("/metrics").text
+        )
+
+
+def test_failed_statements_do_not_leak_start_times():
+    with db.engine.connect() as conn:
+        for _ in range(3):
+            with pytest.raises(sqlalchemy.exc.DBAPIError):
+                conn.execute(sqlalchemy.text("SELECT 1 / 0"))
+            conn.rollback()
+        conn.execute(sqlalchemy.text("SELECT 1"))
+        assert conn.info["query_start"] == []
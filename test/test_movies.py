@@ -1,5 +1,6 @@
 from fastapi.testclient import TestClient
 
+from src import pagination
 from src.api.server import app
 
 import json
@@ -55,3 +56,89 @@ def test_sort_filter2():
 def test_404():
     response = client.get("/movies/1")
     assert response.status_code == 404
+
+
+def test_cursor():
+    response = client.get("/movies/?cursor=")
+    assert response.status_code == 200
+
+    with open("test/movies/root.json", encoding="utf-8") as f:
+        assert response.json()["results"] == json.load(f)
+
+    next_page = client.get(f"/movies/?cursor={response.json()['next_cursor']}")
+    assert next_page.status_code == 200
+    first_ids = {movie["movie_id"] for movie in response.json()["results"]}
+    assert all(
+        movie["movie_id"] not in first_ids for movie in next_page.json()["results"]
+    )
+
+
+def test_cursor_wrong_sort():
+    response = client.get("/movies/?cursor=")
+    cursor = response.json()["next_cursor"]
+
+    response = client.get(f"/movies/?cursor={cursor}&sort=year")
+    assert response.status_code == 400
+
+
+def test_batch():
+    response = client.get("/movies/?ids=44,1,0")
+    assert response.status_code == 200
+
+    movies = response.json()
+    assert list(movies) == ["44", "0"]
+    assert movies["44"] == client.get("/movies/44").json()
+    assert movies["0"] == client.get("/movies/0").json()
+
+
+def test_batch_invalid_ids():
+    response = client.get("/movies/?ids=44,abc")
+    assert response.status_code == 400
+
+
+def test_fields():
+    response = client.get("/movies/?sort=rating&limit=5&fields=movie_title,year")
+    assert response.status_code == 200
+    full = client.get("/movies/?sort=rating&limit=5").json()
+    assert response.json() == [
+        {"movie_title": movie["movie_title"], "year": movie["year"]} for movie in full
+    ]
+
+    response = client.get("/movies/44?fields=title")
+    assert response.json() == {"title": client.get("/movies/44").json()["title"]}
+
+
+def test_fields_with_cursor():
+    response = client.get("/movies/?cursor=&sort=year&limit=3&fields=movie_title")
+    assert response.status_code == 200
+    assert all(list(movie) == ["movie_title"] for movie in response.json()["results"])
+
+    next_page = client.get(
+        f"/movies/?cursor={response.json()['next_cursor']}&sort=year&limit=3"
+    )
+    assert (
+        next_page.json()["results"]
+        == client.get("/movies/?sort=year&limit=3&offset=3").json()
+    )
+
+
+def test_unknown_fields():
+    assert client.get("/movies/?fields=movie_title,top_characters").status_code == 400
+    assert client.get("/movies/44?fields=").status_code == 400
+
+
+def test_cursor_wrong_key_type():
+    for sort, key in [
+        ("movie_title", 1),
+        ("year", ["1999"]),
+        ("rating", "8.1"),
+        ("rating", True),
+    ]:
+        cursor = pagination.encode_cursor(sort, key, 1)
+        response = client.get(f"/movies/?cursor={cursor}&sort={sort}")
+        assert response.status_code == 400
+
+    cursor = pagination.encode_cursor("rating", 8, {"id": 1})
+    assert client.get(f"/movies/?cursor={cursor}&sort=rating").status_code == 400
+    cursor = pagination.encode_cursor("rating", 8, 1)
+    assert client.get(f"/movies/?cursor={cursor}&sort=rating").status_code == 200
@@ -0,0 +1,37 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_search_movies():
+    response = client.get("/search/movies/?q=godfather")
+    assert response.status_code == 200
+
+    titles = [movie["movie_title"] for movie in response.json()]
+    assert "the godfather" in titles
+    assert all("godfather" in title for title in titles)
+
+
+def test_autocomplete():
+    response = client.get("/search/autocomplete/?prefix=the g&kind=movies")
+    assert response.status_code == 200
+
+    names = [suggestion["name"] for suggestion in response.json()]
+    assert "the godfather" in names
+    assert all(name.startswith("the g") for name in names)
+
+
+def test_autocomplete_empty_prefix():
+    response = client.get("/search/autocomplete/?prefix=")
+    assert response.status_code == 422
+
+
+def test_autocomplete_case_and_wildcards():
+    response = client.get("/search/autocomplete/?prefix=THE G&kind=movies")
+    assert "the godfather" in [suggestion["name"] for suggestion in response.json()]
+
+    # LIKE wildcards in the prefix match only themselves
+    response = client.get("/search/autocomplete/?prefix=_he g&kind=movies")
+    assert response.json() == []
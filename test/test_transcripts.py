@@ -0,0 +1,66 @@
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_conversation_round_trip():
+    lines = [
+        {"character_id": 10, "line_text": "Who wrote this?"},
+        {"character_id": 11, "line_text": "Nobody you know."},
+        {"character_id": 10, "line_text": "Then read it back."},
+    ]
+    response = client.post("/movies/0/conversations/", json={
+        "character_1_id": 10,
+        "character_2_id": 11,
+        "lines": lines,
+    })
+    assert response.status_code == 200
+    conversation_id = response.json()["conversation_id"]
+
+    response = client.get(f"/conversations/{conversation_id}")
+    assert response.status_code == 200
+    conversation = response.json()
+    assert conversation["movie_id"] == 0
+    assert [character["character_id"] for character in conversation["characters"]] == [
+        10,
+        11,
+    ]
+    assert [line["line_sort"] for line in conversation["lines"]] == [1, 2, 3]
+    assert [
+        {"character_id": line["character_id"], "line_text": line["line_text"]}
+        for line in conversation["lines"]
+    ] == lines
+    speakers = {
+        character["character_id"]: character["character"]
+        for character in conversation["characters"]
+    }
+    assert all(
+        line["character"] == speakers[line["character_id"]]
+        for line in conversation["lines"]
+    )
+
+    # the new conversation is part of the movie's script
+    script = client.get("/movies/0/script")
+    assert script.status_code == 200
+    assert script.json()["title"] == conversation["movie"]
+    in_script = [
+        line
+        for line in script.json()["lines"]
+        if line["conversation_id"] == conversation_id
+    ]
+    assert in_script == [
+        {"conversation_id": conversation_id, **line} for line in conversation["lines"]
+    ]
+
+
+def test_script_order():
+    lines = client.get("/movies/44/script").json()["lines"]
+    keys = [(line["conversation_id"], line["line_sort"]) for line in lines]
+    assert keys == sorted(keys)
+
+
+def test_404():
+    assert client.get("/conversations/99999999").status_code == 404
+    assert client.get("/movies/1/script").status_code == 404